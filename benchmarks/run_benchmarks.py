@@ -0,0 +1,229 @@
+"""Times each pipeline stage and the drivers end to end on synthetic data
+
+Results are appended to benchmarks/results.jsonl keyed by git commit so runs on
+different commits with the same config can be compared:
+
+    python -m benchmarks.run_benchmarks --n-tiles 4 --tile-pixels 2000 --compare
+"""
+
+import argparse
+from dataclasses import asdict, fields
+from datetime import datetime, timezone
+import json
+from pathlib import Path
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+import geopandas as gpd
+import pandas as pd
+import rasterio
+
+import building_zonals as bz
+from benchmarks.synthetic import SyntheticConfig, make_dataset
+
+BASE = Path(__file__).resolve().parent
+RESULTS = BASE.joinpath('results.jsonl')
+STATS = ['mean', 'min', 'max', 'med']
+LAYER = 'buildings_uk'
+
+def git_revision() -> Dict[str, object]:
+    """Returns commit hash of the working tree and whether it has uncommitted changes"""
+    def git(*args):
+        return subprocess.run(
+            ['git', *args], cwd=BASE, capture_output=True, text=True, check=False).stdout.strip()
+    return {
+        'commit': git('rev-parse', 'HEAD') or None,
+        'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+    }
+
+
+def time_stage(fn: Callable[[], object], repeats: int) -> Dict[str, object]:
+    """Runs fn repeats times and returns its wall times in seconds"""
+    runs = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return {'min': min(runs), 'median': statistics.median(runs), 'runs': runs}
+
+
+def run_driver(driver: type, data_dir: Path, raster_dir: Path, **kwargs) -> None:
+    """Runs a driver from cold (no cached tiles) writing its outputs to data_dir"""
+    shutil.rmtree(raster_dir.joinpath('tmp'), ignore_errors=True)
+    output_gpkg = data_dir.joinpath(f'{driver.__name__}.gpkg')
+    output_gpkg.unlink(missing_ok=True)
+    driver(
+        data_dir.joinpath('buildings.shp'),
+        data_dir.joinpath('buildings.gpkg'),
+        LAYER,
+        'osm_id',
+        27700,
+        raster_dir,
+        STATS,
+        output_gpkg=output_gpkg,
+        output_layer='building_heights',
+        **kwargs)
+
+
+def benchmark(
+    config: SyntheticConfig,
+    data_dir: Path,
+    repeats: int,
+    n_workers: int,
+    drivers: bool) -> Dict[str, Dict[str, object]]:
+    """Generates data in data_dir and times every stage
+
+    Args:
+    config: Synthetic dataset config
+    data_dir: Folder for synthetic data and outputs
+    repeats: Number of times each stage is run
+    n_workers: Workers for the multi process drivers
+    drivers: Also time the drivers end to end
+
+    Returns:
+    results: Timings of each stage
+    """
+    shp, raster_dir = make_dataset(data_dir, config)
+    gpkg = data_dir.joinpath('buildings.gpkg')
+    rasters = sorted(x for x in raster_dir.iterdir() if x.name.endswith('.tif'))
+    results = {}
+
+    def convert():
+        gpkg.unlink(missing_ok=True)
+        bz.convert_shp_to_gpkg(shp, gpkg, LAYER)
+    results['convert_shp_to_gpkg'] = time_stage(convert, repeats)
+    gdf = gpd.read_file(gpkg, layer=LAYER)
+    results['read_gpkg'] = time_stage(lambda: gpd.read_file(gpkg, layer=LAYER), repeats)
+    results['read_building_table'] = time_stage(lambda: bz.BuildingTable.read(gpkg, LAYER), repeats)
+    table = bz.BuildingTable.read(gpkg, LAYER)
+
+    results['get_buildings_using_bounds'] = time_stage(
+        lambda: [bz.get_buildings_using_bounds(x, gdf) for x in rasters], repeats)
+    raster_bounds = []
+    for raster in rasters:
+        with rasterio.open(raster) as src:
+            raster_bounds.append(tuple(src.bounds))
+    results['query_building_table'] = time_stage(
+        lambda: [table.take(table.query_bounds(x)) for x in raster_bounds], repeats)
+    blocks = [(gdf.iloc[table.query_bounds(x)], r) for x, r in zip(raster_bounds, rasters)]
+
+    grids = []
+    results['rasterise_clip'] = time_stage(
+        lambda: grids.__setitem__(slice(None), [bz.rasterise_clip(r, g) for g, r in blocks]), repeats)
+    results['get_building_height_stats'] = time_stage(
+        lambda: [bz.get_building_height_stats(x, STATS) for x in grids], repeats)
+    del grids
+    results['get_tile_building_height_partials'] = time_stage(
+        lambda: [bz.get_tile_building_height_partials(r, g) for g, r in blocks], repeats)
+    shutil.rmtree(data_dir.joinpath('raster_cache'), ignore_errors=True)
+    bz.set_raster_cache(data_dir.joinpath('raster_cache'))
+    [bz.get_raster_cache().array(x) for x in rasters] # warm, so only cached reads are timed
+    results['get_tile_building_height_partials_cached'] = time_stage(
+        lambda: [bz.get_tile_building_height_partials(r, g) for g, r in blocks], repeats)
+    bz.set_raster_cache(None)
+
+    partials = []
+    for gdf_clip, raster in blocks:
+        df = bz.get_tile_building_height_partials(raster, gdf_clip)
+        df['tile_name'] = bz.raster_tile_name(raster)
+        partials.append(df)
+    zonals_df = pd.concat(partials)
+    results['sample_missing_buildings'] = time_stage(
+        lambda: bz.sample_missing_buildings_and_join_back_to_csv(gdf, zonals_df, raster_dir), repeats)
+    df_missing, _ = bz.sample_missing_buildings_and_join_back_to_csv(gdf, zonals_df, raster_dir)
+
+    def join_and_write():
+        final_df = pd.concat([zonals_df, bz.partials_from_stats(df_missing)])
+        final_df = bz.reduce_partial_stats(final_df, STATS)
+        final_df.to_csv(data_dir.joinpath('BUILDING_ZONALS.csv'))
+        gdf_join = gdf.set_index('osm_id').join(final_df, how='inner')
+        gdf_join.to_file(data_dir.joinpath('joined.gpkg'), layer='building_heights')
+    results['reduce_join_write'] = time_stage(join_and_write, repeats)
+    final_df = bz.reduce_partial_stats(pd.concat([zonals_df, bz.partials_from_stats(df_missing)]), STATS)
+    for suffix in ['gpkg', 'parquet', 'fgb']:
+        results[f'write_building_heights_{suffix}'] = time_stage(
+            lambda: bz.write_building_heights(table, final_df, data_dir.joinpath(f'out.{suffix}'), 'building_heights'),
+            repeats)
+
+    if drivers:
+        results['BuildingHeightsSingle'] = time_stage(
+            lambda: run_driver(bz.BuildingHeightsSingle, data_dir, raster_dir), repeats)
+        results['BuildingHeightsMulti'] = time_stage(
+            lambda: run_driver(bz.BuildingHeightsMulti, data_dir, raster_dir, n_workers=n_workers), repeats)
+        results['BuildingHeightsMulti_threads'] = time_stage(
+            lambda: run_driver(bz.BuildingHeightsMulti, data_dir, raster_dir, n_workers=n_workers, engine='threads'),
+            repeats)
+        results['BuildingHeightsMosaic'] = time_stage(
+            lambda: run_driver(bz.BuildingHeightsMosaic, data_dir, raster_dir, n_workers=n_workers), repeats)
+    return results
+
+
+def load_previous(config: SyntheticConfig, commit: Optional[str]) -> Optional[dict]:
+    """Returns the latest saved result with the same config from another commit"""
+    if not RESULTS.exists():
+        return None
+    previous = None
+    with open(RESULTS) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['config'] == asdict(config) and record['commit'] != commit:
+                previous = record
+    return previous
+
+
+def print_results(results: Dict[str, Dict[str, object]], previous: Optional[dict]) -> None:
+    """Prints min time of each stage and the ratio to the previous result"""
+    for stage, timing in results.items():
+        line = f'{stage:<44}{timing["min"]:>10.3f}s'
+        if previous and stage in previous['stages']:
+            before = previous['stages'][stage]['min']
+            line += f'{before:>10.3f}s{timing["min"] / before:>8.2f}x'
+        print(line)
+    if previous:
+        print(f'compared with {previous["commit"]} ({previous["timestamp"]})')
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    for field in fields(SyntheticConfig):
+        parser.add_argument(f'--{field.name.replace("_", "-")}', type=type(field.default), default=field.default)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--n-workers', type=int, default=2)
+    parser.add_argument('--no-drivers', action='store_true', help='only time the stages')
+    parser.add_argument('--data-dir', type=Path, help='keep generated data here instead of a temp folder')
+    parser.add_argument('--compare', action='store_true', help='compare with the last result of another commit')
+    parser.add_argument('--no-save', action='store_true', help='do not append to results.jsonl')
+    args = parser.parse_args(argv)
+    config = SyntheticConfig(**{x.name: getattr(args, x.name) for x in fields(SyntheticConfig)})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = args.data_dir or Path(tmp)
+        data_dir.mkdir(parents=True, exist_ok=True)
+        results = benchmark(config, data_dir, args.repeats, args.n_workers, not args.no_drivers)
+        n_buildings = len(gpd.read_file(data_dir.joinpath('buildings.gpkg'), layer=LAYER, columns=['osm_id']))
+
+    revision = git_revision()
+    record = {
+        **revision,
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'config': asdict(config),
+        'n_buildings': n_buildings,
+        'repeats': args.repeats,
+        'n_workers': args.n_workers,
+        'stages': results,
+    }
+    print_results(results, load_previous(config, revision['commit']) if args.compare else None)
+    if not args.no_save:
+        with open(RESULTS, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    main()
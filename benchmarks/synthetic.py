@@ -0,0 +1,127 @@
+"""Generates synthetic DSM tiles and building footprints for benchmarks"""
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Tuple, Union
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+import building_zonals as bz
+
+# Tiles are placed around the corners of these 2x2 blocks of BNG 10km cells so
+# neighbouring tiles touch and buildings can straddle them
+CORNERS = [(540000, 190000), (560000, 190000), (540000, 170000), (560000, 170000)]
+
+@dataclass
+class SyntheticConfig:
+    """Size and density of a synthetic dataset"""
+    n_tiles: int = 4
+    tile_pixels: int = 1000
+    resolution: float = 1.0
+    buildings_per_km2: int = 4000
+    min_size: float = 0.8
+    max_size: float = 40.0
+    overlap_fraction: float = 0.05
+    seed: int = 0
+
+
+def tile_name(easting: float, northing: float) -> str:
+    """Returns BNG 10km tile name of a point"""
+    return bz.tile_names([easting], [northing])[0]
+
+
+def tile_origins(config: SyntheticConfig) -> List[Tuple[str, float, float]]:
+    """Returns name and top left corner of each tile"""
+    size = config.tile_pixels * config.resolution
+    origins = []
+    for corner in CORNERS:
+        for dx, dy in [(-1, 0), (0, 0), (-1, -1), (0, -1)]:
+            if len(origins) == config.n_tiles:
+                return origins
+            left = corner[0] + dx * size
+            top = corner[1] + (dy + 1) * size
+            origins.append((tile_name(left + size / 2, top - size / 2), left, top))
+    if len(origins) < config.n_tiles:
+        raise ValueError(f'At most {len(origins)} synthetic tiles are supported')
+    return origins
+
+
+def make_tile(
+    path: Union[Path, str],
+    left: float,
+    top: float,
+    config: SyntheticConfig,
+    seed: int) -> Path:
+    """Writes a tiled, deflate compressed float32 DSM with smooth terrain, noise and nodata holes"""
+    rng = np.random.default_rng(seed)
+    n = config.tile_pixels
+    y, x = np.mgrid[0:n, 0:n].astype(np.float32) / n
+    heights = 2000 + 500 * np.sin(6 * x + seed) * np.cos(4 * y) + rng.normal(0, 300, (n, n)).astype(np.float32)
+    heights[rng.random((n, n)) < 0.002] = -9999.0
+    with rasterio.open(
+            path, 'w', driver='GTiff', width=n, height=n, count=1, dtype='float32',
+            crs='EPSG:27700', nodata=-9999.0,
+            transform=from_origin(left, top, config.resolution, config.resolution),
+            tiled=True, blockxsize=256, blockysize=256, compress='deflate') as dst:
+        dst.write(heights.astype(np.float32), 1)
+    return Path(path)
+
+
+def make_buildings(
+    bounds: Tuple[float, float, float, float],
+    config: SyntheticConfig,
+    seed: int,
+    first_id: int = 1_000_000_000) -> gpd.GeoDataFrame:
+    """Returns random rectangular buildings over bounds, a fraction placed overlapping another"""
+    rng = np.random.default_rng(seed)
+    left, bottom, right, top = bounds
+    n = int((right - left) * (top - bottom) / 1e6 * config.buildings_per_km2)
+    w = np.exp(rng.uniform(np.log(config.min_size), np.log(config.max_size), n))
+    h = w * rng.uniform(0.5, 2, n)
+    x = rng.uniform(left - config.max_size / 2, right, n)
+    y = rng.uniform(bottom - config.max_size / 2, top, n)
+    overlapping = rng.random(n) < config.overlap_fraction
+    partners = rng.integers(0, n, n)
+    x[overlapping] = x[partners[overlapping]] + w[partners[overlapping]] / 2
+    y[overlapping] = y[partners[overlapping]] + h[partners[overlapping]] / 2
+    gdf = gpd.GeoDataFrame({
+            'osm_id': np.arange(n, dtype=np.int64) + first_id,
+            'name': np.where(rng.random(n) < 0.1, 'named building', None),
+            'type': rng.choice(['house', 'yes', 'commercial', 'residential'], n)},
+        geometry=[box(*b) for b in zip(x, y, x + w, y + h)],
+        crs=27700)
+    return gdf
+
+
+def make_dataset(
+    out_dir: Union[Path, str],
+    config: SyntheticConfig) -> Tuple[Path, Path]:
+    """Writes synthetic rasters to out_dir/rasters and buildings shapefile (EPSG:4326 like OSM) to out_dir
+
+    Args:
+    out_dir: Folder to write to
+    config: Size and density of the dataset
+
+    Returns:
+    shp: Path to buildings shapefile
+    raster_dir: Folder of rasters
+    """
+    out_dir = Path(out_dir)
+    raster_dir = out_dir.joinpath('rasters')
+    raster_dir.mkdir(parents=True, exist_ok=True)
+    size = config.tile_pixels * config.resolution
+    buildings = []
+    first_id = 1_000_000_000
+    for i, (name, left, top) in enumerate(tile_origins(config)):
+        make_tile(bz.raster_path(raster_dir, name), left, top, config, config.seed + i)
+        buildings.append(make_buildings((left, top - size, left + size, top), config, config.seed + i, first_id))
+        first_id += len(buildings[-1])
+    gdf = pd.concat(buildings, ignore_index=True)
+    shp = out_dir.joinpath('buildings.shp')
+    gdf.to_crs(4326).to_file(shp)
+    return shp, raster_dir
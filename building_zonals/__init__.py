@@ -1,3 +1,21 @@
+from .grid import *
+from .raster_pool import *
+from .ledger import *
+from .tile_cache import *
 from .utils import *
+from .helpers import *
+from .zonal_stats import *
+from .windowed import *
+from .engine import *
+from .store import *
+from .cache import *
+from .mosaic import *
+from .instrument import *
+from .lazy import *
+from .table import *
+from .planner import *
+from .pipeline import *
+from .partition import *
+from .output import *
+from .lookup import *
 from .building_heights import *
-from .helpers import *
\ No newline at end of file
@@ -1,15 +1,19 @@
 """Module with class to carry out functionality to calculate zonals in multiple tiles"""
 
-from dataclasses import dataclass
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import Union, List, Optional, Tuple
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Union, Iterator, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import logging
 
 import geopandas as gpd
 import pandas as pd
 
 import building_zonals as bz
 
+logger = logging.getLogger(__name__)
+
 @dataclass
 class BuildingHeights:
     """Processes zonal stats in chunks"""
@@ -23,48 +27,232 @@ class BuildingHeights:
     output_gpkg: Optional[Union[str, Path, None]] = None
     output_layer: Optional[Union[str, None]] = None
     save_output_gpkg: Optional[bool] = True
+    memory_budget: Optional[int] = None
+    metrics: Optional[bz.Metrics] = None
+    ledger: Optional[bz.JobLedger] = None
+    manifest: Optional[bz.TileManifest] = None
 
     def process(self):
-        gdf = gpd.read_file(self.building_gpkg, layer=self.building_layer)
-        self.get_building_heights(gdf, self.raster)
+        """Calculates the tile's partial heights unless its saved parquet is current
+
+        With a manifest the parquet is current when it was computed from the
+        same raster, buildings and stats, so refreshed buildings or rasters
+        are recomputed. Without one, a done job in the ledger (or else an
+        existing parquet) is enough.
+        """
+        metrics = self.metrics or bz.Metrics(self.building_gpkg.parent.joinpath(bz.METRICS_FILE))
+        tile = self.building_gpkg.stem
+        out_parquet = self.building_gpkg.parent.joinpath(f'{tile}.parquet')
+        if self.manifest is None and self.ledger is not None and self.ledger.is_done(tile):
+            logger.info(f'Already processed {tile}')
+            return
+        if self.ledger is not None:
+            self.ledger.start(tile)
+        try:
+            with metrics.stage('read_buildings', self.raster.stem) as record:
+                gdf = bz.compact_buildings(gpd.read_file(self.building_gpkg, layer=self.building_layer))
+                record.buildings = len(gdf)
+            if self.manifest is None:
+                if not out_parquet.exists():
+                    self.get_building_heights(gdf, self.raster, metrics)
+            else:
+                with metrics.stage('fingerprint', self.raster.stem):
+                    fingerprint = bz.tile_fingerprint(self.raster, gdf, self.stats, self.manifest.get(tile))
+                if self.manifest.is_current(tile, fingerprint, out_parquet):
+                    logger.info(f'Unchanged {tile}')
+                else:
+                    self.get_building_heights(gdf, self.raster, metrics)
+                    self.manifest.record(tile, fingerprint)
+        except Exception as error:
+            if self.ledger is not None:
+                self.ledger.fail(tile, error)
+            raise
+        if self.ledger is not None:
+            self.ledger.done(tile)
+        metrics.tile_done(self.raster.stem, len(gdf))
         
 
     def get_building_heights(
         self,
         gdf_clip: gpd.GeoDataFrame,
-        raster: Union[Path, str]):
-        """Rasterises, calculates heights and saves csv
+        raster: Union[Path, str],
+        metrics: bz.Metrics):
+        """Rasterises, calculates heights and saves parquet (replacing an earlier one)
         
+        The parquet is written last and atomically, so it only exists once the
+        tile is complete.
+
         Args:
         gdf_clip: Buildings clipped to raster
         raster: Path to raster
+        metrics: Records stage costs of the tile
 
         Returns:
         None
         """
-        out_csv = self.building_gpkg.parent.joinpath(f'{self.building_gpkg.stem}.csv')
-        if not out_csv.exists():
-            grid = bz.rasterise_clip(raster, gdf_clip)
-            df = bz.get_building_height_stats(grid, self.stats)
-            df['tile_name'] = raster.name.split('_')[2]
-            df.to_csv(out_csv, index=False)
+        out_parquet = self.building_gpkg.parent.joinpath(f'{self.building_gpkg.stem}.parquet')
+        with metrics.stage(
+                'zonal_stats', raster.stem, buildings=len(gdf_clip), bytes_read=raster.stat().st_size) as record:
+            df = bz.get_tile_building_height_partials(raster, gdf_clip, self.memory_budget)
+            df['tile_name'] = bz.raster_tile_name(raster)
+            record.pixels = bz.raster_pixels(raster)
+        with metrics.stage('sample_missing', raster.stem) as record:
             df_missing, gdf_overlapping = bz.sample_missing_buildings_and_join_back_to_csv(
                 gdf_clip,
-                self.building_gpkg.parent.joinpath(f'{self.building_gpkg.stem}.csv'),
+                df,
                 self.raster.parent
             )
-            df_zonals = pd.concat([df, df_missing])
-            df.to_csv(out_csv, index=False)
-            if not gdf_overlapping.empty:
-                gdf_overlapping.to_file(self.output_gpkg, layer='overlapping_buildings', index=False)
+            record.buildings = len(df_missing)
+        df_zonals = pd.concat([df, bz.partials_from_stats(df_missing)])
+        bz.write_frame(gdf_overlapping, self.output_gpkg, 'overlapping_buildings') # replaces an earlier run's layer
+        with metrics.stage('write_partials', raster.stem) as record:
+            bz.write_zonals(df_zonals, out_parquet)
+            record.bytes_written = out_parquet.stat().st_size
 
             
 
 
 
 
+class _RasterDirDriver:
+    """Shared setup and outputs of the drivers that process the rasters of raster_dir, keeping their state in raster_dir/tmp"""
+
+    def get_tmp_folder(self) -> Path:
+        """Returns raster_dir/tmp, making it if needed"""
+        tmp_folder = self.raster_dir.joinpath('tmp')
+        if not tmp_folder.exists():
+            tmp_folder.mkdir()
+        return tmp_folder
+
+
+    def get_rasters(self) -> List[Path]:
+        """Returns rasters in raster_dir"""
+        return [x for x in self.raster_dir.iterdir() if x.name.endswith('.tif')]
+
+
+    def make_zonals_table(self) -> pd.DataFrame:
+        """Append tile parquets of the rasters in raster_dir into one (parquets of removed rasters are left out)"""
+        tmp_folder = self.get_tmp_folder()
+        tiles = [tmp_folder.joinpath(f'{x.stem}.parquet') for x in self.get_rasters()]
+        return bz.merge_zonals([x for x in tiles if x.exists()], tmp_folder.joinpath(bz.ZONALS_TABLE))
+
+
+    def get_manifest(self) -> bz.TileManifest:
+        """Opens manifest of tile fingerprints in raster_dir/tmp"""
+        return bz.TileManifest(self.get_tmp_folder().joinpath(bz.MANIFEST))
+
+
+    def get_ledger(self) -> bz.JobLedger:
+        """Opens ledger of tile job states in raster_dir/tmp and logs what is left from earlier runs"""
+        ledger = bz.JobLedger(self.get_tmp_folder().joinpath(bz.LEDGER))
+        ledger.add(x.stem for x in self.get_rasters())
+        logger.info(f'Tile jobs: {ledger.counts()}')
+        return ledger
+
+
+    def get_metrics(self) -> bz.Metrics:
+        """Returns metrics recorder appending to raster_dir/tmp/metrics.jsonl (not saved if instrument is False)"""
+        path = self.get_tmp_folder().joinpath(bz.METRICS_FILE) if self.instrument else None
+        return bz.Metrics(path, total_tiles=len(self.get_rasters()))
+
+
+    def get_geoms(self) -> bz.BuildingTable:
+        """Opens/converts buildings to a compact building table
+        
+        Args:
+        self: class
+
+        Returns:
+        buildings: BuildingTable of buildings
+        """
+        if not Path(self.building_gpkg).resolve().exists():
+            bz.convert_shp_to_gpkg(
+                    self.building_shp,
+                    self.building_gpkg, 
+                    self.building_layer)
+        return bz.BuildingTable.read(self.building_gpkg, self.building_layer, self.building_id_field)
+
+
+    @contextmanager
+    def open_run(self) -> Iterator[None]:
+        """Turns on the raster cache for the run and closes the pooled rasters after it, also when it fails"""
+        with bz.use_raster_cache(self.raster_cache):
+            try:
+                yield
+            finally:
+                bz.close_rasters()
+
+
+    def check_output(self) -> None:
+        """Fails on an unsupported output format before any tile is processed"""
+        if self.save_output_gpkg and self.output_gpkg:
+            bz.get_driver(self.output_gpkg)
+
+
+    def sample_missing(
+        self,
+        buildings: bz.BuildingTable,
+        zonals_df: pd.DataFrame) -> Tuple[pd.DataFrame, gpd.GeoDataFrame]:
+        """Samples buildings of processed tiles missing in zonals_df at their centroid
+
+        Args:
+        buildings: Buildings table
+        zonals_df: Merged partial stats
+
+        Returns:
+        df_missing: DataFrame of missing building heights
+        gdf_overlapping: Gdf of buildings presumed to be overlapping
+        """
+        return bz.sample_missing_buildings_and_join_back_to_csv(
+            buildings.take(buildings.missing(zonals_df)),
+            zonals_df,
+            self.raster_dir
+        )
+
+
+    def finish(
+        self,
+        buildings: bz.BuildingTable,
+        metrics: bz.Metrics) -> pd.DataFrame:
+        """Merges the saved partials, fills in missing buildings, reduces and writes the outputs
+
+        Args:
+        buildings: Buildings table
+        metrics: Records stage costs of the run
+
+        Returns:
+        final_df: Heights of each building
+        """
+        with metrics.stage('merge_tiles') as record:
+            zonals_df = self.make_zonals_table()
+            record.buildings = len(zonals_df)
+        with metrics.stage('sample_missing') as record:
+            df_missing, gdf_overlapping = self.sample_missing(buildings, zonals_df)
+            record.buildings = len(df_missing)
+        logger.info(f'Sampled {len(df_missing)} missing buildings')
+        with metrics.stage('reduce', buildings=len(zonals_df) + len(df_missing)):
+            final_df = pd.concat([zonals_df, bz.partials_from_stats(df_missing)])
+            final_df = bz.compact_heights(bz.reduce_partial_stats(final_df, self.stats, self.building_id_field))
+        metrics.buildings = len(final_df)
+        with metrics.stage('write_csv', buildings=len(final_df)) as record:
+            csv = self.output_gpkg.parent.joinpath('BUILDING_ZONALS.csv')
+            with bz.atomic_path(csv) as tmp:
+                final_df.to_csv(tmp)
+            record.bytes_written = csv.stat().st_size
+        if self.save_output_gpkg and self.output_gpkg and self.output_layer:
+            logger.info('Saving buildings')
+            with metrics.stage('write_gpkg') as record:
+                n_joined = bz.write_building_heights(buildings, final_df, self.output_gpkg, self.output_layer)
+                n_overlapping = bz.write_frame(gdf_overlapping, self.output_gpkg, 'overlapping_buildings')
+                record.buildings = n_joined + n_overlapping
+        if self.instrument:
+            metrics.log_summary()
+        return final_df
+
+
+
 @dataclass
-class BuildingHeightsSingle:
+class BuildingHeightsSingle(_RasterDirDriver):
     """Processes zonal stats using single core"""
     building_shp: Union[str, Path]
     building_gpkg: Union[str, Path]
@@ -76,115 +264,106 @@ class BuildingHeightsSingle:
     output_gpkg: Optional[Union[str, Path, None]] = None
     output_layer: Optional[Union[str, None]] = None
     save_output_gpkg: Optional[bool] = True
+    memory_budget: Optional[int] = None
+    lazy_chunk_size: Optional[int] = None
+    scheduler: Optional[str] = 'threads'
+    instrument: Optional[bool] = True
+    prefetch: Optional[int] = bz.PREFETCH_DEPTH
+    max_pending_writes: Optional[int] = 2
+    raster_cache: Optional[Union[str, Path, None]] = None
 
     def __post_init__(self):
-        gdf = self.get_geoms()
-        print('GOT BUILDINGS')
-        for gdf_clip, raster in self.get_blocks(gdf):
-            self.get_building_heights(gdf_clip, raster)
-        self.make_zonals_table()
-        df_missing, gdf_overlapping = bz.sample_missing_buildings_and_join_back_to_csv(
-            gdf,
-            self.raster_dir.joinpath('tmp/ZONALS.csv'),
-            self.raster_dir
-        )
-        print('GOT MISSING BUILDINGS')
-        zonals_df = pd.read_csv(self.raster_dir.joinpath('tmp/ZONALS.csv'))
-        final_df = pd.concat([zonals_df, df_missing])
-        final_df = final_df.groupby(self.building_id_field).agg({
-                "heights_mean": ['mean'],
-                "heights_min": ['min'],
-                "heights_max": ['max'],
-                "heights_med": ['median']})
-        final_df.columns = ["heights_mean", "heights_min", "heights_max", "heights_med"]
-        final_df.to_csv(self.output_gpkg.parent.joinpath('BUILDING_ZONALS.csv'))
-        if self.save_output_gpkg and self.output_gpkg and self.output_layer:
-            print('SAVING BUILDINGS')
-            gdf = gdf.set_index(self.building_id_field)
-            gdf = gdf[[x for x in gdf.columns if not x in ["heights_mean", "heights_min", "heights_max", "heights_med"]]]
-            gdf_join = gdf.join(final_df, how='inner')
-            gdf_join = gdf_join[['name', 'type', 'tile_name', "heights_mean", "heights_min", "heights_max", "heights_med", "geometry"]]
-            gdf_join.to_file(self.output_gpkg, layer=self.output_layer)
-            gdf_overlapping.to_file(self.output_gpkg, layer="overlapping_buildings")
-
-
-
-    def make_zonals_table(self):
-        """Append all csvs into one"""
-        tmp_csv_folder = self.raster_dir.joinpath('tmp')
-        ZONALS_TABLE = tmp_csv_folder.joinpath('ZONALS.csv')
-        df_list = [pd.read_csv(x) for x in tmp_csv_folder.iterdir() if x.name.endswith('.csv') if not x.name=='ZONALS.csv']
-        zonals_df = pd.concat(df_list)
-        zonals_df.to_csv(ZONALS_TABLE, index=False)
-        
-
-    
-    def get_building_heights(
+        self.check_output()
+        with self.open_run():
+            metrics = self.get_metrics()
+            with metrics.stage('load_buildings') as record:
+                buildings = self.get_geoms()
+                record.buildings = len(buildings)
+            logger.info(f'Loaded {len(buildings)} buildings ({buildings.nbytes / 1e6:.0f} MB)')
+            manifest = self.get_manifest()
+            ledger = self.get_ledger()
+            with ThreadPoolExecutor(max_workers=1, thread_name_prefix='reader') as reader, \
+                    ThreadPoolExecutor(max_workers=1, thread_name_prefix='writer') as writer:
+                writes = self.get_writes(reader, buildings, manifest, ledger, metrics)
+                try:
+                    for out_parquet, fingerprint, records in bz.run_tasks(
+                            writer, bz.write_tile, writes, self.max_pending_writes):
+                        manifest.record(out_parquet.stem, fingerprint)
+                        ledger.done(out_parquet.stem)
+                        metrics.add(records)
+                        metrics.tile_done(out_parquet.stem, records[0].buildings)
+                except Exception as error: # a write failed, or a tile failed with writes pending
+                    ledger.fail_running(error)
+                    raise
+                finally:
+                    manifest.save()
+            self.finish(buildings, metrics)
+
+
+
+    def get_writes(
         self,
-        gdf_clip: gpd.GeoDataFrame,
-        raster: Union[Path, str]):
-        """Rasterises, calculates heights and saves csv
-        
-        Args:
-        gdf_clip: Buildings clipped to raster
-        raster: Path to raster
+        reader: ThreadPoolExecutor,
+        buildings: bz.BuildingTable,
+        manifest: bz.TileManifest,
+        ledger: bz.JobLedger,
+        metrics: bz.Metrics) -> Iterator[Tuple[pd.DataFrame, Path, dict, int]]:
+        """Yields a write job for each changed tile while the reader prefetches the next tiles
+
+        While this thread computes a tile, the reader thread decodes the
+        buildings, fingerprints and reads the raster of the next prefetch
+        tiles. Unchanged tiles are finished here, changed ones are yielded to
+        be saved by the writer.
 
-        Returns:
-        None
-        """
-        tmp_csv_folder = self.raster_dir.joinpath('tmp')
-        if not tmp_csv_folder.exists():
-            tmp_csv_folder.mkdir()
-        out_csv = tmp_csv_folder.joinpath(f'{raster.stem}.csv')
-        if not out_csv.exists():
-            grid = bz.rasterise_clip(raster, gdf_clip)
-            df = bz.get_building_height_stats(grid, self.stats)
-            df['tile_name'] = raster.name.split('_')[2]
-            df.to_csv(out_csv, index=False)
-
-
-    def get_blocks(self, gdf: gpd.GeoDataFrame) -> Tuple[gpd.GeoDataFrame, Union[Path, str]]:
-        """Yields each geodataframe clipped to bounds of each raster
-        
         Args:
-        gdf: Buildings geodataframe
+        reader: Single thread pool loading tiles
+        buildings: Buildings table
+        manifest: Fingerprints of saved tiles
+        ledger: Tile job states
+        metrics: Records stage costs of the tile
 
         Yields:
-        gdf_clip : GeoDataFrame clipped to raster
-        raster: Path to raster
-        """
-        rasters = [x for x in self.raster_dir.iterdir() if x.name.endswith('.tif')]
-        for raster in rasters:
-            gdf_clip = bz.get_buildings_using_bounds(
-                    raster,
-                    gdf
-                )
-            yield gdf_clip, raster        
-        
-
-    def get_geoms(self) -> gpd.GeoDataFrame:
-        """Opens/converts buildings to geodataframe
-        
-        Args:
-        self: class
-
-        Returns:
-        gdf: GeoDataFrame of buildings
+        write: bz.write_tile arguments
         """
-        if not Path(self.building_gpkg).resolve().exists():
-            gdf = bz.convert_shp_to_gpkg(
-                    self.building_shp,
-                    self.building_gpkg, 
-                    self.building_layer)
-        else:
-            gdf = gpd.read_file(self.building_gpkg, layer=self.building_layer)
-        return gdf
+        tmp_folder = self.get_tmp_folder()
+        rasters = self.get_rasters()
+
+        def load(raster: Path) -> bz.TileInput:
+            return bz.load_tile(
+                raster,
+                buildings,
+                self.stats,
+                tmp_folder.joinpath(f'{raster.stem}.parquet'),
+                manifest.get(raster.stem),
+                read_raster=not (self.memory_budget or self.lazy_chunk_size))
+
+        for raster, future in bz.prefetch(reader, load, rasters, self.prefetch):
+            ledger.start(raster.stem)
+            try:
+                tile = future.result()
+                metrics.add(tile.records)
+                if tile.current:
+                    ledger.done(raster.stem)
+                    metrics.tile_done(raster.stem, len(tile.gdf))
+                    continue
+                with metrics.stage(
+                        'zonal_stats', raster.stem, buildings=len(tile.gdf), bytes_read=raster.stat().st_size) as record:
+                    if self.lazy_chunk_size:
+                        df = bz.get_tile_building_height_partials_lazy(
+                            raster, tile.gdf, self.lazy_chunk_size, self.scheduler)
+                    else:
+                        df = bz.get_tile_building_height_partials(raster, tile.gdf, self.memory_budget, tile.heights)
+                    df['tile_name'] = bz.raster_tile_name(raster)
+                    record.pixels = bz.raster_pixels(raster)
+            except Exception as error:
+                ledger.fail(raster.stem, error)
+                raise
+            yield df, tmp_folder.joinpath(f'{raster.stem}.parquet'), tile.fingerprint, len(tile.gdf)
 
-            
 
 @dataclass
-class BuildingHeightsMulti:
-    """Processes zonal stats using single core"""
+class BuildingHeightsMulti(_RasterDirDriver):
+    """Processes zonal stats using multiple processes, or threads sharing one building table"""
     building_shp: Union[str, Path]
     building_gpkg: Union[str, Path]
     building_layer: str
@@ -196,108 +375,201 @@ class BuildingHeightsMulti:
     output_layer: Optional[Union[str, None]] = None
     save_output_gpkg: Optional[bool] = True
     n_workers: Optional[int] = 2
+    memory_budget: Optional[int] = None
+    max_in_flight: Optional[int] = None
+    lazy_chunk_size: Optional[int] = None
+    instrument: Optional[bool] = True
+    dry_run: Optional[bool] = False
+    cost_model: Optional[bz.CostModel] = None
+    engine: Optional[str] = 'processes'
+    raster_cache: Optional[Union[str, Path, None]] = None
 
     def __post_init__(self):
-        gdf = self.get_geoms()
-        print('GOT BUILDINGS')
-        with ProcessPoolExecutor(max_workers=self.n_workers) as exec:
-            for gdf_clip, raster in self.get_blocks(gdf):
-                future = exec.submit(self.get_building_heights, gdf_clip, raster)
-        self.make_zonals_table()
-        df_missing, gdf_overlapping = bz.sample_missing_buildings_and_join_back_to_csv(
-            gdf,
-            self.raster_dir.joinpath('tmp/ZONALS.csv'),
-            self.raster_dir
-        )
-        print('GOT MISSING BUILDINGS')
-        zonals_df = pd.read_csv(self.raster_dir.joinpath('tmp/ZONALS.csv'))
-        final_df = pd.concat([zonals_df, df_missing])
-        final_df = final_df.groupby(self.building_id_field).agg({
-                "heights_mean": ['mean'],
-                "heights_min": ['min'],
-                "heights_max": ['max'],
-                "heights_med": ['median']})
-        final_df.columns = ["heights_mean", "heights_min", "heights_max", "heights_med"]
-        final_df.to_csv(self.output_gpkg.parent.joinpath('BUILDING_ZONALS.csv'))
-        if self.save_output_gpkg and self.output_gpkg and self.output_layer:
-            print('SAVING BUILDINGS')
-            gdf = gdf.set_index(self.building_id_field)
-            gdf = gdf[[x for x in gdf.columns if not x in ["heights_mean", "heights_min", "heights_max", "heights_med"]]]
-            gdf_join = gdf.join(final_df, how='inner')
-            gdf_join = gdf_join[['name', 'type', 'tile_name', "heights_mean", "heights_min", "heights_max", "heights_med", "geometry"]]
-            gdf_join.to_file(self.output_gpkg, layer=self.output_layer)
-            gdf_overlapping.to_file(self.output_gpkg, layer="overlapping_buildings")
-
-
-
-    def make_zonals_table(self):
-        """Append all csvs into one"""
-        tmp_csv_folder = self.raster_dir.joinpath('tmp')
-        ZONALS_TABLE = tmp_csv_folder.joinpath('ZONALS.csv')
-        df_list = [pd.read_csv(x) for x in tmp_csv_folder.iterdir() if x.name.endswith('.csv') if not x.name=='ZONALS.csv']
-        zonals_df = pd.concat(df_list)
-        zonals_df.to_csv(ZONALS_TABLE, index=False)
-        
-
-    
-    def get_building_heights(
+        if self.engine not in ('processes', 'threads'):
+            raise ValueError(f"Unsupported engine {self.engine}, use 'processes' or 'threads'")
+        self.check_output()
+        metrics = self.get_metrics()
+        with metrics.stage('load_buildings') as record:
+            buildings = self.get_geoms()
+            record.buildings = len(buildings)
+        logger.info(f'Loaded {len(buildings)} buildings ({buildings.nbytes / 1e6:.0f} MB)')
+        max_in_flight = self.max_in_flight or 2 * self.n_workers
+        manifest = self.get_manifest()
+        ledger = self.get_ledger()
+        with metrics.stage('plan_tiles'):
+            self.plan = self.get_plan(buildings, ledger)
+        logger.info(self.plan.report())
+        if self.dry_run:
+            return
+        with self.open_run(): # cache set before the pool starts so workers inherit it
+            threads = self.engine == 'threads'
+            pool = ThreadPoolExecutor if threads else ProcessPoolExecutor
+            with pool(max_workers=self.n_workers) as exec:
+                tasks = self.get_tasks(self.plan, manifest, ledger, buildings)
+                process_tile = bz.process_tile_shared if threads else bz.process_tile
+                try:
+                    for out_parquet, fingerprint, records in bz.run_tasks(exec, process_tile, tasks, max_in_flight):
+                        manifest.record(out_parquet.stem, fingerprint)
+                        ledger.done(out_parquet.stem)
+                        metrics.add(records)
+                        metrics.tile_done(out_parquet.stem, records[0].buildings)
+                except Exception as error: # the failed tile is one of those in flight
+                    ledger.fail_running(error)
+                    raise
+                finally:
+                    manifest.save()
+            self.finish(buildings, metrics)
+
+
+
+    def get_tasks(
         self,
-        gdf_clip: gpd.GeoDataFrame,
-        raster: Union[Path, str]):
-        """Rasterises, calculates heights and saves csv
-        
-        Args:
-        gdf_clip: Buildings clipped to raster
-        raster: Path to raster
-
-        Returns:
-        None
-        """
-        tmp_csv_folder = self.raster_dir.joinpath('tmp')
-        if not tmp_csv_folder.exists():
-            tmp_csv_folder.mkdir()
-        out_csv = tmp_csv_folder.joinpath(f'{raster.stem}.csv')
-        if not out_csv.exists():
-            grid = bz.rasterise_clip(raster, gdf_clip)
-            df = bz.get_building_height_stats(grid, self.stats)
-            df['tile_name'] = raster.name.split('_')[2]
-            df.to_csv(out_csv, index=False)
-
-
-    def get_blocks(self, gdf: gpd.GeoDataFrame) -> Tuple[gpd.GeoDataFrame, Union[Path, str]]:
-        """Yields each geodataframe clipped to bounds of each raster
+        plan: bz.TilePlan,
+        manifest: bz.TileManifest,
+        ledger: bz.JobLedger,
+        buildings: bz.BuildingTable) -> Tuple:
+        """Yields process_tile arguments for each raster in plan order, marking its job running as it is submitted
         
         Args:
-        gdf: Buildings geodataframe
+        plan: Rasters in submission order
+        manifest: Fingerprints of saved tiles
+        ledger: Tile job states
+        buildings: Buildings table (passed to threads, processes read the geopackage)
 
         Yields:
-        gdf_clip : GeoDataFrame clipped to raster
-        raster: Path to raster
+        task: Paths and settings for bz.process_tile (bz.process_tile_shared with threads)
         """
-        rasters = [x for x in self.raster_dir.iterdir() if x.name.endswith('.tif')]
-        for raster in rasters:
-            gdf_clip = bz.get_buildings_using_bounds(
-                    raster,
-                    gdf
-                )
-            yield gdf_clip, raster        
-        
+        tmp_folder = self.get_tmp_folder()
+        threads = self.engine == 'threads'
+        sources = (buildings,) if threads else (self.building_gpkg, self.building_layer)
+        for raster in plan.rasters:
+            out_parquet = tmp_folder.joinpath(f'{raster.stem}.parquet')
+            ledger.start(raster.stem)
+            task = (
+                raster,
+                *sources,
+                self.stats,
+                out_parquet,
+                self.memory_budget,
+                manifest.get(raster.stem) if out_parquet.exists() else None,
+                self.lazy_chunk_size)
+            yield task if threads else (*task, self.building_id_field)
+
+
+    def get_plan(
+        self,
+        buildings: bz.BuildingTable,
+        ledger: bz.JobLedger) -> bz.TilePlan:
+        """Estimates each tile's cost and orders the rasters longest first for n_workers
+
+        Timings come from earlier runs in raster_dir/tmp/metrics.jsonl. Tiles
+        the ledger has done with a saved parquet are expected to be skipped.
 
-    def get_geoms(self) -> gpd.GeoDataFrame:
-        """Opens/converts buildings to geodataframe
-        
         Args:
-        self: class
+        buildings: Buildings table
+        ledger: Tile job states
 
         Returns:
-        gdf: GeoDataFrame of buildings
+        plan: TilePlan with predicted wall time and peak memory
         """
-        if not Path(self.building_gpkg).resolve().exists():
-            gdf = bz.convert_shp_to_gpkg(
-                    self.building_shp,
-                    self.building_gpkg, 
-                    self.building_layer)
-        else:
-            gdf = gpd.read_file(self.building_gpkg, layer=self.building_layer)
-        return gdf
+        tmp_folder = self.get_tmp_folder()
+        rasters = self.get_rasters()
+        cached = [
+            x.stem for x in rasters
+            if ledger.is_done(x.stem) and tmp_folder.joinpath(f'{x.stem}.parquet').exists()]
+        model = self.cost_model or bz.CostModel()
+        if self.engine == 'threads': # threads share the parent's memory
+            model = replace(model, worker_mb=0.0)
+        else: # each process holds its own copy of the building table
+            model = replace(model, worker_mb=model.worker_mb + buildings.nbytes / 1024 ** 2)
+        costs = bz.estimate_tile_costs(
+            rasters,
+            buildings,
+            bz.load_tile_timings(tmp_folder.joinpath(bz.METRICS_FILE)),
+            self.memory_budget,
+            cached,
+            model)
+        base_memory_mb = bz.peak_memory_mb() or buildings.nbytes / 1024 ** 2
+        return bz.plan_tiles(costs, self.n_workers, base_memory_mb, model)
+
+
+@dataclass
+class BuildingHeightsMosaic(_RasterDirDriver):
+    """Processes zonal stats treating raster_dir as one mosaic split into work units"""
+    building_shp: Union[str, Path]
+    building_gpkg: Union[str, Path]
+    building_layer: str
+    building_id_field: str
+    building_crs: int
+    raster_dir : Union[str, Path]
+    stats: List[str]
+    output_gpkg: Optional[Union[str, Path, None]] = None
+    output_layer: Optional[Union[str, None]] = None
+    save_output_gpkg: Optional[bool] = True
+    n_workers: Optional[int] = 1
+    memory_budget: Optional[int] = 1 << 30
+    max_buildings: Optional[int] = 50000
+    instrument: Optional[bool] = True
+    raster_cache: Optional[Union[str, Path, None]] = None
+
+    def __post_init__(self):
+        self.check_output()
+        with self.open_run():
+            metrics = self.get_metrics()
+            with metrics.stage('load_buildings') as record:
+                buildings = self.get_geoms()
+                record.buildings = len(buildings)
+            logger.info(f'Loaded {len(buildings)} buildings ({buildings.nbytes / 1e6:.0f} MB)')
+            with metrics.stage('plan_units'):
+                self.raster_index = bz.build_raster_index(self.raster_dir)
+                units = bz.plan_work_units(
+                    self.raster_index,
+                    buildings,
+                    self.memory_budget // bz.BYTES_PER_PIXEL,
+                    self.max_buildings)
+            metrics.total_tiles = len(units)
+            unit_folder = self.get_unit_folder()
+            tasks = bz.iter_unit_tasks(
+                self.raster_index,
+                units,
+                self.building_gpkg,
+                self.building_layer,
+                unit_folder)
+            with ProcessPoolExecutor(max_workers=self.n_workers) if self.n_workers > 1 else nullcontext() as exec:
+                if exec is None:
+                    results = (bz.process_unit(*task) for task in tasks)
+                else:
+                    results = bz.run_tasks(exec, bz.process_unit, tasks, 2 * self.n_workers)
+                for out_parquet, records in results:
+                    metrics.add(records)
+                    metrics.tile_done(out_parquet.stem, records[0].buildings)
+            self.finish(buildings, metrics)
+
+
+    def make_zonals_table(self) -> pd.DataFrame:
+        """Append unit parquets into one"""
+        return bz.merge_zonals(self.raster_dir.joinpath('tmp', 'units').glob('unit_*.parquet'))
+
+
+    def sample_missing(
+        self,
+        buildings: bz.BuildingTable,
+        zonals_df: pd.DataFrame) -> Tuple[pd.DataFrame, gpd.GeoDataFrame]:
+        """Samples buildings covered by the mosaic but missing in zonals_df at their centroid"""
+        return bz.sample_missing_buildings_from_index(
+            buildings.take(buildings.missing(zonals_df, by_tile=False)),
+            zonals_df,
+            self.raster_index
+        )
+
+
+    def get_unit_folder(self) -> Path:
+        """Returns empty raster_dir/tmp/units folder (units depend on the plan so are not reused)"""
+        unit_folder = self.raster_dir.joinpath('tmp', 'units')
+        if not unit_folder.exists():
+            unit_folder.mkdir(parents=True)
+        for old_unit in unit_folder.glob('unit_*.parquet'):
+            old_unit.unlink()
+        return unit_folder
+
 
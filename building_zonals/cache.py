@@ -0,0 +1,154 @@
+"""Fingerprints of tile inputs so only changed tiles are recomputed"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+import time
+from typing import List, Optional, Union
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from .ledger import atomic_path
+
+MANIFEST = 'manifest.json'
+SAVE_EVERY = 64
+SAVE_INTERVAL = 30.0
+
+def fingerprint_file(
+    path: Union[Path, str],
+    chunk_size: int = 1 << 24) -> str:
+    """Returns blake2b hex digest of file contents
+
+    Args:
+    path: File path
+    chunk_size: Bytes read at a time
+
+    Returns:
+    digest: Hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint_buildings(
+    gdf: gpd.GeoDataFrame,
+    id_field: str = 'osm_id') -> str:
+    """Returns blake2b hex digest of building ids and geometries (independent of row order)
+
+    Args:
+    gdf: Buildings geodataframe
+    id_field: Building id column
+
+    Returns:
+    digest: Hex digest
+    """
+    ids = np.asarray(gdf[id_field].values, dtype=np.int64)
+    order = np.argsort(ids, kind='stable')
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(ids[order].tobytes())
+    for wkb in shapely.to_wkb(gdf.geometry.values[order]):
+        digest.update(wkb)
+    return digest.hexdigest()
+
+
+def tile_fingerprint(
+    raster: Union[Path, str],
+    gdf: gpd.GeoDataFrame,
+    stats: List[str],
+    previous: Optional[dict] = None) -> dict:
+    """Returns fingerprint of the inputs of a tile
+
+    The raster is only re-hashed when its size or modification time differs from previous.
+
+    Args:
+    raster: Path to raster
+    gdf: Buildings rasterised for the tile
+    stats: stats calculated
+    previous: Fingerprint recorded for the tile in an earlier run
+
+    Returns:
+    fingerprint: dict of raster and building digests
+    """
+    stat = os.stat(raster)
+    fingerprint = {
+        'raster_size': stat.st_size,
+        'raster_mtime': stat.st_mtime_ns,
+        'raster': None,
+        'buildings': fingerprint_buildings(gdf),
+        'stats': sorted(stats),
+    }
+    if previous and all(previous.get(x) == fingerprint[x] for x in ['raster_size', 'raster_mtime']):
+        fingerprint['raster'] = previous['raster']
+    else:
+        fingerprint['raster'] = fingerprint_file(raster)
+    return fingerprint
+
+
+def is_same_tile(fingerprint: dict, previous: Optional[dict]) -> bool:
+    """Returns True if fingerprint has the same raster contents, buildings and stats as previous"""
+    if not previous:
+        return False
+    return all(previous.get(x) == fingerprint[x] for x in ['raster', 'buildings', 'stats'])
+
+
+class TileManifest:
+    """Json record of the fingerprint each saved tile output was computed from
+
+    A tile is only entered once its output has been saved, so outputs left by a
+    crashed run are never treated as finished. Records are saved in batches,
+    call save once the run ends. Tiles recorded after the last save of a
+    crashed run are recomputed, never skipped.
+
+    Args:
+    path: Json path
+    save_every: Tiles recorded between saves
+    save_interval: Seconds between saves
+    """
+
+    def __init__(
+        self,
+        path: Union[Path, str],
+        save_every: int = SAVE_EVERY,
+        save_interval: float = SAVE_INTERVAL):
+        self.path = Path(path)
+        self.save_every = save_every
+        self.save_interval = save_interval
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+        self.tiles = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.tiles = json.load(f)
+
+    def get(self, tile: str) -> Optional[dict]:
+        """Returns recorded fingerprint of tile"""
+        return self.tiles.get(tile)
+
+    def is_current(
+        self,
+        tile: str,
+        fingerprint: dict,
+        output: Union[Path, str]) -> bool:
+        """Returns True if output exists and was computed from the same inputs"""
+        return Path(output).exists() and is_same_tile(fingerprint, self.get(tile))
+
+    def record(self, tile: str, fingerprint: dict):
+        """Records fingerprint of a saved tile output, saving manifest every save_every tiles or save_interval seconds"""
+        self.tiles[tile] = fingerprint
+        self.unsaved += 1
+        if self.unsaved >= self.save_every or time.monotonic() - self.saved_at >= self.save_interval:
+            self.save()
+
+    def save(self):
+        """Writes manifest to a temporary file and renames it into place"""
+        with atomic_path(self.path) as tmp:
+            with open(tmp, 'w') as f:
+                json.dump(self.tiles, f, indent=1)
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
@@ -0,0 +1,165 @@
+"""Functions to run tiles in worker pools"""
+
+from concurrent.futures import Executor, FIRST_COMPLETED, as_completed, wait
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, Union
+
+from .grid import raster_tile_name
+from .raster_pool import raster_info
+from .instrument import Metrics, StageRecord
+from .lazy import get_tile_building_height_partials_lazy
+from .pipeline import load_tile
+from .store import write_zonals
+from .table import BuildingTable
+from .windowed import get_tile_building_height_partials
+
+_worker_table: Optional[Tuple[tuple, BuildingTable]] = None
+
+def get_worker_building_table(
+    building_gpkg: Union[Path, str],
+    building_layer: str,
+    building_id_field: str = 'osm_id') -> Tuple[BuildingTable, bool]:
+    """Returns the building table of this worker process, reading it when first used or after the layer changed
+
+    Args:
+    building_gpkg: Geopackage of buildings
+    building_layer: Layer in geopackage
+    building_id_field: Building id column
+
+    Returns:
+    buildings: Buildings table
+    read: Whether the table was read by this call
+    """
+    global _worker_table
+    stat = Path(building_gpkg).stat()
+    key = (str(Path(building_gpkg).resolve()), building_layer, building_id_field, stat.st_size, stat.st_mtime_ns)
+    if _worker_table is not None and _worker_table[0] == key:
+        return _worker_table[1], False
+    _worker_table = None # release the old table before reading the new one
+    _worker_table = key, BuildingTable.read(building_gpkg, building_layer, building_id_field)
+    return _worker_table[1], True
+
+
+def process_tile(
+    raster: Union[Path, str],
+    building_gpkg: Union[Path, str],
+    building_layer: str,
+    stats: List[str],
+    out_parquet: Union[Path, str],
+    memory_budget: Optional[int] = None,
+    previous: Optional[dict] = None,
+    lazy_chunk_size: Optional[int] = None,
+    building_id_field: str = 'osm_id') -> Tuple[Path, dict, List[StageRecord]]:
+    """Loads the buildings inside raster, calculates partial zonal stats and saves parquet
+
+    Only paths are passed in so the task is cheap to send to a worker process.
+    Each worker reads the building table once and selects a tile's buildings
+    like process_tile_shared, so both engines fingerprint and compute the same
+    buildings. The tile is skipped when its inputs match the previous
+    fingerprint. Stage costs are measured in the worker and returned to be
+    added to the parent's Metrics.
+
+    Args:
+    raster: Path to raster
+    building_gpkg: Geopackage of buildings
+    building_layer: Layer in geopackage
+    stats: stats to calculate (options ['mean', 'min', 'max', 'med'])
+    out_parquet: Path of parquet to save
+    memory_budget: Bytes allowed for the working set of one window (None reads the whole raster)
+    previous: Fingerprint recorded for the saved output (None if there is no output)
+    lazy_chunk_size: Use the lazy dask engine with chunks of this size (synchronous in the worker)
+    building_id_field: Building id column
+
+    Returns:
+    out_parquet: Path of saved parquet
+    fingerprint: Fingerprint of the tile inputs
+    records: Stage records of the tile
+    """
+    metrics = Metrics()
+    with metrics.stage('load_buildings', Path(raster).stem) as record:
+        buildings, read = get_worker_building_table(building_gpkg, building_layer, building_id_field)
+        record.buildings = len(buildings)
+    out_parquet, fingerprint, records = process_tile_shared(
+        raster, buildings, stats, out_parquet, memory_budget, previous, lazy_chunk_size)
+    return out_parquet, fingerprint, (metrics.records if read else []) + records
+
+
+def process_tile_shared(
+    raster: Union[Path, str],
+    buildings: BuildingTable,
+    stats: List[str],
+    out_parquet: Union[Path, str],
+    memory_budget: Optional[int] = None,
+    previous: Optional[dict] = None,
+    lazy_chunk_size: Optional[int] = None) -> Tuple[Path, dict, List[StageRecord]]:
+    """Same as process_tile but takes buildings from a table shared by the threads of a pool
+
+    Nothing is pickled or re-read: threads take their tile's rows from the
+    building table in memory and reuse the process raster pool. The heavy
+    steps (GDAL reads, rasterising, shapely decoding and numpy reductions)
+    release the GIL, so tiles run in parallel.
+
+    Args:
+    raster: Path to raster
+    buildings: Buildings table shared by all threads
+    stats: stats to calculate (options ['mean', 'min', 'max', 'med'])
+    out_parquet: Path of parquet to save
+    memory_budget: Bytes allowed for the working set of one window (None reads the whole raster)
+    previous: Fingerprint recorded for the saved output (None if there is no output)
+    lazy_chunk_size: Use the lazy dask engine with chunks of this size (synchronous in the thread)
+
+    Returns:
+    out_parquet: Path of saved parquet
+    fingerprint: Fingerprint of the tile inputs
+    records: Stage records of the tile
+    """
+    raster = Path(raster)
+    tile = load_tile(
+        raster, buildings, stats, out_parquet, previous, read_raster=not (memory_budget or lazy_chunk_size))
+    metrics = Metrics()
+    metrics.records = tile.records
+    if tile.current:
+        return Path(out_parquet), tile.fingerprint, metrics.records
+    info = raster_info(raster)
+    with metrics.stage(
+            'zonal_stats', raster.stem, buildings=len(tile.gdf), pixels=info.width * info.height,
+            bytes_read=raster.stat().st_size):
+        if lazy_chunk_size:
+            df = get_tile_building_height_partials_lazy(raster, tile.gdf, lazy_chunk_size, 'synchronous')
+        else:
+            df = get_tile_building_height_partials(raster, tile.gdf, memory_budget, tile.heights)
+        df['tile_name'] = raster_tile_name(raster)
+    with metrics.stage('write_partials', raster.stem) as record:
+        out_parquet = write_zonals(df, out_parquet)
+        record.bytes_written = out_parquet.stat().st_size
+    return out_parquet, tile.fingerprint, metrics.records
+
+
+def run_tasks(
+    executor: Executor,
+    fn: Callable,
+    tasks: Iterable[Tuple],
+    max_in_flight: int) -> Iterator:
+    """Submits fn(*task) for each task keeping at most max_in_flight running
+
+    Results are yielded as tasks complete and any exception raised in a worker
+    is re-raised here.
+
+    Args:
+    executor: Pool to submit to
+    fn: Picklable function to run
+    tasks: Argument tuples for fn
+    max_in_flight: Maximum number of submitted but unfinished tasks
+
+    Yields:
+    result: Return value of fn for each task
+    """
+    in_flight = set()
+    for task in tasks:
+        if len(in_flight) >= max_in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+        in_flight.add(executor.submit(fn, *task))
+    for future in as_completed(in_flight):
+        yield future.result()
@@ -0,0 +1,136 @@
+"""British National Grid 10km tile references computed from coordinates"""
+
+from pathlib import Path
+import re
+from typing import Iterable, Tuple, Union
+
+import numpy as np
+
+CELL_SIZE = 10000
+SQUARE_SIZE = 100000
+MAX_EASTING = 700000
+MAX_NORTHING = 1300000
+RASTER_TEMPLATE = 'DSM_DTM_{}_m100_10K_Tile.tif'
+TILE_PATTERN = re.compile(r'^([A-HJ-Z]{2})(\d)(\d)$')
+
+def _square_letters() -> np.ndarray:
+    """Returns (northing // 100km, easting // 100km) array of 100km square letters"""
+    letters = 'ABCDEFGHJKLMNOPQRSTUVWXYZ' # 5 x 5 grid without I
+    squares = np.empty((MAX_NORTHING // SQUARE_SIZE, MAX_EASTING // SQUARE_SIZE), dtype=object)
+    for row in range(squares.shape[0]):
+        for col in range(squares.shape[1]):
+            first = 17 - 5 * (row // 5) + col // 5 # S, T, N, O, H... 500km squares
+            second = 20 - 5 * (row % 5) + col % 5
+            squares[row, col] = letters[first] + letters[second]
+    return squares
+
+SQUARES = _square_letters()
+SQUARE_INDEX = {x: (row, col) for (row, col), x in np.ndenumerate(SQUARES)}
+
+def tile_indices(
+    x: np.ndarray,
+    y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns integer 10km column (easting // 10km) and row (northing // 10km) of coordinates"""
+    cols = np.floor(np.asarray(x, dtype=np.float64) / CELL_SIZE).astype(np.int64)
+    rows = np.floor(np.asarray(y, dtype=np.float64) / CELL_SIZE).astype(np.int64)
+    return cols, rows
+
+
+def index_tile_names(
+    cols: np.ndarray,
+    rows: np.ndarray) -> np.ndarray:
+    """Returns tile names of 10km columns and rows (None outside the grid)"""
+    cols = np.asarray(cols, dtype=np.int64)
+    rows = np.asarray(rows, dtype=np.int64)
+    names = np.full(cols.shape, None, dtype=object)
+    inside = (
+        (cols >= 0) & (cols < MAX_EASTING // CELL_SIZE)
+        & (rows >= 0) & (rows < MAX_NORTHING // CELL_SIZE))
+    cols = cols[inside]
+    rows = rows[inside]
+    codes = (rows // 10 * SQUARES.shape[1] + cols // 10) * 100 + cols % 10 * 10 + rows % 10
+    unique, inverse = np.unique(codes, return_inverse=True) # format each distinct tile once
+    labels = np.array([
+        f'{SQUARES.flat[x // 100]}{x % 100:02d}' for x in unique], dtype=object)
+    names[inside] = labels[inverse]
+    return names
+
+
+def tile_names(
+    x: np.ndarray,
+    y: np.ndarray) -> np.ndarray:
+    """Returns BNG 10km tile names (e.g. TQ38) of BNG coordinates
+
+    Args:
+    x: Eastings
+    y: Northings
+
+    Returns:
+    names: Object array of tile names (None outside the grid)
+    """
+    return index_tile_names(*tile_indices(x, y))
+
+
+def tile_bounds(names: Iterable[str]) -> np.ndarray:
+    """Returns (n, 4) array of minx, miny, maxx, maxy of BNG 10km tile names
+
+    Args:
+    names: Tile names (e.g. TQ38)
+
+    Returns:
+    bounds: float64 bounds of each tile
+
+    Raises:
+    ValueError: If a name is not a BNG 10km tile reference
+    """
+    names = list(names)
+    bounds = np.empty((len(names), 4))
+    for i, name in enumerate(names):
+        match = TILE_PATTERN.match(name)
+        if match is None or match.group(1) not in SQUARE_INDEX:
+            raise ValueError(f'{name} is not a BNG 10km tile name')
+        row, col = SQUARE_INDEX[match.group(1)]
+        left = col * SQUARE_SIZE + int(match.group(2)) * CELL_SIZE
+        bottom = row * SQUARE_SIZE + int(match.group(3)) * CELL_SIZE
+        bounds[i] = left, bottom, left + CELL_SIZE, bottom + CELL_SIZE
+    return bounds
+
+
+def bounds_tile_pairs(bounds: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns (row, tile name) pairs of every tile each bounding box reaches
+
+    Boxes touching a tile edge count as reaching the tile, like bbox reads.
+
+    Args:
+    bounds: (n, 4) array of minx, miny, maxx, maxy
+
+    Returns:
+    rows: Positions in bounds, ascending
+    names: Tile name of each pair (pairs outside the grid are dropped)
+    """
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    col_0 = np.ceil(bounds[:, 0] / CELL_SIZE).astype(np.int64) - 1 # min edges on a tile edge reach the tile before
+    row_0 = np.ceil(bounds[:, 1] / CELL_SIZE).astype(np.int64) - 1
+    col_1, row_1 = tile_indices(bounds[:, 2], bounds[:, 3])
+    n_cols = col_1 - col_0 + 1
+    n_rows = row_1 - row_0 + 1
+    counts = n_cols * n_rows
+    rows = np.repeat(np.arange(len(bounds)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cols = col_0[rows] + k % n_cols[rows]
+    grid_rows = row_0[rows] + k // n_cols[rows]
+    names = index_tile_names(cols, grid_rows)
+    inside = names != None
+    return rows[inside], names[inside]
+
+
+def raster_path(
+    raster_dir: Union[Path, str],
+    tile_name: str) -> Path:
+    """Returns path of the DSM/DTM raster of tile_name in raster_dir"""
+    return Path(raster_dir).joinpath(RASTER_TEMPLATE.format(tile_name))
+
+
+def raster_tile_name(raster: Union[Path, str]) -> str:
+    """Returns tile name of a DSM/DTM raster path (e.g. TQ38 of DSM_DTM_TQ38_m100_10K_Tile.tif)"""
+    return Path(raster).name.split('_')[2]
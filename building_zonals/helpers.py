@@ -2,20 +2,27 @@
 
 from pathlib import Path 
 import geopandas as gpd 
+import pyogrio
 from shapely.geometry import box
 from typing import Union
-import shutil
+
+from .grid import raster_path, tile_bounds
+from .partition import link_raster
 
 BASE = Path(__file__).resolve().parent
 GRID = BASE.joinpath('OS_BNG_10km.gpkg')
 
 def iterate_grid_cells() -> list:
-    """Returns bounding box of cell as list"""
-    gdf = gpd.read_file(GRID, layer='OS_10km_tiles_buildings')
+    """Returns bounding box of cell as list
+
+    Only the tile names of cells with buildings are read from GRID, the bounds
+    are computed from the names.
+    """
+    df = pyogrio.read_dataframe(GRID, layer='OS_10km_tiles_buildings', columns=['tile_name'], read_geometry=False)
     #######TESTING ONLY######
     # gdf = gdf[gdf.tile_name.isin(['TL23', 'TL24', 'TL25', 'TL26', 'TL33', 'TL34', 'TL35', 'TL36', 'TL43', 'TL44', 'TL45', 'TL46', 'TL53', 'TL54', 'TL55', 'TL56', 'TL63', 'TL64', 'TL65', 'TL66'])]
-    for row in gdf.itertuples():
-        yield list(row.geometry.bounds), row.tile_name
+    for bounds, tile_name in zip(tile_bounds(df.tile_name), df.tile_name):
+        yield bounds.tolist(), tile_name
 
 def extract_from_buildings(
     gpkg: Union[Path, str],
@@ -33,12 +40,9 @@ def save_gpkg_to_folder(
     raster_dir: Union[Path, str],
     tile_name: str
     ):
-    """Saves gdf to folder named tile name in out_parent and moves corresponding raster to same dir"""
+    """Saves gdf to folder named tile name in out_parent and links corresponding raster into same dir"""
     out_dir = Path(out_parent).joinpath(tile_name)
     if not out_dir.exists():
         out_dir.mkdir(parents=True)
     gdf.to_file(out_dir.joinpath(f'{tile_name}.gpkg'), layer='buildings_uk', index=False)
-    raster = raster_dir.joinpath(f'DSM_DTM_{tile_name}_m100_10K_Tile.tif')
-    if not out_dir.joinpath(raster.name).exists():
-        if raster.exists():
-            shutil.move(raster, out_dir)
+    link_raster(raster_path(raster_dir, tile_name), out_dir)
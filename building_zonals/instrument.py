@@ -0,0 +1,184 @@
+"""Per tile and per stage run metrics written as JSON lines"""
+
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+from pathlib import Path
+import sys
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+from .raster_pool import raster_info
+
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+METRICS_FILE = 'metrics.jsonl'
+
+def peak_memory_mb() -> Optional[float]:
+    """Returns peak resident memory of this process in MB (None where unsupported)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+@dataclass
+class StageRecord:
+    """Cost of one stage, optionally for one tile"""
+    stage: str
+    tile: Optional[str] = None
+    wall_s: float = 0.0
+    cpu_s: float = 0.0
+    peak_memory_mb: Optional[float] = None
+    buildings: int = 0
+    pixels: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    pid: int = field(default_factory=os.getpid)
+
+
+class Metrics:
+    """Records stage costs, appends them to a JSON lines file and reports progress
+
+    Records are plain dataclasses so worker processes can measure their own
+    stages with a Metrics without a path and return metrics.records to be
+    added to the parent's Metrics.
+
+    Args:
+    path: JSON lines file records are appended to (not saved if None)
+    total_tiles: Number of tiles in the run, used for the ETA
+    """
+
+    def __init__(
+        self,
+        path: Union[Path, str, None] = None,
+        total_tiles: Optional[int] = None):
+        self.path = Path(path) if path else None
+        self.total_tiles = total_tiles
+        self.run_id = datetime.now().isoformat(timespec='seconds')
+        self.records: List[StageRecord] = []
+        self.tiles_done = 0
+        self.buildings_done = 0
+        self.buildings: Optional[int] = None # distinct buildings of the run, once known
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(
+        self,
+        stage: str,
+        tile: Optional[str] = None,
+        **counts) -> Iterator[StageRecord]:
+        """Measures wall time, CPU time and peak memory of the with block
+
+        The yielded record can be updated inside the block with counts
+        (buildings, pixels, bytes_read, bytes_written) known only once the
+        work is done. The record is only kept if the block succeeds.
+
+        Args:
+        stage: Name of the stage
+        tile: Name of the tile (None for whole run stages)
+        counts: Initial StageRecord counts
+
+        Yields:
+        record: StageRecord of the stage
+        """
+        record = StageRecord(stage, tile, **counts)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        yield record
+        record.wall_s = time.perf_counter() - wall
+        record.cpu_s = time.process_time() - cpu
+        record.peak_memory_mb = peak_memory_mb()
+        self.add([record])
+
+    def add(self, records: Iterable[StageRecord]) -> None:
+        """Keeps records (e.g. returned by a worker) and appends them to path"""
+        records = list(records)
+        self.records.extend(records)
+        if self.path and records:
+            with open(self.path, 'a') as f:
+                for record in records:
+                    f.write(json.dumps({'run': self.run_id, **asdict(record)}) + '\n')
+
+    def tile_done(self, tile: str, buildings: int) -> None:
+        """Counts a finished tile and logs throughput and ETA"""
+        self.tiles_done += 1
+        self.buildings_done += buildings
+        elapsed = time.perf_counter() - self.start
+        message = f'{tile} done ({self.tiles_done}'
+        if self.total_tiles:
+            message += f'/{self.total_tiles}'
+        message += f' tiles, {self.buildings_done / elapsed:.0f} buildings/s'
+        eta = self.eta()
+        if eta is not None:
+            message += f', ETA {eta}'
+        logger.info(message + ')')
+
+    def eta(self) -> Optional[timedelta]:
+        """Returns remaining time assuming the remaining tiles run at the mean tile rate"""
+        if not self.total_tiles or not self.tiles_done:
+            return None
+        elapsed = time.perf_counter() - self.start
+        remaining = max(self.total_tiles - self.tiles_done, 0)
+        return timedelta(seconds=round(elapsed / self.tiles_done * remaining))
+
+    def summary(self, n_slowest: int = 5) -> Dict[str, object]:
+        """Returns totals of the run
+
+        Args:
+        n_slowest: Number of slowest tiles to list
+
+        Returns:
+        summary: Elapsed time, throughput, per stage totals and slowest tiles
+        """
+        elapsed = time.perf_counter() - self.start
+        stages = {}
+        tiles = {}
+        for record in self.records:
+            totals = stages.setdefault(record.stage, {'wall_s': 0.0, 'cpu_s': 0.0, 'count': 0})
+            totals['wall_s'] += record.wall_s
+            totals['cpu_s'] += record.cpu_s
+            totals['count'] += 1
+            if record.tile is not None:
+                tiles[record.tile] = tiles.get(record.tile, 0.0) + record.wall_s
+        peaks = [x.peak_memory_mb for x in self.records if x.peak_memory_mb is not None]
+        # buildings straddling tiles are counted once per tile until the distinct count is set
+        buildings = self.buildings if self.buildings is not None else self.buildings_done
+        return {
+            'elapsed_s': elapsed,
+            'tiles': self.tiles_done,
+            'buildings': buildings,
+            'buildings_per_s': buildings / elapsed if elapsed else 0.0,
+            'peak_memory_mb': max(peaks) if peaks else None,
+            'stages': stages,
+            'slowest_tiles': sorted(tiles.items(), key=lambda x: -x[1])[:n_slowest],
+        }
+
+    def log_summary(self) -> Dict[str, object]:
+        """Logs and returns the run summary"""
+        summary = self.summary()
+        peak = summary['peak_memory_mb']
+        logger.info(
+            f'Run took {timedelta(seconds=round(summary["elapsed_s"]))} for {summary["tiles"]} tiles '
+            f'and {summary["buildings"]} buildings ({summary["buildings_per_s"]:.0f} buildings/s'
+            + (f', peak memory {peak:.0f} MB)' if peak is not None else ')'))
+        for stage, totals in summary['stages'].items():
+            logger.info(f'  {stage}: {totals["wall_s"]:.1f}s wall, {totals["cpu_s"]:.1f}s CPU over {totals["count"]} calls')
+        for tile, wall_s in summary['slowest_tiles']:
+            logger.info(f'  slow tile {tile}: {wall_s:.1f}s')
+        return summary
+
+
+def raster_pixels(raster: Union[Path, str]) -> int:
+    """Returns number of pixels in a band of raster"""
+    info = raster_info(raster)
+    return info.width * info.height
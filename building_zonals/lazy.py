@@ -0,0 +1,130 @@
+"""Out of core zonal statistics over chunked rasters evaluated as a dask graph"""
+
+from pathlib import Path
+from typing import List, Optional, Union
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.coords import BoundingBox
+import rioxarray
+from shapely.geometry import box
+
+from .tile_cache import get_raster_cache
+from .utils import codes_to_ids, rasterise_codes
+from .windowed import get_edge_ids
+from .zonal_stats import merge_partial_stats, partial_zonal_stats
+
+try:
+    import dask
+except ImportError: # optional dependency, only needed for the lazy engine
+    dask = None
+
+def _require_dask() -> None:
+    """Raises ImportError if dask is not installed"""
+    if dask is None:
+        raise ImportError('The lazy engine needs dask, install it with `pip install dask`')
+
+
+def _chunk_partials(
+    heights: np.ndarray,
+    transform: rasterio.Affine,
+    gdf: gpd.GeoDataFrame) -> pd.DataFrame:
+    """Rasterises the buildings of one chunk and returns their partial statistics
+
+    Args:
+    heights: 2d float array of the chunk (NaN for nodata)
+    transform: Affine transform of the chunk
+    gdf: Buildings intersecting the chunk
+
+    Returns:
+    df : DataFrame of partial statistics, with histograms for buildings reaching the chunk edge
+    """
+    heights = np.asarray(heights)
+    if heights.ndim == 3:
+        heights = heights[0]
+    rows, cols = heights.shape
+    bounds = BoundingBox(*rasterio.transform.array_bounds(rows, cols, transform))
+    codes = rasterise_codes(gdf, heights.shape, transform)
+    edge = np.isin(gdf.osm_id.values, get_edge_ids(gdf, bounds))
+    df = partial_zonal_stats(codes, heights, np.flatnonzero(edge) + 1, nodata_label=0)
+    return codes_to_ids(df, gdf.osm_id.values)
+
+
+def _merge(
+    partials: List[pd.DataFrame],
+    edge_ids: Optional[np.ndarray] = None) -> pd.DataFrame:
+    """Concatenates partials and merges rows of the same id"""
+    return merge_partial_stats(pd.concat(partials, ignore_index=True), edge_ids)
+
+
+def get_tile_building_height_partials_lazy(
+    raster: Union[Path, str],
+    gdf: gpd.GeoDataFrame,
+    chunk_size: int = 2048,
+    scheduler: str = 'threads',
+    split_every: int = 8) -> pd.DataFrame:
+    """Calculates mergeable partial statistics for a raster opened in chunks with dask
+
+    The raster is opened chunked so no more than a few chunks are in memory at
+    once. Each chunk task rasterises only the buildings intersecting it and
+    returns partial statistics, which are merged in a tree of split_every
+    partials per task. Buildings split across chunks get their median from
+    merged histograms (within HIST_BIN_WIDTH / 2 of the exact median).
+    Buildings reaching the raster edge keep a histogram so the result can be
+    merged with other tiles like get_tile_building_height_partials.
+
+    Args:
+    raster: Path to raster
+    gdf: gdf of buildings to rasterise
+    chunk_size: Rows and columns in each chunk (rounded to the raster blocks by rioxarray)
+    scheduler: dask scheduler ('threads', 'processes' or 'synchronous')
+    split_every: Number of partials merged by each reduction task
+
+    Returns:
+    df : DataFrame of partial statistics
+    """
+    _require_dask()
+    if gdf.empty:
+        return partial_zonal_stats(np.empty(0, dtype=np.int64), np.empty(0))
+    rx = rioxarray.open_rasterio(raster, mask_and_scale=True, chunks={'band': 1, 'y': chunk_size, 'x': chunk_size})
+    transform = rx.rio.transform()
+    edge_ids = get_edge_ids(gdf, BoundingBox(*rx.rio.bounds()))
+    row_offsets = np.concatenate(([0], np.cumsum(rx.chunks[1])))
+    col_offsets = np.concatenate(([0], np.cumsum(rx.chunks[2])))
+    cache = get_raster_cache()
+    cached = cache.heights(raster) if cache is not None else None
+    blocks = rx.data.to_delayed()[0]
+
+    chunks = []
+    for i in range(len(rx.chunks[1])):
+        for j in range(len(rx.chunks[2])):
+            chunk_transform = transform * rasterio.Affine.translation(col_offsets[j], row_offsets[i])
+            chunk_bounds = rasterio.transform.array_bounds(
+                row_offsets[i + 1] - row_offsets[i], col_offsets[j + 1] - col_offsets[j], chunk_transform)
+            if cached is not None: # chunk as a view of the cached band instead of a decode task
+                block = cached[row_offsets[i]:row_offsets[i + 1], col_offsets[j]:col_offsets[j + 1]]
+            else:
+                block = blocks[i, j]
+            chunks.append((block, chunk_transform, box(*chunk_bounds)))
+    chunk_idx, building_idx = gdf.sindex.query(np.array([x[2] for x in chunks]), predicate='intersects')
+    order = np.lexsort((building_idx, chunk_idx))
+    chunk_idx = chunk_idx[order]
+    building_idx = building_idx[order]
+    splits = np.searchsorted(chunk_idx, np.arange(len(chunks) + 1))
+
+    partials = []
+    for k, (block, chunk_transform, _) in enumerate(chunks):
+        if splits[k + 1] > splits[k]:
+            gdf_chunk = gdf.iloc[building_idx[splits[k]:splits[k + 1]]]
+            partials.append(dask.delayed(_chunk_partials)(block, chunk_transform, gdf_chunk))
+    if not partials:
+        return partial_zonal_stats(np.empty(0, dtype=np.int64), np.empty(0))
+    while len(partials) > 1:
+        partials = [
+            dask.delayed(_merge)(partials[i:i + split_every])
+            for i in range(0, len(partials), split_every)]
+    df = dask.delayed(_merge)(partials, edge_ids).compute(scheduler=scheduler)
+    df['osm_id'] = df['osm_id'].astype(np.int64)
+    return df
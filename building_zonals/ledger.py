@@ -0,0 +1,140 @@
+"""Crash safe record of tile jobs in SQLite and atomic file outputs"""
+
+from contextlib import contextmanager
+import os
+from pathlib import Path
+import sqlite3
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+LEDGER = 'jobs.sqlite'
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+@contextmanager
+def atomic_path(path: Union[Path, str]) -> Iterator[Path]:
+    """Yields a temporary path next to path that is renamed to path if the block succeeds
+
+    A killed process leaves at most a stray temporary file, never a partial
+    file at path. The temporary file keeps the suffix of path so writers that
+    pick a format from it still work.
+
+    Args:
+    path: Final path
+
+    Yields:
+    tmp: Path to write to
+    """
+    path = Path(path)
+    tmp = path.with_name(f'{path.stem}.tmp{os.getpid()}{path.suffix}')
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+class JobLedger:
+    """SQLite ledger of the state, attempts and timings of each tile job
+
+    Jobs go from pending to running to done or failed. Jobs left running by a
+    killed process are counted as unfinished, so a restart picks up exactly
+    the tiles that never finished. Every change is committed straight away.
+
+    Args:
+    path: SQLite database path
+    """
+
+    def __init__(self, path: Union[Path, str]):
+        self.path = Path(path)
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    name TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    started REAL,
+                    finished REAL,
+                    wall_s REAL,
+                    error TEXT)''')
+
+    def add(self, names: Iterable[str]) -> None:
+        """Adds jobs as pending (jobs already in the ledger are kept as they are)"""
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO jobs (name, state) VALUES (?, ?)', [(x, PENDING) for x in names])
+
+    def start(self, name: str) -> None:
+        """Marks job running and counts an attempt"""
+        with self.connection:
+            self.connection.execute('''
+                INSERT INTO jobs (name, state, attempts, started) VALUES (?, ?, 1, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    state = excluded.state, attempts = attempts + 1, started = excluded.started,
+                    finished = NULL, wall_s = NULL, error = NULL''', (name, RUNNING, time.time()))
+
+    def done(self, name: str) -> None:
+        """Marks job done once its outputs are saved"""
+        self._finish(name, DONE, None)
+
+    def fail(self, name: str, error: object) -> None:
+        """Marks job failed with the error"""
+        self._finish(name, FAILED, repr(error))
+
+    def fail_running(self, error: object) -> List[str]:
+        """Marks every running job failed (e.g. when a worker error cannot be traced to its job)"""
+        names = self.names(RUNNING)
+        for name in names:
+            self.fail(name, error)
+        return names
+
+    def _finish(
+        self,
+        name: str,
+        state: str,
+        error: Optional[str]) -> None:
+        now = time.time()
+        with self.connection:
+            self.connection.execute('''
+                UPDATE jobs SET state = ?, finished = ?, wall_s = ? - started, error = ? WHERE name = ?''',
+                (state, now, now, error, name))
+
+    def state(self, name: str) -> Optional[str]:
+        """Returns state of job (None if not in the ledger)"""
+        row = self.connection.execute('SELECT state FROM jobs WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def is_done(self, name: str) -> bool:
+        """Returns True if job finished and saved its outputs"""
+        return self.state(name) == DONE
+
+    def names(self, state: Optional[str] = None) -> List[str]:
+        """Returns names of jobs in state (all jobs if None)"""
+        if state is None:
+            return [x[0] for x in self.connection.execute('SELECT name FROM jobs ORDER BY name')]
+        return [x[0] for x in self.connection.execute('SELECT name FROM jobs WHERE state = ? ORDER BY name', (state,))]
+
+    def unfinished(self, max_attempts: Optional[int] = None) -> List[str]:
+        """Returns jobs not done, optionally leaving out failed jobs that used max_attempts"""
+        rows = self.connection.execute('SELECT name, state, attempts FROM jobs WHERE state != ? ORDER BY name', (DONE,))
+        return [
+            name for name, state, attempts in rows
+            if max_attempts is None or state != FAILED or attempts < max_attempts]
+
+    def counts(self) -> Dict[str, int]:
+        """Returns number of jobs in each state"""
+        return dict(self.connection.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> 'JobLedger':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
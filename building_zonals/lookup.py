@@ -0,0 +1,368 @@
+"""Memory mapped index of finished building heights for fast lookups by id, bbox and point"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import math
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+
+from .ledger import atomic_path
+from .table import BOUNDS_BATCH
+
+logger = logging.getLogger(__name__)
+
+LOOKUP_FILE = 'lookup.json'
+LOOKUP_CELL_SIZE = 100.0
+MAX_QUERY_CELLS = 1 << 14
+
+def _read_results(
+    path: Path,
+    layer: Optional[str]) -> Tuple[pa.Table, Optional[str], object]:
+    """Returns table, geometry column (None without geometry) and crs of a results file"""
+    suffix = path.suffix.lower()
+    if suffix == '.csv':
+        return pv.read_csv(path), None, None
+    if suffix == '.parquet':
+        table = pq.read_table(path)
+        geo = json.loads((table.schema.metadata or {}).get(b'geo', b'null'))
+        if not geo:
+            return table, None, None
+        geometry_name = geo['primary_column']
+        return table, geometry_name, geo['columns'][geometry_name].get('crs')
+    meta, table = pyogrio.read_arrow(path, layer=layer)
+    return table, meta['geometry_name'] or 'wkb_geometry', meta['crs']
+
+
+def _cell_pairs(
+    bounds: np.ndarray,
+    origin: Tuple[float, float],
+    cell_size: float,
+    n_rows: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns (position, cell key) pairs of every grid cell each bounding box reaches"""
+    col_0 = np.floor((bounds[:, 0] - origin[0]) / cell_size).astype(np.int64)
+    row_0 = np.floor((bounds[:, 1] - origin[1]) / cell_size).astype(np.int64)
+    col_1 = np.floor((bounds[:, 2] - origin[0]) / cell_size).astype(np.int64)
+    row_1 = np.floor((bounds[:, 3] - origin[1]) / cell_size).astype(np.int64)
+    n_cols = col_1 - col_0 + 1
+    counts = n_cols * (row_1 - row_0 + 1)
+    positions = np.repeat(np.arange(len(bounds)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cols = col_0[positions] + k % n_cols[positions]
+    rows = row_0[positions] + k // n_cols[positions]
+    return positions, cols * n_rows + rows
+
+
+def build_lookup_index(
+    results: Union[Path, str],
+    index_dir: Union[Path, str],
+    layer: Optional[str] = 'building_heights',
+    id_field: str = 'osm_id',
+    cell_size: float = LOOKUP_CELL_SIZE) -> Path:
+    """Writes a lookup index of a results file that BuildingLookup memory maps
+
+    The results are sorted by id and saved as an uncompressed Arrow file, so
+    ids and columns are read straight from the page cache. Footprints get a
+    bounds array and a grid index (rows of each cell of cell_size, in CSR
+    form) saved as .npy files. CSV and zonals parquet without geometry only
+    support lookups by id. lookup.json is written last, marking the index complete.
+
+    Args:
+    results: Building heights layer (.gpkg, .parquet, .fgb) or BUILDING_ZONALS.csv
+    index_dir: Folder to write the index to
+    layer: Layer of a geopackage
+    id_field: Name of the id column
+    cell_size: Grid cell size in CRS units
+
+    Returns:
+    index_dir: Path of the index
+    """
+    results = Path(results)
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    index_dir.joinpath(LOOKUP_FILE).unlink(missing_ok=True)
+    table, geometry_name, crs = _read_results(results, layer)
+    ids = table.column(id_field).to_numpy()
+    order = np.argsort(ids, kind='stable')
+    table = table.take(pa.array(order))
+    meta = {
+        'source': str(results),
+        'id_field': id_field,
+        'geometry_name': geometry_name,
+        'crs': crs if crs is None or isinstance(crs, (str, dict)) else str(crs),
+        'rows': len(table),
+    }
+    if geometry_name is not None:
+        wkb = table.column(geometry_name).cast(pa.large_binary())
+        table = table.set_column(table.column_names.index(geometry_name), geometry_name, wkb)
+        bounds = np.empty((len(table), 4))
+        for start in range(0, len(table), BOUNDS_BATCH):
+            batch = wkb.slice(start, BOUNDS_BATCH).to_numpy(zero_copy_only=False)
+            bounds[start:start + len(batch)] = shapely.bounds(shapely.from_wkb(batch))
+        valid = ~np.isnan(bounds).any(axis=1) # empty geometries have NaN bounds
+        if valid.any():
+            extent = [bounds[valid, 0].min(), bounds[valid, 1].min(), bounds[valid, 3].max()]
+        else:
+            extent = [0.0, 0.0, 0.0]
+        origin = tuple(float(np.floor(x / cell_size) * cell_size) for x in extent[:2])
+        n_rows = int((extent[2] - origin[1]) // cell_size) + 1
+        positions, keys = _cell_pairs(bounds[valid], origin, cell_size, n_rows)
+        positions = np.flatnonzero(valid)[positions]
+        pair_order = np.lexsort((positions, keys))
+        cell_keys, starts = np.unique(keys[pair_order], return_index=True)
+        np.save(index_dir.joinpath('bounds.npy'), bounds)
+        np.save(index_dir.joinpath('cell_keys.npy'), cell_keys)
+        np.save(index_dir.joinpath('cell_starts.npy'), np.r_[starts, len(keys)].astype(np.int64))
+        np.save(index_dir.joinpath('cell_rows.npy'), positions[pair_order].astype(np.int64))
+        meta.update({'cell_size': cell_size, 'origin': origin, 'n_rows': n_rows})
+    with pa.OSFile(str(index_dir.joinpath('buildings.arrow')), 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer: # one batch, so columns map as single arrays
+            writer.write_table(table.combine_chunks(), max_chunksize=max(len(table), 1))
+    with atomic_path(index_dir.joinpath(LOOKUP_FILE)) as tmp:
+        tmp.write_text(json.dumps(meta))
+    logger.info(f'Indexed {len(table)} buildings from {results} in {index_dir}')
+    return index_dir
+
+
+def _json_value(value: object) -> object:
+    """Returns value with NaN as None so records dump as strict JSON"""
+    return None if isinstance(value, float) and math.isnan(value) else value
+
+
+class BuildingLookup:
+    """Lookups of building heights by id, bounding box and point over a memory mapped index
+
+    Opening maps the files of build_lookup_index without reading them, so
+    lookups only touch the pages they need. Ids are found by binary search of
+    the sorted id column, footprints through the grid index then their
+    bounds, and points are tested against the candidate footprints. Records
+    are dicts of the columns other than geometry.
+
+    Args:
+    index_dir: Folder written by build_lookup_index
+    """
+
+    def __init__(self, index_dir: Union[Path, str]):
+        self.index_dir = Path(index_dir)
+        path = self.index_dir.joinpath(LOOKUP_FILE)
+        if not path.exists():
+            raise FileNotFoundError(f'No complete lookup index in {self.index_dir}')
+        self.meta = json.loads(path.read_text())
+        self.id_field = self.meta['id_field']
+        self.geometry_name = self.meta['geometry_name']
+        source = pa.memory_map(str(self.index_dir.joinpath('buildings.arrow')))
+        self.table = pa.ipc.open_file(source).read_all()
+        self.ids = self.table.column(self.id_field).chunk(0).to_numpy() if len(self.table) else np.empty(0, np.int64)
+        self.columns = [x for x in self.table.column_names if x != self.geometry_name]
+        self._records_table = self.table.select(self.columns)
+        if self.geometry_name is not None:
+            self.bounds = self._load('bounds')
+            self.cell_keys = self._load('cell_keys')
+            self.cell_starts = self._load('cell_starts')
+            self.cell_rows = self._load('cell_rows')
+            self.cell_size = self.meta['cell_size']
+            self.origin = self.meta['origin']
+            self.n_rows = self.meta['n_rows']
+
+    def _load(self, name: str) -> np.ndarray:
+        return np.load(self.index_dir.joinpath(f'{name}.npy'), mmap_mode='r')
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def spatial(self) -> bool:
+        """True if the index has footprints for bbox and point lookups"""
+        return self.geometry_name is not None
+
+    def records(self, rows: Sequence[int]) -> List[Dict[str, object]]:
+        """Returns records of row positions"""
+        rows = pa.array(np.asarray(rows, dtype=np.int64))
+        return [{k: _json_value(v) for k, v in x.items()} for x in self._records_table.take(rows).to_pylist()]
+
+    def rows_by_id(self, ids: Sequence[int]) -> np.ndarray:
+        """Returns row positions of ids (-1 where an id is not in the index)"""
+        ids = np.asarray(ids, dtype=self.ids.dtype)
+        rows = np.searchsorted(self.ids, ids)
+        found = rows < len(self.ids)
+        found[found] = self.ids[rows[found]] == ids[found]
+        return np.where(found, rows, -1)
+
+    def by_id(self, building_id: int) -> Optional[Dict[str, object]]:
+        """Returns record of building_id (None if not in the index)"""
+        row = self.rows_by_id([building_id])[0]
+        return self.records([row])[0] if row >= 0 else None
+
+    def by_ids(self, ids: Sequence[int]) -> List[Dict[str, object]]:
+        """Returns records of the ids in the index, in the order given"""
+        rows = self.rows_by_id(ids)
+        return self.records(rows[rows >= 0])
+
+    def _require_spatial(self) -> None:
+        if not self.spatial:
+            raise ValueError(f'{self.meta["source"]} has no geometry, only lookups by id are supported')
+
+    def _cell_candidates(self, bounds: Tuple[float, float, float, float]) -> Optional[np.ndarray]:
+        """Returns rows registered in the cells bounds reach (None if it reaches too many cells)"""
+        left, bottom, right, top = bounds
+        col_0, col_1 = [int(np.floor((x - self.origin[0]) / self.cell_size)) for x in (left, right)]
+        row_0, row_1 = [int(np.floor((x - self.origin[1]) / self.cell_size)) for x in (bottom, top)]
+        row_0 = max(row_0, 0)
+        row_1 = min(row_1, self.n_rows - 1)
+        if row_1 < row_0 or col_1 < 0:
+            return np.empty(0, dtype=np.int64)
+        col_0 = max(col_0, 0)
+        if (col_1 - col_0 + 1) * (row_1 - row_0 + 1) > MAX_QUERY_CELLS:
+            return None
+        cols, rows = np.meshgrid(np.arange(col_0, col_1 + 1), np.arange(row_0, row_1 + 1))
+        keys = (cols * self.n_rows + rows).ravel()
+        idx = np.searchsorted(self.cell_keys, keys)
+        hit = idx < len(self.cell_keys)
+        hit[hit] = self.cell_keys[idx[hit]] == keys[hit]
+        idx = idx[hit]
+        if not len(idx):
+            return np.empty(0, dtype=np.int64)
+        starts = self.cell_starts[idx]
+        stops = self.cell_starts[idx + 1]
+        return np.unique(np.concatenate([self.cell_rows[a:b] for a, b in zip(starts, stops)]))
+
+    def rows_in_bbox(self, bounds: Tuple[float, float, float, float]) -> np.ndarray:
+        """Returns sorted row positions of buildings whose bounds intersect bounds"""
+        self._require_spatial()
+        left, bottom, right, top = bounds
+        rows = self._cell_candidates(bounds)
+        candidates = self.bounds if rows is None else self.bounds[rows]
+        hit = (
+            (candidates[:, 2] >= left) & (candidates[:, 0] <= right)
+            & (candidates[:, 3] >= bottom) & (candidates[:, 1] <= top))
+        return np.flatnonzero(hit) if rows is None else rows[hit]
+
+    def in_bbox(
+        self,
+        bounds: Tuple[float, float, float, float],
+        limit: Optional[int] = None) -> List[Dict[str, object]]:
+        """Returns records of buildings whose bounds intersect bounds (at most limit)"""
+        return self.records(self.rows_in_bbox(bounds)[:limit])
+
+    def rows_at_point(
+        self,
+        x: float,
+        y: float) -> np.ndarray:
+        """Returns row positions of buildings whose footprint contains or touches x, y"""
+        rows = self.rows_in_bbox((x, y, x, y))
+        if not len(rows):
+            return rows
+        wkb = self.table.column(self.geometry_name).take(pa.array(rows)).to_numpy(zero_copy_only=False)
+        return rows[shapely.intersects_xy(shapely.from_wkb(wkb), x, y)]
+
+    def at_point(
+        self,
+        x: float,
+        y: float) -> List[Dict[str, object]]:
+        """Returns records of buildings whose footprint contains or touches x, y"""
+        return self.records(self.rows_at_point(x, y))
+
+
+class _LookupHandler(BaseHTTPRequestHandler):
+    """JSON endpoints over a BuildingLookup set on the server
+
+    GET /buildings/<id>, /buildings?ids=1,2, /buildings?bbox=minx,miny,maxx,maxy[&limit=n]
+    and /buildings?x=..&y=..
+    """
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        parts = [x for x in url.path.split('/') if x]
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        lookup = self.server.lookup
+        try:
+            if parts == ['health']:
+                return self._send(200, {'buildings': len(lookup)})
+            if not parts or parts[0] != 'buildings' or len(parts) > 2:
+                return self._send(404, {'error': 'not found'})
+            if len(parts) == 2:
+                record = lookup.by_id(int(parts[1]))
+                return self._send(200, record) if record else self._send(404, {'error': 'unknown id'})
+            if 'ids' in query:
+                return self._send(200, lookup.by_ids([int(x) for x in query['ids'].split(',') if x]))
+            if 'bbox' in query:
+                bounds = tuple(float(x) for x in query['bbox'].split(','))
+                if len(bounds) != 4:
+                    raise ValueError('bbox needs minx,miny,maxx,maxy')
+                limit = int(query['limit']) if 'limit' in query else None
+                return self._send(200, lookup.in_bbox(bounds, limit))
+            if 'x' in query and 'y' in query:
+                return self._send(200, lookup.at_point(float(query['x']), float(query['y'])))
+            return self._send(400, {'error': 'use /buildings/<id> or ids, bbox or x and y parameters'})
+        except (ValueError, OverflowError) as error: # OverflowError for ids outside int64
+            return self._send(400, {'error': str(error)})
+
+    def _send(
+        self,
+        status: int,
+        body: object) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(format % args)
+
+
+def make_lookup_server(
+    lookup: BuildingLookup,
+    host: str = '127.0.0.1',
+    port: int = 8000) -> ThreadingHTTPServer:
+    """Returns a threaded HTTP server answering lookups as JSON (call serve_forever to run)
+
+    Args:
+    lookup: Opened index
+    host: Address to bind (local only by default)
+    port: Port to bind (0 picks a free port)
+
+    Returns:
+    server: Server with the lookup attached
+    """
+    server = ThreadingHTTPServer((host, port), _LookupHandler)
+    server.lookup = lookup
+    return server
+
+
+def _main(argv: Optional[List[str]] = None) -> None:
+    """Command line: python -m building_zonals.lookup build|serve"""
+    parser = argparse.ArgumentParser(description='Build or serve a building heights lookup index')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='Index a results file')
+    build.add_argument('results', type=Path)
+    build.add_argument('index_dir', type=Path)
+    build.add_argument('--layer', default='building_heights')
+    build.add_argument('--id-field', default='osm_id')
+    build.add_argument('--cell-size', type=float, default=LOOKUP_CELL_SIZE)
+    serve = commands.add_parser('serve', help='Serve an index over HTTP')
+    serve.add_argument('index_dir', type=Path)
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'build':
+        build_lookup_index(args.results, args.index_dir, args.layer, args.id_field, args.cell_size)
+    else:
+        server = make_lookup_server(BuildingLookup(args.index_dir), args.host, args.port)
+        logger.info(f'Serving {args.index_dir} on http://{args.host}:{server.server_port}')
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    _main()
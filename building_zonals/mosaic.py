@@ -0,0 +1,266 @@
+"""Functions to treat a folder of rasters as one mosaic processed in work units"""
+
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Tuple, Union
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.merge
+from shapely.geometry import box
+
+from .instrument import Metrics, StageRecord
+from .raster_pool import open_raster, raster_info
+from .store import read_zonals, write_zonals
+from .table import BuildingTable
+from .tile_cache import RasterCache, get_raster_cache
+from .zonal_stats import STATS_COLUMNS, partial_zonal_stats
+from .utils import codes_to_ids, rasterise_codes, sample_raster_points
+
+Bounds = Tuple[float, float, float, float]
+
+class UnitTask(NamedTuple):
+    """Arguments of process_unit for one work unit"""
+    bounds: Bounds
+    rasters: List[str]
+    building_gpkg: Path
+    building_layer: str
+    out_parquet: Path
+
+
+def build_raster_index(raster_dir: Union[Path, str]) -> gpd.GeoDataFrame:
+    """Returns footprints of every tif in raster_dir
+
+    Args:
+    raster_dir: Folder in which rasters are held
+
+    Returns:
+    gdf: GeoDataFrame with path, res_x, res_y and footprint geometry of each raster
+    """
+    records = []
+    crs = None
+    for raster in sorted(Path(raster_dir).iterdir()):
+        if raster.name.endswith('.tif'):
+            info = raster_info(raster)
+            crs = crs or info.crs
+            records.append({
+                'path': str(raster),
+                'res_x': info.res[0],
+                'res_y': info.res[1],
+                'geometry': box(*info.bounds)})
+    return gpd.GeoDataFrame(records, geometry='geometry', crs=crs)
+
+
+def plan_work_units(
+    raster_index: gpd.GeoDataFrame,
+    buildings: BuildingTable,
+    max_pixels: int,
+    max_buildings: int) -> List[Bounds]:
+    """Splits the mosaic extent into quadtree units sized to memory and building density
+
+    A unit is split into quarters (snapped to the pixel grid) until it holds at
+    most max_pixels pixels and max_buildings buildings, so dense areas get small
+    units and sparse areas large ones. Units without rasters or buildings are dropped.
+
+    Args:
+    raster_index: Footprints from build_raster_index
+    buildings: Buildings table
+    max_pixels: Maximum pixels in a unit
+    max_buildings: Maximum buildings intersecting a unit
+
+    Returns:
+    units: Bounds of each work unit
+    """
+    res_x = raster_index.res_x.max()
+    res_y = raster_index.res_y.max()
+    left, bottom, right, top = raster_index.total_bounds
+    units = []
+    stack = [(left, bottom, right, top)]
+    while stack:
+        bounds = stack.pop()
+        polygon = box(*bounds)
+        if not len(raster_index.sindex.query(polygon, predicate='intersects')):
+            continue
+        n_buildings = len(buildings.query_bounds(bounds))
+        if not n_buildings:
+            continue
+        cols = round((bounds[2] - bounds[0]) / res_x)
+        rows = round((bounds[3] - bounds[1]) / res_y)
+        fits = cols * rows <= max_pixels and n_buildings <= max_buildings
+        if fits or (cols < 2 and rows < 2):
+            units.append(bounds)
+            continue
+        mid_x = bounds[0] + (cols // 2) * res_x if cols > 1 else bounds[2]
+        mid_y = bounds[3] - (rows // 2) * res_y if rows > 1 else bounds[1]
+        for quarter in [
+                (bounds[0], mid_y, mid_x, bounds[3]),
+                (mid_x, mid_y, bounds[2], bounds[3]),
+                (bounds[0], bounds[1], mid_x, mid_y),
+                (mid_x, bounds[1], bounds[2], mid_y)]:
+            if quarter[0] < quarter[2] and quarter[1] < quarter[3]:
+                stack.append(quarter)
+    return sorted(units, key=lambda x: (-x[3], x[0]))
+
+
+def read_mosaic_window(
+    rasters: List[Union[Path, str]],
+    bounds: Bounds) -> Tuple[np.ndarray, rasterio.Affine]:
+    """Reads bounds from the rasters as one float array, NaN where there is no data
+
+    Args:
+    rasters: Paths of rasters intersecting bounds
+    bounds: Bounds to read
+
+    Returns:
+    heights: 2d float32 array
+    transform: Affine transform of heights
+    """
+    cache = get_raster_cache()
+    if cache is not None:
+        return read_cached_mosaic_window(cache, rasters, bounds)
+    with ExitStack() as stack:
+        datasets = [stack.enter_context(open_raster(x)) for x in rasters]
+        heights, transform = rasterio.merge.merge(
+            datasets, bounds=bounds, indexes=[1], dtype='float32', nodata=np.nan)
+    return heights[0], transform
+
+
+def read_cached_mosaic_window(
+    cache: RasterCache,
+    rasters: List[Union[Path, str]],
+    bounds: Bounds) -> Tuple[np.ndarray, rasterio.Affine]:
+    """Same as read_mosaic_window but copies from cached bands instead of decoding
+
+    Rasters must share the pixel grid of the first one (as the mosaic work
+    units assume). Earlier rasters win where they overlap, like rasterio.merge.
+
+    Args:
+    cache: Raster cache
+    rasters: Paths of rasters intersecting bounds
+    bounds: Bounds to read
+
+    Returns:
+    heights: 2d float32 array
+    transform: Affine transform of heights
+    """
+    left, bottom, right, top = bounds
+    res_x, res_y = raster_info(rasters[0]).res
+    shape = (int(round((top - bottom) / res_y)), int(round((right - left) / res_x)))
+    heights = np.full(shape, np.nan, dtype=np.float32)
+    for raster in rasters:
+        info = raster_info(raster)
+        row_off = int(round((top - info.bounds.top) / res_y))
+        col_off = int(round((info.bounds.left - left) / res_x))
+        rows = slice(max(row_off, 0), min(row_off + info.height, shape[0]))
+        cols = slice(max(col_off, 0), min(col_off + info.width, shape[1]))
+        if rows.start >= rows.stop or cols.start >= cols.stop:
+            continue
+        band = cache.heights(raster)[rows.start - row_off:rows.stop - row_off, cols.start - col_off:cols.stop - col_off]
+        out = heights[rows, cols]
+        np.copyto(out, band, where=np.isnan(out))
+    return heights, rasterio.transform.from_origin(left, top, res_x, res_y)
+
+
+def process_unit(
+    bounds: Bounds,
+    rasters: List[Union[Path, str]],
+    building_gpkg: Union[Path, str],
+    building_layer: str,
+    out_parquet: Union[Path, str]) -> Tuple[Path, List[StageRecord]]:
+    """Reads a work unit from the mosaic, calculates partial zonal stats and saves parquet
+
+    The cost of the unit is measured where it runs (a worker process or the
+    parent) and returned to be added to the parent's Metrics.
+
+    Args:
+    bounds: Bounds of the work unit
+    rasters: Paths of rasters intersecting bounds
+    building_gpkg: Geopackage of buildings
+    building_layer: Layer in geopackage
+    out_parquet: Path of parquet to save
+
+    Returns:
+    out_parquet: Path of saved parquet
+    records: Stage record of the unit, with the number of buildings read
+    """
+    metrics = Metrics()
+    with metrics.stage('process_unit', Path(out_parquet).stem) as record:
+        gdf = gpd.read_file(building_gpkg, layer=building_layer, bbox=bounds, fid_as_index=True)
+        gdf = gdf.sort_index() # bbox reads come back in spatial index order
+        record.buildings = len(gdf)
+        heights, transform = read_mosaic_window(rasters, bounds)
+        record.pixels = heights.size
+        codes = rasterise_codes(gdf, heights.shape, transform)
+        building_bounds = gdf.geometry.bounds
+        edge = (
+            (building_bounds.minx.values <= bounds[0])
+            | (building_bounds.miny.values <= bounds[1])
+            | (building_bounds.maxx.values >= bounds[2])
+            | (building_bounds.maxy.values >= bounds[3]))
+        df = partial_zonal_stats(codes, heights, np.flatnonzero(edge) + 1, nodata_label=0)
+        out_parquet = write_zonals(codes_to_ids(df, gdf.osm_id.values), out_parquet)
+        record.bytes_written = out_parquet.stat().st_size
+    return out_parquet, metrics.records
+
+
+def iter_unit_tasks(
+    raster_index: gpd.GeoDataFrame,
+    units: List[Bounds],
+    building_gpkg: Union[Path, str],
+    building_layer: str,
+    out_dir: Union[Path, str]) -> Iterator[UnitTask]:
+    """Yields process_unit arguments for each work unit
+
+    Args:
+    raster_index: Footprints from build_raster_index
+    units: Bounds of each work unit
+    building_gpkg: Geopackage of buildings
+    building_layer: Layer in geopackage
+    out_dir: Folder for unit parquets
+
+    Yields:
+    task: UnitTask of process_unit arguments
+    """
+    for i, bounds in enumerate(units):
+        idx = raster_index.sindex.query(box(*bounds), predicate='intersects')
+        rasters = list(raster_index.path.values[np.sort(idx)])
+        yield UnitTask(bounds, rasters, Path(building_gpkg), building_layer, Path(out_dir).joinpath(f'unit_{i}.parquet'))
+
+
+def sample_missing_buildings_from_index(
+    gdf: gpd.GeoDataFrame,
+    zonals: Union[Path, str, pd.DataFrame],
+    raster_index: gpd.GeoDataFrame) -> Tuple[pd.DataFrame, gpd.GeoDataFrame]:
+    """Samples buildings covered by the mosaic but missing in zonals at their centroid
+
+    Args:
+    gdf: Buildings geodataframe
+    zonals: Zonals DataFrame or path to parquet/csv
+    raster_index: Footprints from build_raster_index
+
+    Returns:
+    df: DataFrame of missing building heights
+    gdf_overlapping: Gdf of buildings presumed to be overlapping
+    """
+    df = read_zonals(zonals, columns=['osm_id'])
+    gdf = gdf[~np.isin(gdf.osm_id.values, df.osm_id.values)]
+    centroids = gdf.centroid
+    building_idx, raster_idx = raster_index.sindex.query(centroids.values, predicate='intersects')
+    # a centroid on a shared edge is sampled from the first raster only
+    building_idx, first = np.unique(building_idx, return_index=True)
+    raster_idx = raster_idx[first]
+    gdf = gdf.iloc[building_idx]
+    centroids = centroids.iloc[building_idx]
+    small = (gdf.area <= 1.5).values
+    heights = np.full(len(gdf), np.nan)
+    xs = centroids.x.values
+    ys = centroids.y.values
+    for raster in np.unique(raster_idx[small]):
+        idx = np.flatnonzero(small & (raster_idx == raster))
+        heights[idx] = sample_raster_points(raster_index.path.values[raster], xs[idx], ys[idx])
+    df = pd.DataFrame({'osm_id': gdf.osm_id.values[small]})
+    for col in STATS_COLUMNS.values():
+        df[col] = heights[small]
+    return df, gdf[~small]
@@ -0,0 +1,224 @@
+"""Streaming writers for the final building layers (GeoPackage, GeoParquet, FlatGeobuf)"""
+
+import json
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Sequence, Tuple, Union
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyogrio
+from pyproj import CRS
+
+from .ledger import atomic_path
+from .table import BuildingTable
+from .zonal_stats import STATS_COLUMNS
+
+DRIVERS = {'.gpkg': 'GPKG', '.parquet': 'Parquet', '.fgb': 'FlatGeobuf'}
+SINGLE_LAYER_DRIVERS = ['Parquet', 'FlatGeobuf']
+WRITE_BATCH = 1 << 16
+
+def get_driver(path: Union[Path, str]) -> str:
+    """Returns the output driver for the suffix of path"""
+    suffix = Path(path).suffix.lower()
+    if suffix not in DRIVERS:
+        raise ValueError(f'Unsupported output format {suffix}, use one of {list(DRIVERS)}')
+    return DRIVERS[suffix]
+
+
+def layer_path(
+    path: Union[Path, str],
+    layer: str) -> Path:
+    """Returns path for formats with layers, else a sibling file named after layer
+
+    Args:
+    path: Main output path (e.g. buildings.gpkg or buildings.parquet)
+    layer: Layer name
+
+    Returns:
+    path: Path holding layer (e.g. buildings_overlapping_buildings.parquet)
+    """
+    path = Path(path)
+    if get_driver(path) in SINGLE_LAYER_DRIVERS:
+        return path.with_name(f'{path.stem}_{layer}{path.suffix}')
+    return path
+
+
+def _crs_to_wkt(crs: object) -> Optional[str]:
+    """Returns WKT of any CRS pyproj understands (None if crs is None)"""
+    return None if crs is None else CRS.from_user_input(crs).to_wkt()
+
+
+def _geoparquet_metadata(
+    crs: object,
+    geometry_name: str) -> bytes:
+    """Returns GeoParquet 1.0 file metadata for a WKB geometry column"""
+    column = {'encoding': 'WKB', 'geometry_types': []}
+    if crs is not None:
+        column['crs'] = CRS.from_user_input(crs).to_json_dict()
+    return json.dumps({'version': '1.0.0', 'primary_column': geometry_name, 'columns': {geometry_name: column}}).encode()
+
+
+def write_batches(
+    batches: Iterable[pa.RecordBatch],
+    schema: pa.Schema,
+    path: Union[Path, str],
+    layer: str,
+    crs: object,
+    geometry_name: str = 'geometry') -> int:
+    """Streams record batches with a WKB geometry column to path
+
+    GeoPackage and FlatGeobuf layers are written by one pyogrio.write_arrow
+    call, so GDAL writes every batch in a single transaction and builds the
+    spatial index once at the end. GeoParquet is written by pyarrow one row
+    group per batch. Only the batch being written is held in memory.
+
+    Args:
+    batches: Record batches matching schema
+    schema: Arrow schema including the geometry column
+    path: Output path, the format comes from its suffix (.gpkg, .parquet or .fgb)
+    layer: Output layer (ignored for single layer formats)
+    crs: Coordinate reference system of the geometries
+    geometry_name: Name of the WKB geometry column
+
+    Returns:
+    n: Number of features written
+    """
+    driver = get_driver(path)
+    if driver in SINGLE_LAYER_DRIVERS:
+        with atomic_path(path) as tmp: # whole file outputs are renamed into place when complete
+            return _write_batches(batches, schema, tmp, driver, layer, crs, geometry_name)
+    return _write_batches(batches, schema, path, driver, layer, crs, geometry_name)
+
+
+def _write_batches(
+    batches: Iterable[pa.RecordBatch],
+    schema: pa.Schema,
+    path: Path,
+    driver: str,
+    layer: str,
+    crs: object,
+    geometry_name: str) -> int:
+    """Writes batches with driver (see write_batches)"""
+    n = 0
+    def count(batches: Iterable[pa.RecordBatch]) -> Iterator[pa.RecordBatch]:
+        nonlocal n
+        for batch in batches:
+            n += batch.num_rows
+            yield batch
+    if driver == 'Parquet':
+        schema = schema.with_metadata({b'geo': _geoparquet_metadata(crs, geometry_name)})
+        with pq.ParquetWriter(path, schema) as writer:
+            for batch in count(batches):
+                writer.write_batch(batch)
+        return n
+    pyogrio.write_arrow(
+        pa.RecordBatchReader.from_batches(schema, count(batches)),
+        path,
+        layer=layer,
+        driver=driver,
+        geometry_name=geometry_name,
+        geometry_type='Unknown',
+        crs=_crs_to_wkt(crs))
+    return n
+
+
+def write_frame(
+    gdf: gpd.GeoDataFrame,
+    path: Union[Path, str],
+    layer: str) -> int:
+    """Writes a GeoDataFrame (e.g. overlapping buildings) to layer_path(path, layer)"""
+    table = pa.table(gdf.to_arrow(index=False, geometry_encoding='WKB'))
+    geometry_name = gdf.geometry.name
+    table = table.set_column(
+        table.schema.get_field_index(geometry_name), geometry_name, table.column(geometry_name).cast(pa.binary()))
+    return write_batches(table.to_batches(WRITE_BATCH), table.schema, layer_path(path, layer), layer, gdf.crs, geometry_name)
+
+
+def copy_layers(
+    sources: Iterable[Tuple[Union[Path, str], str]],
+    path: Union[Path, str],
+    layer: str,
+    batch_size: int = WRITE_BATCH) -> int:
+    """Streams layers of several files (e.g. per tile outputs) into one layer
+
+    Args:
+    sources: (path, layer) of each source, missing files and layers are skipped
+    path: Output path
+    layer: Output layer
+    batch_size: Features read per batch
+
+    Returns:
+    n: Number of features written
+    """
+    sources = [(x, y) for x, y in sources if Path(x).exists() and y in pyogrio.list_layers(x)[:, 0]]
+    if not sources:
+        return 0
+    with pyogrio.open_arrow(sources[0][0], layer=sources[0][1], max_features=0, use_pyarrow=True) as (meta, reader):
+        schema = pa.schema([x.with_name('geometry') if x.name == meta['geometry_name'] else x for x in reader.schema])
+    def batches() -> Iterator[pa.RecordBatch]:
+        for source, source_layer in sources:
+            with pyogrio.open_arrow(source, layer=source_layer, batch_size=batch_size, use_pyarrow=True) as (info, reader):
+                for batch in reader:
+                    batch = batch.rename_columns(
+                        ['geometry' if x == info['geometry_name'] else x for x in batch.schema.names])
+                    yield batch if batch.schema == schema else batch.cast(schema)
+    return write_batches(batches(), schema, layer_path(path, layer), layer, meta['crs'])
+
+
+def iter_building_height_batches(
+    table: BuildingTable,
+    final_df: pd.DataFrame,
+    columns: Sequence[str] = ('name', 'type', 'tile_name'),
+    batch_size: int = WRITE_BATCH) -> Tuple[pa.Schema, Iterator[pa.RecordBatch]]:
+    """Joins final statistics to buildings a batch at a time
+
+    Args:
+    table: Buildings
+    final_df: Final statistics indexed by id (see reduce_partial_stats)
+    columns: Building attribute columns to keep
+    batch_size: Buildings per batch
+
+    Returns:
+    schema: Arrow schema of the batches
+    batches: Iterator of joined record batches with a WKB geometry column
+    """
+    idx = np.flatnonzero(np.isin(table.ids, final_df.index.values))
+    columns = [x for x in columns if x in table.attributes.columns]
+    def join(rows: np.ndarray) -> pa.Table:
+        arrow = table.to_arrow(rows).select([table.id_field] + columns + ['geometry'])
+        heights = final_df.reindex(table.ids[rows])
+        for col in STATS_COLUMNS.values():
+            arrow = arrow.add_column(
+                arrow.num_columns - 1, col, pa.array(heights[col].values.astype(np.float32), from_pandas=True))
+        return arrow
+    def batches() -> Iterator[pa.RecordBatch]:
+        for start in range(0, len(idx), batch_size):
+            yield from join(idx[start:start + batch_size]).combine_chunks().to_batches()
+    return join(idx[:0]).schema, batches()
+
+
+def write_building_heights(
+    table: BuildingTable,
+    final_df: pd.DataFrame,
+    path: Union[Path, str],
+    layer: str,
+    columns: Sequence[str] = ('name', 'type', 'tile_name'),
+    batch_size: int = WRITE_BATCH) -> int:
+    """Joins final statistics to buildings and streams them to path in batches
+
+    Args:
+    table: Buildings
+    final_df: Final statistics indexed by id (see reduce_partial_stats)
+    path: Output path (.gpkg, .parquet or .fgb)
+    layer: Output layer
+    columns: Building attribute columns to keep
+    batch_size: Buildings joined and written at a time
+
+    Returns:
+    n: Number of buildings written
+    """
+    schema, batches = iter_building_height_batches(table, final_df, columns, batch_size)
+    return write_batches(batches, schema, path, layer, table.crs)
@@ -0,0 +1,242 @@
+"""Single pass partitioning of buildings into per tile geopackages"""
+
+from contextlib import closing
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyogrio
+import shapely
+
+from .grid import bounds_tile_pairs, raster_path
+from .ledger import atomic_path
+
+logger = logging.getLogger(__name__)
+
+PARTITIONS_FILE = 'partitions.json'
+BATCH_SIZE = 1 << 16
+BUFFER_ROWS = 1 << 21
+
+def route_by_grid(wkb: Union[pa.Array, pa.ChunkedArray]) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns (row, tile name) pairs of buildings whose bounds reach each BNG 10km tile
+
+    Buildings straddling tiles are routed to every tile they reach, like the
+    bbox reads of extract_from_buildings, so each tile sees all of its pixels.
+
+    Args:
+    wkb: WKB geometries of a batch
+
+    Returns:
+    rows: Row positions in the batch
+    tiles: Tile names
+    """
+    geoms = shapely.from_wkb(wkb.to_numpy(zero_copy_only=False))
+    return bounds_tile_pairs(shapely.bounds(geoms))
+
+
+def layer_signature(
+    gpkg: Union[Path, str],
+    layer: str) -> dict:
+    """Returns feature count and last change time of a geopackage layer
+
+    GDAL updates the last change time of a layer whenever its features are
+    written, so outputs written to other layers of the same geopackage do
+    not change the signature. Other formats fall back to the file's
+    modification time.
+
+    Args:
+    gpkg: Geopackage of buildings
+    layer: Layer in geopackage
+
+    Returns:
+    signature: dict of layer, features and last_change
+    """
+    info = pyogrio.read_info(gpkg, layer=layer)
+    last_change = None
+    try:
+        with closing(sqlite3.connect(Path(gpkg).resolve().as_uri() + '?mode=ro', uri=True)) as connection:
+            row = connection.execute(
+                'SELECT last_change FROM gpkg_contents WHERE table_name = ?', (layer,)).fetchone()
+            last_change = row and row[0]
+    except sqlite3.Error: # not a geopackage
+        pass
+    return {
+        'layer': layer,
+        'features': int(info['features']),
+        'last_change': last_change or os.stat(gpkg).st_mtime_ns,
+    }
+
+
+def link_raster(
+    raster: Union[Path, str],
+    out_dir: Union[Path, str]) -> Optional[Path]:
+    """Hard links raster into out_dir, falling back to a symlink then a copy
+
+    A link from an earlier run is kept while it matches raster, replaced if
+    raster has changed and removed if raster no longer exists.
+
+    Args:
+    raster: Path to raster
+    out_dir: Folder to link into
+
+    Returns:
+    path: Path of the link (None if raster does not exist)
+    """
+    raster = Path(raster)
+    path = Path(out_dir).joinpath(raster.name)
+    if path.exists() or path.is_symlink():
+        if raster.exists() and path.exists():
+            stat, link_stat = raster.stat(), path.stat()
+            if os.path.samefile(raster, path) or (
+                    stat.st_size == link_stat.st_size and stat.st_mtime_ns == link_stat.st_mtime_ns):
+                return path
+        path.unlink()
+    if not raster.exists():
+        return None
+    try:
+        os.link(raster, path)
+    except OSError: # other filesystem or no permission to hard link
+        try:
+            os.symlink(raster.resolve(), path)
+        except OSError:
+            shutil.copy2(raster, path)
+    return path
+
+
+class _PartitionWriter:
+    """Buffers batches per tile and appends them to each tile's geopackage"""
+
+    def __init__(
+        self,
+        out_parent: Path,
+        layer: str,
+        meta: dict,
+        buffer_rows: int):
+        self.out_parent = out_parent
+        self.layer = layer
+        self.meta = meta
+        self.buffer_rows = buffer_rows
+        self.buffers: Dict[str, List[pa.Table]] = {}
+        self.buffered = 0
+        self.counts: Dict[str, int] = {}
+
+    def add(self, tile_name: str, table: pa.Table) -> None:
+        self.buffers.setdefault(tile_name, []).append(table)
+        self.buffered += len(table)
+        if self.buffered >= self.buffer_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        for tile_name, tables in self.buffers.items():
+            out_dir = self.out_parent.joinpath(tile_name)
+            out_dir.mkdir(parents=True, exist_ok=True)
+            pyogrio.write_arrow(
+                pa.concat_tables(tables),
+                out_dir.joinpath(f'{tile_name}.gpkg'),
+                layer=self.layer,
+                driver='GPKG',
+                geometry_name=self.meta['geometry_name'],
+                geometry_type='Unknown',
+                crs=self.meta['crs'],
+                append=tile_name in self.counts)
+            self.counts[tile_name] = self.counts.get(tile_name, 0) + sum(len(x) for x in tables)
+        self.buffers = {}
+        self.buffered = 0
+
+
+def partition_buildings(
+    gpkg: Union[Path, str],
+    layer: str,
+    out_parent: Union[Path, str],
+    by_grid: bool = True,
+    tiles: Optional[Iterable[str]] = None,
+    raster_dir: Union[Path, str, None] = None,
+    batch_size: int = BATCH_SIZE,
+    buffer_rows: int = BUFFER_ROWS) -> Dict[str, int]:
+    """Streams buildings once and writes a geopackage per tile, linking rasters alongside
+
+    Replaces a bbox read and clip of the source per grid cell. Features are
+    read in arrow batches and routed to the BNG 10km tiles their bounds reach
+    (by_grid), or by the tile_name column. Routed rows are buffered and appended
+    to out_parent/<tile>/<tile>.gpkg in bulk. Geometries are not clipped,
+    rasterising against the tile's raster already limits them to the tile.
+    A finished run writes partitions.json and is only repeated once the
+    buildings layer (see layer_signature) or the routing changes. Rasters
+    are linked again on every call, so links of removed rasters are dropped.
+
+    Args:
+    gpkg: Geopackage of buildings
+    layer: Layer in geopackage (also used for the tile geopackages)
+    out_parent: Folder in which a folder per tile is made
+    by_grid: Route by the grid tiles buildings reach instead of the tile_name column
+    tiles: Only write these tiles (all tiles if None)
+    raster_dir: Folder of rasters to link into the tile folders (not linked if None)
+    batch_size: Features read per batch
+    buffer_rows: Features buffered before writing
+
+    Returns:
+    counts: Number of buildings written per tile
+    """
+    out_parent = Path(out_parent)
+    tiles = None if tiles is None else np.array(sorted(tiles), dtype=object)
+    source = {
+        **layer_signature(gpkg, layer),
+        'by_grid': by_grid,
+        'tiles': None if tiles is None else tiles.tolist()}
+    done = out_parent.joinpath(PARTITIONS_FILE)
+    previous = json.loads(done.read_text()) if done.exists() else {}
+    if previous.get('source') == source:
+        logger.info(f'Already partitioned into {out_parent}')
+        counts = previous['counts']
+    else:
+        if previous:
+            logger.info(f'Buildings changed since {out_parent} was partitioned, partitioning again')
+        counts = _partition(gpkg, layer, out_parent, by_grid, tiles, batch_size, buffer_rows)
+        with atomic_path(done) as tmp:
+            tmp.write_text(json.dumps({'source': source, 'counts': counts}))
+        logger.info(f'Partitioned {sum(counts.values())} buildings into {len(counts)} tiles')
+    if raster_dir is not None:
+        for tile_name in counts:
+            link_raster(raster_path(raster_dir, tile_name), out_parent.joinpath(tile_name))
+    return counts
+
+
+def _partition(
+    gpkg: Union[Path, str],
+    layer: str,
+    out_parent: Path,
+    by_grid: bool,
+    tiles: Optional[np.ndarray],
+    batch_size: int,
+    buffer_rows: int) -> Dict[str, int]:
+    """Routes and writes the buildings of each tile (see partition_buildings)"""
+    with pyogrio.open_arrow(gpkg, layer=layer, batch_size=batch_size, use_pyarrow=True) as (meta, reader):
+        meta = {**meta, 'geometry_name': meta['geometry_name'] or 'wkb_geometry'}
+        writer = _PartitionWriter(out_parent, layer, meta, buffer_rows)
+        for batch in reader:
+            table = pa.Table.from_batches([batch])
+            if by_grid:
+                rows, names = route_by_grid(table.column(meta['geometry_name']))
+            else:
+                names = table.column('tile_name').to_numpy(zero_copy_only=False)
+                rows = np.flatnonzero(pc.is_valid(table.column('tile_name')).to_numpy(zero_copy_only=False))
+                names = names[rows]
+            if tiles is not None:
+                keep = np.isin(names, tiles)
+                rows = rows[keep]
+                names = names[keep]
+            order = np.lexsort((rows, names))
+            rows = rows[order]
+            names = names[order]
+            starts = np.flatnonzero(np.r_[True, names[1:] != names[:-1]]) if len(names) else []
+            for start, stop in zip(starts, np.r_[starts[1:], len(names)].astype(int)):
+                writer.add(str(names[start]), table.take(pa.array(rows[start:stop])))
+        writer.flush()
+    return dict(sorted(writer.counts.items()))
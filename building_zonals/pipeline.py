@@ -0,0 +1,127 @@
+"""Background prefetch of tile inputs and background writes of tile outputs"""
+
+from concurrent.futures import Executor, Future
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, TypeVar, Union
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from .cache import is_same_tile, tile_fingerprint
+from .instrument import Metrics, StageRecord
+from .raster_pool import open_raster, raster_info
+from .store import write_zonals
+from .table import BuildingTable
+from .utils import read_heights
+
+T = TypeVar('T')
+
+PREFETCH_DEPTH = 2
+
+def prefetch(
+    executor: Executor,
+    load: Callable[[T], object],
+    items: Iterable[T],
+    depth: int = PREFETCH_DEPTH) -> Iterator[Tuple[T, Future]]:
+    """Yields (item, future of load(item)) in order, keeping depth loads running ahead
+
+    The caller works on one item while the next depth are loaded in the
+    background. At most depth + 1 loaded items are held at once. Errors are
+    raised by future.result(), so the caller knows which item failed.
+
+    Args:
+    executor: Pool the loads run in (e.g. a ThreadPoolExecutor)
+    load: Function loading one item
+    items: Items to load
+    depth: Number of items loaded ahead of the one being used
+
+    Yields:
+    item: Item
+    future: Future of load(item)
+    """
+    pending = []
+    for item in items:
+        pending.append((item, executor.submit(load, item)))
+        if len(pending) > depth:
+            yield pending.pop(0)
+    while pending:
+        yield pending.pop(0)
+
+
+@dataclass
+class TileInput:
+    """Buildings, fingerprint and (unless the tile is unchanged) heights of a tile"""
+    raster: Path
+    gdf: gpd.GeoDataFrame
+    fingerprint: dict
+    current: bool
+    heights: Optional[np.ndarray] = None
+    records: List[StageRecord] = field(default_factory=list)
+
+
+def load_tile(
+    raster: Union[Path, str],
+    buildings: BuildingTable,
+    stats: List[str],
+    out_parquet: Union[Path, str],
+    previous: Optional[dict] = None,
+    read_raster: bool = True) -> TileInput:
+    """Decodes the buildings of raster, fingerprints the tile and reads its heights if it changed
+
+    Meant to run in a background thread: GDAL and shapely release the GIL
+    while reading, decompressing and decoding, so the next tile loads while
+    the current one is computed. Stage costs are returned, not recorded.
+
+    Args:
+    raster: Path to raster
+    buildings: Buildings table
+    stats: stats to calculate
+    out_parquet: Path the tile output is saved to
+    previous: Fingerprint recorded for the saved output (None if there is no output)
+    read_raster: Read the whole band (False when processing in windows or lazily)
+
+    Returns:
+    tile: TileInput of the raster
+    """
+    raster = Path(raster)
+    metrics = Metrics()
+    with metrics.stage('read_buildings', raster.stem) as record:
+        gdf = buildings.take(buildings.query_bounds(tuple(raster_info(raster).bounds)))
+        record.buildings = len(gdf)
+    with metrics.stage('fingerprint', raster.stem, buildings=len(gdf)):
+        fingerprint = tile_fingerprint(raster, gdf, stats, previous)
+    current = is_same_tile(fingerprint, previous) and Path(out_parquet).exists()
+    heights = None
+    if read_raster and not current and not gdf.empty:
+        with metrics.stage('read_raster', raster.stem, bytes_read=raster.stat().st_size) as record:
+            with open_raster(raster) as src:
+                heights = read_heights(src)
+            record.pixels = heights.size
+    return TileInput(raster, gdf, fingerprint, current, heights, metrics.records)
+
+
+def write_tile(
+    df: pd.DataFrame,
+    out_parquet: Union[Path, str],
+    fingerprint: dict,
+    buildings: int) -> Tuple[Path, dict, List[StageRecord]]:
+    """Saves partial stats of a tile, returning what run_tasks callers record
+
+    Args:
+    df: Partial statistics of the tile
+    out_parquet: Path of parquet to save
+    fingerprint: Fingerprint of the tile inputs
+    buildings: Number of buildings in the tile
+
+    Returns:
+    out_parquet: Path of saved parquet
+    fingerprint: Fingerprint of the tile inputs
+    records: Stage record of the write
+    """
+    metrics = Metrics()
+    with metrics.stage('write_partials', Path(out_parquet).stem, buildings=buildings) as record:
+        out_parquet = write_zonals(df, out_parquet)
+        record.bytes_written = out_parquet.stat().st_size
+    return out_parquet, fingerprint, metrics.records
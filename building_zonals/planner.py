@@ -0,0 +1,227 @@
+"""Cost estimates of tiles, largest first ordering and dry run schedules"""
+
+from dataclasses import dataclass, field, replace
+from datetime import timedelta
+import heapq
+import json
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+
+import numpy as np
+
+from .raster_pool import raster_info
+from .table import BuildingTable
+
+@dataclass
+class CostModel:
+    """Linear model of the time and memory of one tile
+
+    Time is an overhead plus terms for buildings, pixels covered by building
+    bounding boxes (a cheap stand in for footprint area) and raster pixels.
+    Memory is a worker baseline plus the raster working set, which a
+    memory_budget caps, plus the decoded buildings.
+    """
+    overhead_s: float = 0.2
+    s_per_building: float = 5e-5
+    s_per_footprint_pixel: float = 2e-8
+    s_per_pixel: float = 2e-8
+    worker_mb: float = 150.0
+    bytes_per_pixel: float = 12.0
+    bytes_per_building: float = 1500.0
+
+
+@dataclass
+class TileCost:
+    """Estimated cost of one tile"""
+    tile: str
+    raster: Path
+    buildings: int
+    footprint_pixels: int
+    pixels: int
+    seconds: float
+    memory_mb: float
+    measured: bool = False
+
+
+@dataclass
+class TilePlan:
+    """Tiles in submission order with the predicted schedule for n_workers"""
+    tiles: List[TileCost]
+    n_workers: int
+    wall_s: float
+    peak_memory_mb: float
+    serial_s: float
+    unordered_wall_s: float
+    starts: Dict[str, float] = field(default_factory=dict)
+
+    @property
+    def rasters(self) -> List[Path]:
+        return [x.raster for x in self.tiles]
+
+    def report(self, n_largest: int = 5) -> str:
+        """Returns a readable summary of the plan"""
+        measured = sum(x.measured for x in self.tiles)
+        lines = [
+            f'{len(self.tiles)} tiles on {self.n_workers} workers ({measured} timed in earlier runs): '
+            f'predicted wall {timedelta(seconds=round(self.wall_s))} '
+            f'(directory order {timedelta(seconds=round(self.unordered_wall_s))}, '
+            f'serial {timedelta(seconds=round(self.serial_s))}), '
+            f'peak memory {self.peak_memory_mb:.0f} MB']
+        for x in self.tiles[:n_largest]:
+            lines.append(f'  {x.tile}: {x.seconds:.1f}s, {x.memory_mb:.0f} MB, {x.buildings} buildings')
+        return '\n'.join(lines)
+
+
+def load_tile_timings(metrics_path: Union[Path, str, None]) -> Dict[str, float]:
+    """Returns the latest measured seconds of each tile from a metrics.jsonl
+
+    Only runs that calculated the zonal stats of a tile count, so tiles skipped
+    as unchanged do not look cheap.
+
+    Args:
+    metrics_path: JSON lines written by Metrics (nothing if None or missing)
+
+    Returns:
+    timings: Seconds of each tile's stages in its latest computed run
+    """
+    if metrics_path is None or not Path(metrics_path).exists():
+        return {}
+    runs: Dict[tuple, float] = {}
+    computed = set()
+    with open(metrics_path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('tile') is None:
+                continue
+            key = (record['tile'], record['run'])
+            runs[key] = runs.get(key, 0.0) + record['wall_s']
+            if record['stage'] == 'zonal_stats':
+                computed.add(key)
+    timings = {}
+    for tile, run in sorted(computed, key=lambda x: x[1]): # ISO run ids sort by time
+        timings[tile] = runs[tile, run]
+    return timings
+
+
+def estimate_tile_costs(
+    rasters: Iterable[Union[Path, str]],
+    buildings: BuildingTable,
+    timings: Optional[Dict[str, float]] = None,
+    memory_budget: Optional[int] = None,
+    cached: Iterable[str] = (),
+    model: Optional[CostModel] = None) -> List[TileCost]:
+    """Estimates seconds and memory of each raster tile
+
+    Tiles timed in earlier runs use their timing. The model estimate of the
+    other tiles is scaled by the median ratio of timed to estimated seconds,
+    so a model tuned on another machine still ranks and sums sensibly.
+
+    Args:
+    rasters: Paths to rasters
+    buildings: Buildings table
+    timings: Measured seconds per tile (e.g. from load_tile_timings)
+    memory_budget: Bytes allowed for the working set of one window (None reads the whole raster)
+    cached: Tiles expected to be skipped as unchanged (only the overhead is counted)
+    model: Cost model (default CostModel())
+
+    Returns:
+    costs: TileCost of each raster, in the order given
+    """
+    model = model or CostModel()
+    timings = timings or {}
+    cached = set(cached)
+    costs = []
+    for raster in rasters:
+        raster = Path(raster)
+        info = raster_info(raster)
+        idx = buildings.query_bounds(tuple(info.bounds))
+        bounds = buildings.bounds[idx]
+        area = np.sum((bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1]))
+        footprint_pixels = int(area / abs(info.res[0] * info.res[1]))
+        pixels = info.width * info.height
+        seconds = (
+            model.overhead_s + model.s_per_building * len(idx)
+            + model.s_per_footprint_pixel * footprint_pixels + model.s_per_pixel * pixels)
+        working_set = pixels * model.bytes_per_pixel
+        if memory_budget:
+            working_set = min(working_set, memory_budget)
+        memory_mb = model.worker_mb + (working_set + model.bytes_per_building * len(idx)) / 1024 ** 2
+        costs.append(TileCost(raster.stem, raster, len(idx), footprint_pixels, pixels, seconds, memory_mb))
+    ratios = [timings[x.tile] / x.seconds for x in costs if x.tile in timings and x.seconds > 0]
+    scale = float(np.median(ratios)) if ratios else 1.0
+    for x in costs:
+        if x.tile in cached:
+            x.seconds = model.overhead_s
+        elif x.tile in timings:
+            x.seconds = timings[x.tile]
+            x.measured = True
+        else:
+            x.seconds *= scale
+    return costs
+
+
+def simulate_schedule(
+    costs: List[TileCost],
+    n_workers: int,
+    base_memory_mb: float = 0.0,
+    worker_mb: float = 0.0) -> TilePlan:
+    """Predicts wall time and peak memory of a pool taking tiles in the given order
+
+    Each tile starts on the first worker to become free, as in a process pool
+    fed in submission order. Peak memory is the base (e.g. the parent's
+    building table) plus every worker's baseline plus the largest sum of tile
+    working sets running at once.
+
+    Args:
+    costs: Tiles in submission order
+    n_workers: Number of workers
+    base_memory_mb: Memory of the parent process
+    worker_mb: Baseline memory of each worker (already counted in each TileCost)
+
+    Returns:
+    plan: TilePlan (unordered_wall_s is the wall time of this same order)
+    """
+    workers = [0.0] * max(n_workers, 1)
+    events = []
+    starts = {}
+    for x in costs:
+        start = heapq.heappop(workers)
+        heapq.heappush(workers, start + x.seconds)
+        starts[x.tile] = start
+        events.append((start, 1, x.memory_mb - worker_mb))
+        events.append((start + x.seconds, 0, -(x.memory_mb - worker_mb))) # ends sort before starts
+    running = peak = 0.0
+    for _, _, memory in sorted(events):
+        running += memory
+        peak = max(peak, running)
+    wall_s = max(workers)
+    return TilePlan(
+        list(costs), n_workers, wall_s, base_memory_mb + n_workers * worker_mb + peak,
+        sum(x.seconds for x in costs), wall_s, starts)
+
+
+def plan_tiles(
+    costs: List[TileCost],
+    n_workers: int,
+    base_memory_mb: float = 0.0,
+    model: Optional[CostModel] = None) -> TilePlan:
+    """Orders tiles longest first (LPT) and predicts the schedule for n_workers
+
+    Starting the most expensive tiles first stops one dense tile from running
+    alone at the end of the run. The plan also records the predicted wall time
+    of the original order to show what the ordering saves.
+
+    Args:
+    costs: Estimated tiles (e.g. from estimate_tile_costs) in their original order
+    n_workers: Number of workers
+    base_memory_mb: Memory of the parent process
+    model: Cost model the costs were estimated with (default CostModel())
+
+    Returns:
+    plan: TilePlan with tiles in submission order
+    """
+    worker_mb = (model or CostModel()).worker_mb
+    ordered = sorted(costs, key=lambda x: (-x.seconds, x.tile))
+    plan = simulate_schedule(ordered, n_workers, base_memory_mb, worker_mb)
+    unordered = simulate_schedule(costs, n_workers, base_memory_mb, worker_mb)
+    return replace(plan, unordered_wall_s=unordered.wall_s)
@@ -0,0 +1,146 @@
+"""Bounded pool of open raster datasets with memoized metadata"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+import os
+from pathlib import Path
+import threading
+from typing import Dict, Iterator, Optional, Tuple, Union
+
+import rasterio
+from rasterio.coords import BoundingBox
+
+RASTER_POOL_SIZE = 32
+
+@dataclass(frozen=True)
+class RasterInfo:
+    """Metadata of a raster read once from its header"""
+    path: str
+    bounds: BoundingBox
+    transform: rasterio.Affine
+    crs: object
+    nodata: Optional[float]
+    width: int
+    height: int
+    res: Tuple[float, float]
+    dtype: str
+    block_shape: Tuple[int, int]
+
+
+def _key(raster: Union[Path, str]) -> Tuple[str, int, int]:
+    """Returns resolved path, modification time and size, so rewritten files are reopened"""
+    path = Path(raster).resolve()
+    stat = path.stat()
+    return str(path), stat.st_mtime_ns, stat.st_size
+
+
+class RasterPool:
+    """Least recently used pool of open rasterio datasets
+
+    Datasets are kept open between uses up to max_open, closing the least
+    recently used idle dataset when full. Datasets in use are never closed, so
+    the pool can briefly exceed max_open. Handles are per thread, as a GDAL
+    dataset must not be read from two threads at once, and metadata is shared.
+
+    Args:
+    max_open: Maximum idle datasets kept open
+    """
+
+    def __init__(self, max_open: int = RASTER_POOL_SIZE):
+        self.max_open = max_open
+        self._datasets: 'OrderedDict[Tuple, rasterio.io.DatasetReader]' = OrderedDict()
+        self._in_use: Dict[Tuple, int] = {}
+        self._info: Dict[Tuple, RasterInfo] = {}
+        self._lock = threading.RLock()
+        self.opened = 0
+
+    @contextmanager
+    def open(self, raster: Union[Path, str]) -> Iterator[rasterio.io.DatasetReader]:
+        """Yields an open dataset of raster, reusing a pooled handle when there is one
+
+        Args:
+        raster: Path to raster
+
+        Yields:
+        src: Open rasterio dataset (do not close it)
+        """
+        key = (*_key(raster), threading.get_ident())
+        with self._lock:
+            src = self._datasets.pop(key, None)
+            if src is None or src.closed:
+                src = rasterio.open(key[0])
+                self.opened += 1
+            self._datasets[key] = src
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+        try:
+            yield src
+        finally:
+            with self._lock:
+                self._in_use[key] -= 1
+                if not self._in_use[key]:
+                    del self._in_use[key]
+                self._evict()
+
+    def info(self, raster: Union[Path, str]) -> RasterInfo:
+        """Returns metadata of raster, reading its header only the first time"""
+        key = _key(raster)
+        with self._lock:
+            info = self._info.get(key)
+        if info is None:
+            with self.open(raster) as src:
+                info = RasterInfo(
+                    key[0], src.bounds, src.transform, src.crs, src.nodata,
+                    src.width, src.height, src.res, src.dtypes[0], src.block_shapes[0])
+            with self._lock:
+                self._info[key] = info
+        return info
+
+    def _evict(self) -> None:
+        """Closes least recently used idle datasets beyond max_open"""
+        idle = [x for x in self._datasets if x not in self._in_use]
+        for key in idle[:max(len(self._datasets) - self.max_open, 0)]:
+            self._datasets.pop(key).close()
+
+    def close(self) -> None:
+        """Closes every idle dataset (metadata is kept)"""
+        with self._lock:
+            for key in [x for x in self._datasets if x not in self._in_use]:
+                self._datasets.pop(key).close()
+
+    def __len__(self) -> int:
+        return len(self._datasets)
+
+    def __enter__(self) -> 'RasterPool':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+_pool: Optional[RasterPool] = None
+_pool_pid: Optional[int] = None
+
+def get_raster_pool() -> RasterPool:
+    """Returns the raster pool of this process (forked workers get a new one)"""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = RasterPool()
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def open_raster(raster: Union[Path, str]):
+    """Context manager yielding a pooled open dataset of raster (see RasterPool.open)"""
+    return get_raster_pool().open(raster)
+
+
+def raster_info(raster: Union[Path, str]) -> RasterInfo:
+    """Returns memoized metadata of raster from the process pool"""
+    return get_raster_pool().info(raster)
+
+
+def close_rasters() -> None:
+    """Closes idle datasets of the process pool, e.g. at the end of a run"""
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.close()
@@ -0,0 +1,104 @@
+"""Functions to save and load intermediate zonal tables as parquet"""
+
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from .ledger import atomic_path
+from .zonal_stats import reduce_partial_stats
+
+ZONALS_TABLE = 'ZONALS.parquet'
+HIST_COLUMNS = ['heights_hist_bins', 'heights_hist_counts']
+
+def write_zonals(
+    df: pd.DataFrame,
+    path: Union[Path, str]) -> Path:
+    """Saves zonals dataframe as parquet atomically (histogram columns are typed as lists of int32)
+
+    Args:
+    df: DataFrame of zonal statistics
+    path: Parquet path
+
+    Returns:
+    path: Parquet path
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for col in HIST_COLUMNS:
+        if col in table.column_names:
+            i = table.column_names.index(col)
+            table = table.set_column(i, col, pa.array(df[col].values, type=pa.list_(pa.int32())))
+    with atomic_path(path) as tmp:
+        pq.write_table(table, tmp)
+    return Path(path)
+
+
+def read_zonals(
+    zonals: Union[Path, str, pd.DataFrame],
+    columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Returns zonals as dataframe from a dataframe, parquet or csv
+
+    Args:
+    zonals: DataFrame or path to parquet/csv
+    columns: Columns to read (all if None)
+
+    Returns:
+    df: DataFrame of zonal statistics
+    """
+    if isinstance(zonals, pd.DataFrame):
+        return zonals if columns is None else zonals[columns]
+    if Path(zonals).suffix == '.parquet':
+        return pd.read_parquet(zonals, columns=columns)
+    return pd.read_csv(zonals, usecols=columns)
+
+
+def merge_zonals(
+    paths: Iterable[Union[Path, str]],
+    out_path: Union[Path, str, None] = None) -> pd.DataFrame:
+    """Scans tile parquet files into one table, optionally saving it
+
+    Args:
+    paths: Parquet paths of tiles
+    out_path: Parquet path of merged table (not saved if None)
+
+    Returns:
+    df: DataFrame of all tiles
+    """
+    paths = [str(x) for x in paths]
+    table = ds.dataset(paths, format='parquet').to_table()
+    if out_path:
+        with atomic_path(out_path) as tmp:
+            pq.write_table(table, tmp)
+    return table.to_pandas()
+
+
+def reduce_partial_files(
+    paths: Iterable[Union[Path, str]],
+    stats: List[str],
+    n_partitions: int = 16,
+    id_field: str = 'osm_id') -> Iterator[pd.DataFrame]:
+    """Yields final statistics from tile partials one id partition at a time
+
+    Ids are partitioned on their low bits so only one partition of the partial
+    rows is in memory at once, and partitions can be reduced in separate processes.
+
+    Args:
+    paths: Parquet paths of tile partials
+    stats: stats to return (options ['mean', 'min', 'max', 'med'])
+    n_partitions: Number of id partitions (power of two)
+    id_field: Name of the id column
+
+    Yields:
+    df : DataFrame of final statistics indexed by id_field for one partition
+    """
+    if n_partitions & (n_partitions - 1):
+        raise ValueError(f'n_partitions must be a power of two, got {n_partitions}')
+    dataset = ds.dataset([str(x) for x in paths], format='parquet')
+    for partition in range(n_partitions):
+        partition_filter = pc.equal(pc.bit_wise_and(pc.field(id_field), n_partitions - 1), partition)
+        df = dataset.to_table(filter=partition_filter).to_pandas()
+        yield reduce_partial_stats(df, stats, id_field)
@@ -0,0 +1,223 @@
+"""Compact in memory table of buildings with geometry packed as WKB"""
+
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyogrio
+import shapely
+
+from .store import read_zonals
+from .zonal_stats import STATS_COLUMNS
+
+CATEGORICAL_COLUMNS = ['tile_name', 'type']
+BOUNDS_BATCH = 1 << 20
+
+def compact_buildings(
+    df: pd.DataFrame,
+    id_field: str = 'osm_id') -> pd.DataFrame:
+    """Casts building attributes to compact dtypes in place
+
+    Ids become int64 (OSM way ids overflow int32), tile_name and type become
+    categoricals and other text columns pyarrow strings.
+
+    Args:
+    df: Buildings (geo)dataframe
+    id_field: Name of the id column
+
+    Returns:
+    df: The same dataframe with compact dtypes
+    """
+    if id_field in df.columns:
+        df[id_field] = df[id_field].astype(np.int64)
+    for col in df.columns:
+        if col == id_field or col == getattr(df, '_geometry_column_name', None):
+            continue
+        if col in CATEGORICAL_COLUMNS:
+            df[col] = df[col].astype('category')
+        elif pd.api.types.is_string_dtype(df[col].dtype) and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('string[pyarrow]')
+    return df
+
+
+def compact_heights(df: pd.DataFrame) -> pd.DataFrame:
+    """Casts heights_* statistics columns to float32 in place"""
+    for col in STATS_COLUMNS.values():
+        if col in df.columns:
+            df[col] = df[col].astype(np.float32)
+    return df
+
+
+class BuildingTable:
+    """Buildings held as compact arrays instead of a GeoDataFrame of shapely objects
+
+    Geometry stays as one packed arrow array of WKB and is only decoded for the
+    rows taken, and spatial queries run on a float64 bounds array, so a
+    national building layer fits in a fraction of the memory of a GeoDataFrame.
+
+    Args:
+    ids: int64 building ids
+    attributes: DataFrame of the other columns in compact dtypes
+    wkb: Arrow array of WKB geometries
+    bounds: (n, 4) array of minx, miny, maxx, maxy
+    crs: Coordinate reference system
+    id_field: Name of the id column
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        attributes: pd.DataFrame,
+        wkb: Union[pa.Array, pa.ChunkedArray],
+        bounds: np.ndarray,
+        crs: object,
+        id_field: str = 'osm_id'):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.attributes = attributes.reset_index(drop=True)
+        self.wkb = wkb
+        self.bounds = np.asarray(bounds, dtype=np.float64)
+        self.crs = crs
+        self.id_field = id_field
+        self._minx_order = None
+
+    @classmethod
+    def from_geodataframe(
+        cls,
+        gdf: gpd.GeoDataFrame,
+        id_field: str = 'osm_id') -> 'BuildingTable':
+        """Packs a GeoDataFrame of buildings"""
+        attributes = compact_buildings(pd.DataFrame(gdf.drop(columns=[id_field, gdf.geometry.name])))
+        attributes = attributes[[x for x in attributes.columns if not x.startswith('heights_')]]
+        return cls(
+            gdf[id_field].values,
+            attributes,
+            pa.array(shapely.to_wkb(gdf.geometry.values), type=pa.large_binary()),
+            shapely.bounds(gdf.geometry.values),
+            gdf.crs,
+            id_field)
+
+    @classmethod
+    def read(
+        cls,
+        path: Union[Path, str],
+        layer: Optional[str] = None,
+        id_field: str = 'osm_id') -> 'BuildingTable':
+        """Reads a building layer as arrow, without creating a shapely object per building
+
+        Args:
+        path: Path of vector file (e.g. geopackage)
+        layer: Layer to read
+        id_field: Name of the id column
+
+        Returns:
+        table: BuildingTable of the layer in fid order
+        """
+        meta, table = pyogrio.read_arrow(path, layer=layer)
+        geometry_name = meta['geometry_name'] or 'wkb_geometry'
+        wkb = table.column(geometry_name).cast(pa.large_binary())
+        bounds = np.empty((len(table), 4))
+        for start in range(0, len(table), BOUNDS_BATCH):
+            batch = wkb.slice(start, BOUNDS_BATCH).to_numpy(zero_copy_only=False)
+            bounds[start:start + len(batch)] = shapely.bounds(shapely.from_wkb(batch))
+        columns = [x for x in table.column_names if x not in (id_field, geometry_name) and not x.startswith('heights_')]
+        attributes = compact_buildings(table.select(columns).to_pandas(), id_field)
+        return cls(table.column(id_field).to_numpy(), attributes, wkb, bounds, meta['crs'], id_field)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory held by the table in bytes"""
+        return (
+            self.ids.nbytes + self.bounds.nbytes + self.wkb.nbytes
+            + int(self.attributes.memory_usage(index=False, deep=True).sum()))
+
+    def take(self, idx: Optional[np.ndarray] = None) -> gpd.GeoDataFrame:
+        """Decodes rows idx (all rows if None) into a GeoDataFrame
+
+        Args:
+        idx: Row positions
+
+        Returns:
+        gdf: GeoDataFrame with the id, attribute and geometry columns
+        """
+        if idx is None:
+            idx = np.arange(len(self))
+        idx = np.asarray(idx, dtype=np.int64)
+        wkb = self.wkb.take(pa.array(idx)).to_numpy(zero_copy_only=False)
+        gdf = gpd.GeoDataFrame(
+            self.attributes.iloc[idx].reset_index(drop=True),
+            geometry=shapely.from_wkb(wkb),
+            crs=self.crs)
+        gdf.insert(0, self.id_field, self.ids[idx])
+        return gdf
+
+    def query_bounds(self, bounds: Tuple[float, float, float, float]) -> np.ndarray:
+        """Returns positions (in table order) of buildings whose bounds intersect bounds
+
+        Buildings are sorted by minx once so each query only scans the strip
+        of buildings that can reach bounds.
+
+        Args:
+        bounds: minx, miny, maxx, maxy
+
+        Returns:
+        idx: Sorted row positions
+        """
+        if self._minx_order is None: # set last, so threads never see a half built index
+            order = np.argsort(self.bounds[:, 0], kind='stable')
+            self._sorted_minx = self.bounds[order, 0]
+            self._max_width = float(np.max(self.bounds[:, 2] - self.bounds[:, 0], initial=0))
+            self._minx_order = order
+        left, bottom, right, top = bounds
+        start = np.searchsorted(self._sorted_minx, left - self._max_width, 'left')
+        stop = np.searchsorted(self._sorted_minx, right, 'right')
+        idx = self._minx_order[start:stop]
+        candidates = self.bounds[idx]
+        hit = (
+            (candidates[:, 2] >= left) & (candidates[:, 0] <= right)
+            & (candidates[:, 3] >= bottom) & (candidates[:, 1] <= top))
+        return np.sort(idx[hit])
+
+    def missing(
+        self,
+        zonals: Union[Path, str, pd.DataFrame],
+        by_tile: bool = True) -> np.ndarray:
+        """Returns positions of buildings without zonal statistics
+
+        Args:
+        zonals: Zonals DataFrame or path to parquet/csv
+        by_tile: Only count buildings in tiles that appear in zonals (like find_missing_buildings)
+
+        Returns:
+        idx: Sorted row positions
+        """
+        df = read_zonals(zonals, columns=[self.id_field, 'tile_name'] if by_tile else [self.id_field])
+        missing = ~np.isin(self.ids, df[self.id_field].values)
+        if by_tile:
+            missing &= self.attributes.tile_name.isin(df.tile_name.unique()).values
+        return np.flatnonzero(missing)
+
+    def to_arrow(
+        self,
+        idx: Optional[np.ndarray] = None,
+        geometry_name: str = 'geometry') -> pa.Table:
+        """Returns rows idx (all rows if None) as an arrow table with a WKB geometry column"""
+        if idx is None:
+            idx = np.arange(len(self))
+        attributes = self.attributes.iloc[idx]
+        columns = {self.id_field: pa.array(self.ids[idx])}
+        for col in attributes.columns:
+            values = pa.array(attributes[col], from_pandas=True)
+            if pa.types.is_dictionary(values.type):
+                values = values.dictionary_decode()
+            if pa.types.is_null(values.type): # no categories, so no values
+                values = values.cast(pa.string())
+            columns[col] = values
+        columns[geometry_name] = self.wkb.take(pa.array(np.asarray(idx, dtype=np.int64)))
+        return pa.table(columns)
+
@@ -0,0 +1,205 @@
+"""Memory mapped cache of decoded raster bands so reruns skip decompression"""
+
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+from pathlib import Path
+import threading
+from typing import Dict, Iterator, Optional, Tuple, Union
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from .ledger import atomic_path
+from .raster_pool import open_raster
+
+RASTER_CACHE_ENV = 'BUILDING_ZONALS_RASTER_CACHE'
+CACHE_ROWS = 1024
+
+def decode_heights(
+    src: rasterio.io.DatasetReader,
+    window: Union[Window, None] = None) -> np.ndarray:
+    """Decodes first band of src as floats with NaN for nodata (like rioxarray mask_and_scale)
+
+    Args:
+    src: Open raster dataset
+    window: Window to read (whole raster if None)
+
+    Returns:
+    heights: 2d float array (float32 unless the raster is float64)
+    """
+    dtype = np.result_type(src.dtypes[0], np.float32)
+    heights = src.read(1, window=window, masked=True, out_dtype=dtype).filled(np.nan)
+    if src.scales[0] != 1 or src.offsets[0] != 0:
+        heights = heights * src.scales[0] + src.offsets[0]
+    return heights
+
+
+class RasterCache:
+    """Decoded bands of rasters kept as .npy files with a JSON sidecar and read as memmap views
+
+    A raster is decoded once, in strips, into an uncompressed row major array
+    the first time it is read, and again only when its size or modification
+    time changes. Reads after that are read only views of a memory map, so
+    they skip decompression and only touch the pages they need. Files are
+    written atomically, the sidecar last, so a killed conversion is redone.
+    Threads converting different rasters run at the same time, threads
+    asking for a raster being converted wait for it.
+    Arrays are uncompressed floats, often several times the size of the
+    compressed rasters, and are never evicted (delete cache_dir to free them).
+
+    Args:
+    cache_dir: Folder of the cached arrays
+    rows_per_read: Rows decoded at a time while converting (rounded up to the block height)
+    """
+
+    def __init__(
+        self,
+        cache_dir: Union[Path, str],
+        rows_per_read: int = CACHE_ROWS):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.rows_per_read = rows_per_read
+        self._arrays: Dict[Tuple[str, int, int], np.memmap] = {}
+        self._raster_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock() # guards the dicts and converted, never held while converting
+        self.converted = 0
+
+    def paths(self, raster: Union[Path, str]) -> Tuple[Path, Path]:
+        """Returns array and sidecar paths of raster (named by stem and a hash of its full path)"""
+        raster = Path(raster).resolve()
+        digest = hashlib.blake2b(str(raster).encode(), digest_size=4).hexdigest()
+        stem = self.cache_dir.joinpath(f'{raster.stem}_{digest}')
+        return stem.with_suffix('.npy'), stem.with_suffix('.json')
+
+    def is_current(self, raster: Union[Path, str]) -> bool:
+        """Returns True if raster has a complete cached array matching its size and modification time"""
+        _, sidecar = self.paths(raster)
+        if not sidecar.exists():
+            return False
+        meta = json.loads(sidecar.read_text())
+        stat = os.stat(raster)
+        return meta['size'] == stat.st_size and meta['mtime_ns'] == stat.st_mtime_ns
+
+    def convert(self, raster: Union[Path, str]) -> Path:
+        """Decodes raster into its cached array, strip by strip
+
+        Args:
+        raster: Path to raster
+
+        Returns:
+        path: Path of the .npy array
+        """
+        array_path, sidecar = self.paths(raster)
+        stat = os.stat(raster)
+        with open_raster(raster) as src:
+            dtype = np.result_type(src.dtypes[0], np.float32)
+            block_height = src.block_shapes[0][0]
+            rows = block_height * -(-self.rows_per_read // block_height)
+            with atomic_path(array_path) as tmp:
+                out = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=(src.height, src.width))
+                for row_off in range(0, src.height, rows):
+                    window = Window(0, row_off, src.width, min(rows, src.height - row_off))
+                    out[row_off:row_off + window.height] = decode_heights(src, window)
+                out.flush()
+                del out
+            meta = {
+                'source': str(Path(raster).resolve()),
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'shape': [src.height, src.width],
+                'dtype': str(dtype),
+                'transform': list(src.transform)[:6],
+                'crs': src.crs.to_wkt() if src.crs else None,
+                'block_shape': list(src.block_shapes[0]),
+            }
+        with atomic_path(sidecar) as tmp:
+            tmp.write_text(json.dumps(meta))
+        with self._lock:
+            self.converted += 1
+        return array_path
+
+    def array(self, raster: Union[Path, str]) -> np.memmap:
+        """Returns read only memmap of the decoded band of raster, converting it on first use"""
+        stat = os.stat(raster)
+        source = str(Path(raster).resolve())
+        key = (source, stat.st_mtime_ns, stat.st_size)
+        array = self._arrays.get(key)
+        if array is not None:
+            return array
+        with self._lock:
+            raster_lock = self._raster_locks.setdefault(source, threading.Lock())
+        with raster_lock: # only waits for a conversion of the same raster
+            array = self._arrays.get(key)
+            if array is None:
+                if not self.is_current(raster):
+                    self.convert(raster)
+                array = np.load(self.paths(raster)[0], mmap_mode='r')
+                with self._lock:
+                    self._arrays[key] = array
+        return array
+
+    def heights(
+        self,
+        raster: Union[Path, str],
+        window: Union[Window, None] = None) -> np.ndarray:
+        """Returns a zero copy view of window (whole band if None) of the decoded band of raster
+
+        Args:
+        raster: Path to raster
+        window: Window inside the raster
+
+        Returns:
+        heights: Read only 2d float array with NaN for nodata (same values as decode_heights)
+        """
+        array = self.array(raster)
+        if window is None:
+            return array
+        (row_0, row_1), (col_0, col_1) = window.round_offsets().round_lengths().toranges()
+        return array[row_0:row_1, col_0:col_1]
+
+
+_cache: Optional[RasterCache] = None
+_cache_key: Optional[Tuple[int, str]] = None
+
+def set_raster_cache(cache_dir: Union[Path, str, None]) -> None:
+    """Turns the raster cache on in cache_dir for this process and workers it starts (off if None)
+
+    The folder is kept in an environment variable, so worker processes,
+    forked or spawned, read through the same cache.
+    """
+    if cache_dir is None:
+        os.environ.pop(RASTER_CACHE_ENV, None)
+    else:
+        os.environ[RASTER_CACHE_ENV] = str(Path(cache_dir).resolve())
+
+
+@contextmanager
+def use_raster_cache(cache_dir: Union[Path, str, None]) -> Iterator[Optional[RasterCache]]:
+    """Turns the raster cache on in cache_dir (unchanged if None) until the block exits
+
+    The previous setting is restored even when the block raises, so a failed
+    run does not leave later runs in the process reading through its cache.
+    """
+    previous = os.environ.get(RASTER_CACHE_ENV)
+    if cache_dir is not None:
+        set_raster_cache(cache_dir)
+    try:
+        yield get_raster_cache()
+    finally:
+        set_raster_cache(previous)
+
+
+def get_raster_cache() -> Optional[RasterCache]:
+    """Returns the raster cache of this process (None when the cache is off)"""
+    global _cache, _cache_key
+    cache_dir = os.environ.get(RASTER_CACHE_ENV)
+    if not cache_dir:
+        return None
+    key = (os.getpid(), cache_dir)
+    if _cache is None or _cache_key != key:
+        _cache = RasterCache(cache_dir)
+        _cache_key = key
+    return _cache
@@ -1,43 +1,92 @@
 """Utility functions"""
 
 from pathlib import Path 
-from typing import Union, List
+import threading
+from typing import Iterator, List, Tuple, Union
 
 from geocube.api.core import make_geocube
 import geopandas as gpd
 import numpy as np
 import pandas as pd
+import pyogrio
 import rasterio
+import rasterio.features
+from rasterio.windows import Window
 import rioxarray
+import shapely
 from shapely.geometry import box
 import xarray
 
+from .grid import raster_path, tile_names
+from .ledger import atomic_path
+from .raster_pool import open_raster, raster_info
+from .store import read_zonals
+from .tile_cache import decode_heights, get_raster_cache
+from .zonal_stats import STATS_COLUMNS, zonal_stats
+
 GRID_GPKG = Path(__file__).resolve().parent.joinpath('OS_BNG_10km.gpkg')
+CONVERT_BATCH = 1 << 17
+# rasterize hides a NotGeoreferencedWarning of its in memory dataset with
+# warnings.catch_warnings, which is not thread safe: overlapping calls
+# restore each other's filters and the warning escapes
+_RASTERIZE_LOCK = threading.Lock()
+
+def iter_shp_batches(
+        shp: Union[Path, str],
+        batch_size: int = CONVERT_BATCH) -> Iterator[gpd.GeoDataFrame]:
+    """Reads buildings in batches, reprojects them to BNG and tags each with the grid tile of its centroid
+
+    Only one batch is in memory at a time, so a consumer can start work on
+    each batch as soon as it is yielded.
+
+    Args:
+    shp: Shapefile (or any vector file) path
+    batch_size: Features read per batch
+
+    Yields:
+    gdf: GeoDataFrame of osm_id, name, type, tile_name and geometry
+    """
+    with pyogrio.open_arrow(shp, batch_size=batch_size, use_pyarrow=True) as (meta, reader):
+        geometry_name = meta['geometry_name'] or 'wkb_geometry'
+        for batch in reader:
+            geoms = shapely.from_wkb(batch.column(geometry_name).to_numpy(zero_copy_only=False))
+            gdf = gpd.GeoDataFrame(
+                batch.select(['osm_id', 'name', 'type']).to_pandas(),
+                geometry=geoms,
+                crs=meta['crs']).to_crs(27700)
+            centroids = gdf.centroid
+            gdf.insert(3, 'tile_name', tile_names(centroids.x.values, centroids.y.values))
+            gdf.osm_id = gdf.osm_id.astype(np.int64) # OSM way ids overflow int32
+            yield gdf
+
 
 def convert_shp_to_gpkg(
         shp: Union[Path, str], 
         gpkg: Union[Path, str],
-        layer: str) -> None:
+        layer: str,
+        batch_size: int = CONVERT_BATCH) -> int:
     """Converts shp shapefile to geopackage and gets grid id in which building lies
     
+    Batches from iter_shp_batches are appended to the layer as they are
+    converted, so memory stays flat whatever the size of the shapefile. They
+    are written to a temporary geopackage that is renamed to gpkg once every
+    batch is in, so a killed conversion never leaves a truncated gpkg.
+
     Args:
     shp: Shapefile path
     gpkg: Geopackage path
     layer: Layer in geopackage
+    batch_size: Features converted at a time
 
     Returns:
-    None
+    n: Number of buildings written
     """
-    gdf = gpd.read_file(shp).to_crs(27700)
-    gdf_grid = gpd.read_file(GRID_GPKG)
-    gdf['centroids'] = gdf.centroid
-    gdf = gdf.set_geometry('centroids')
-    gdf = gdf.sjoin(gdf_grid, how='left', predicate='intersects')
-    gdf = gdf.set_geometry('geometry')
-    gdf = gdf[['osm_id', 'name', 'type', 'tile_name', 'geometry']]
-    gdf.osm_id = gdf.osm_id.astype(np.int32)
-    gdf.to_file(gpkg, layer=layer, index=False)
-    return gdf
+    n = 0
+    with atomic_path(gpkg) as tmp:
+        for gdf in iter_shp_batches(shp, batch_size):
+            gdf.to_file(tmp, layer=layer, index=False, mode='a' if n else 'w', use_arrow=True)
+            n += len(gdf)
+    return n
 
 def get_buildings_using_bounds(
         raster: Union[Path, str],
@@ -52,12 +101,82 @@ def get_buildings_using_bounds(
     Returns:
     gdf: Geodataframe of buildings clipped to raster
     """
-    src = rasterio.open(raster)
-    bounds = list(src.bounds)
-    polygon = box(*bounds)
+    polygon = box(*raster_info(raster).bounds)
     gdf_clip = gdf.clip(polygon)
     return gdf_clip
 
+def read_heights(
+    src: rasterio.io.DatasetReader,
+    window: Union[Window, None] = None) -> np.ndarray:
+    """Reads first band of src as floats with NaN for nodata (like rioxarray mask_and_scale)
+
+    With the raster cache on (see set_raster_cache) this is a read only view
+    of the cached band instead of a decoded copy.
+
+    Args:
+    src: Open raster dataset
+    window: Window to read (whole raster if None)
+
+    Returns:
+    heights: 2d float array (float32 unless the raster is float64)
+    """
+    cache = get_raster_cache()
+    if cache is not None:
+        return cache.heights(src.name, window)
+    return decode_heights(src, window)
+
+def rasterise_codes(
+    gdf: gpd.GeoDataFrame,
+    shape: Tuple[int, int],
+    transform: rasterio.Affine,
+    out: Union[np.ndarray, None] = None) -> np.ndarray:
+    """Burns the position (plus one) of each building into a uint32 grid, 0 is background
+
+    Positions rather than ids are burnt so ids of any size stay exact, use
+    codes_to_ids to map the results back. Later buildings are burnt over
+    earlier ones, like rasterise_clip. Calls from several threads burn one
+    at a time (see _RASTERIZE_LOCK).
+
+    Args:
+    gdf: Buildings geodataframe
+    shape: Rows and columns of the grid
+    transform: Affine transform of the grid
+    out: uint32 buffer of shape to reuse (a new array if None)
+
+    Returns:
+    codes: uint32 array, index gdf with codes - 1
+    """
+    if out is None:
+        out = np.zeros(shape, dtype=np.uint32)
+    else:
+        out.fill(0)
+    if gdf.empty:
+        return out
+    with _RASTERIZE_LOCK:
+        return rasterio.features.rasterize(
+            zip(gdf.geometry.values, np.arange(1, len(gdf) + 1, dtype=np.uint32)),
+            out=out,
+            transform=transform,
+            dtype='uint32')
+
+def codes_to_ids(
+    df: pd.DataFrame,
+    ids: np.ndarray,
+    id_field: str = 'osm_id') -> pd.DataFrame:
+    """Replaces the building codes in id_field of df with ids (int64)
+
+    Args:
+    df: DataFrame of statistics keyed by codes from rasterise_codes
+    ids: Ids of the rasterised buildings in gdf order
+    id_field: Name of the id column
+
+    Returns:
+    df: DataFrame of statistics keyed by ids
+    """
+    codes = df[id_field].values.astype(np.int64)
+    df[id_field] = np.asarray(ids).astype(np.int64)[codes - 1]
+    return df
+
 def rasterise_clip(
     raster: Union[Path, str],
     gdf: gpd.GeoDataFrame,
@@ -73,6 +192,23 @@ def rasterise_clip(
     out_grid: rasterised gdf dataset merged with raster data
     """
     rx = rioxarray.open_rasterio(raster, mask_and_scale=True)
+    out_grid = rasterise_like(rx, gdf)
+    return out_grid
+
+def rasterise_like(
+    rx: xarray.DataArray,
+    gdf: gpd.GeoDataFrame,
+) -> xarray.Dataset:
+    """
+    Rasterises gdf onto the grid of rx and attaches the rx values as heights
+
+    Args:
+    rx: Height raster (or a window of it) opened with rioxarray
+    gdf: gdf of buildings to rasterise
+
+    Returns:
+    out_grid: rasterised gdf dataset merged with raster data
+    """
     out_grid = make_geocube(
             vector_data=gdf, 
             measurements=['osm_id'], 
@@ -93,95 +229,104 @@ def get_building_height_stats(
     Returns:
     df : DataFrame of statistics
     """
-    stats_for_dataframe = []
-    grouped_heights = raster_dataset.drop_vars("spatial_ref").groupby(raster_dataset.osm_id)
-    if "mean" in stats:
-        #grid_mean = grouped_heights.mean().rename({"heights": "heights_mean"})
-        stats_for_dataframe.append(grouped_heights.mean().rename({"heights": "heights_mean"}))
-    if "min" in stats:
-        stats_for_dataframe.append(grouped_heights.min().rename({"heights": "heights_min"}))
-    if "max" in stats:
-        stats_for_dataframe.append(grouped_heights.max().rename({"heights": "heights_max"}))
-    if "med" in stats:
-        stats_for_dataframe.append(grouped_heights.median().rename({"heights": "heights_med"}))
-
-    df = xarray.merge(stats_for_dataframe).to_dataframe().reset_index()
-    df = df[[x for x in df.columns if not x in ['band', 'spatial_ref']]]
-    stats_cols_to_insert = ["heights_mean", "heights_min", "heights_max", "heights_med"]
-    for i in stats_cols_to_insert: # holder columns for aggregation later
-        if not i in df.columns:
-            df[i] = np.nan
+    heights = raster_dataset.heights.values
+    labels = np.broadcast_to(raster_dataset.osm_id.values, heights.shape)
+    df = zonal_stats(labels, heights, stats, id_field='osm_id')
+    df['osm_id'] = df['osm_id'].astype(np.int64)
     return df
 
 
 def find_missing_buildings(
         gdf: gpd.GeoDataFrame,
-        csv: Union[Path, str]) -> gpd.GeoDataFrame:
-    """Returns gdf of buildings in gpkg missing in csv
+        zonals: Union[Path, str, pd.DataFrame]) -> gpd.GeoDataFrame:
+    """Returns gdf of buildings in gpkg missing in zonals
     
     Args:
     gdf: gpd.GeoDataFrame
-    csv : Path to csv
+    zonals : Zonals DataFrame or path to parquet/csv
 
     Returns:
     gdf_small : Dataframe of small missing buildings
     gdf_overlapping: Dataframe of buildings presumed to be overlapping
     """
-    df = pd.read_csv(csv)
-    tiles = list(df.tile_name.unique())
-    gdf = gdf[gdf.tile_name.isin(tiles)]
-    gdf = gdf[~gdf.osm_id.isin(df.osm_id.unique())]
-    gdf_small = gdf[gdf.area <= 1.5]
-    gdf_overlapping = gdf[gdf.area > 1.5]
+    df = read_zonals(zonals, columns=['osm_id', 'tile_name'])
+    in_tiles = gdf.tile_name.isin(df.tile_name.unique()).values
+    found = np.isin(gdf.osm_id.values, df.osm_id.values)
+    gdf = gdf[in_tiles & ~found]
+    small = (gdf.area <= 1.5).values
+    gdf_small = gdf[small]
+    gdf_overlapping = gdf[~small]
     return gdf_small, gdf_overlapping
 
 
+def sample_raster_points(
+    raster: Union[Path, str],
+    xs: np.ndarray,
+    ys: np.ndarray,
+    strip_rows: int = 256) -> np.ndarray:
+    """Samples first band of raster at coordinates, reading only the strips that contain points
+
+    Args:
+    raster: Path to raster
+    xs: x coordinates
+    ys: y coordinates
+    strip_rows: Minimum number of rows read at a time (rounded up to the block height)
+
+    Returns:
+    values: float64 array of pixel values (NaN for nodata and points outside raster)
+    """
+    values = np.full(len(xs), np.nan)
+    with open_raster(raster) as src:
+        cols, rows = ~src.transform * (np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+        rows = np.floor(rows).astype(np.int64)
+        cols = np.floor(cols).astype(np.int64)
+        inside = np.flatnonzero((rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width))
+        block_height = src.block_shapes[0][0]
+        strip_rows = block_height * -(-strip_rows // block_height)
+        strips = rows[inside] // strip_rows
+        for strip in np.unique(strips):
+            idx = inside[strips == strip]
+            row_off = strip * strip_rows
+            window = Window(0, row_off, src.width, min(strip_rows, src.height - row_off))
+            data = read_heights(src, window)
+            values[idx] = data[rows[idx] - row_off, cols[idx]]
+    return values
+
+
 def sample_missing_buildings_and_join_back_to_csv(
     gdf: gpd.GeoDataFrame,
-    csv: Union[Path, str],
+    zonals: Union[Path, str, pd.DataFrame],
     raster_dir: Union[Path, str]
 ) -> pd.DataFrame:
     """Samples missing buildings to rasters to fill in vals
     
+    Centroids are calculated once for all missing buildings, which are grouped by
+    tile in one pass so each raster is opened once.
+
     Args:
     gdf: Buildings geodataframe
-    csv: Path to zonals csv
+    zonals: Zonals DataFrame or path to parquet/csv
     raster_dir: Folder in which rasters are held
 
     Returns:
     -------
-    df: DataFrame with missing values filled
+    df: DataFrame of missing building heights (NaN where no raster could be sampled)
     gdf_overlapping: Gdf of buildings presumed to be overlapping
     """
-    gdf_missing, gdf_overlapping = find_missing_buildings(gdf, csv)
-    gdf_missing = gdf_missing[[x for x in gdf_missing.columns if not x in ['fid', 'code', 'fclass', 'name', 'type']]]
-    grid_ids = list(gdf_missing.tile_name.unique())
-    for id in grid_ids:
-        raster = raster_dir.joinpath(f'DSM_DTM_{id}_m100_10K_Tile.tif')
+    gdf_missing, gdf_overlapping = find_missing_buildings(gdf, zonals)
+    centroids = gdf_missing.centroid
+    xs = centroids.x.values
+    ys = centroids.y.values
+    heights = np.full(len(gdf_missing), np.nan)
+    codes, grid_ids = pd.factorize(gdf_missing.tile_name)
+    order = np.argsort(codes, kind='stable')
+    splits = np.searchsorted(codes[order], np.arange(len(grid_ids) + 1))
+    for i, id in enumerate(grid_ids):
+        raster = raster_path(raster_dir, id)
         if raster.exists():
-            gdf_subset = gdf_missing[gdf_missing.tile_name == id]
-            gdf_missing = gdf_missing[gdf_missing.tile_name != id]
-            coords = [(x,y) for x, y in zip(gdf_subset.centroid.x, gdf_subset.centroid.y)]
-            src = rasterio.open(raster)
-            nodata = src.nodata
-            pixel_samples = [x[0] for x in src.sample(coords)]
-            height_cols = [x for x in gdf_subset.columns if x.startswith('heights')]
-            for col in height_cols:
-                gdf_subset[col] = pixel_samples
-                gdf_subset.loc[gdf_subset[col]==nodata, col] = np.nan
-            gdf_missing = pd.concat([gdf_missing, gdf_subset])
-    df = gdf_missing[[x for x in gdf_missing.columns if not x in ['tile_name','centroid']]]
+            idx = order[splits[i]:splits[i + 1]]
+            heights[idx] = sample_raster_points(raster, xs[idx], ys[idx])
+    df = pd.DataFrame({'osm_id': gdf_missing.osm_id.values})
+    for col in STATS_COLUMNS.values():
+        df[col] = heights
     return df, gdf_overlapping
-
-
-
-
-
-
-
-    
-
-
-
-
-
@@ -0,0 +1,200 @@
+"""Memory bounded processing of a raster in row windows"""
+
+from functools import partial
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Union
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.windows import Window
+
+from .raster_pool import open_raster
+from .utils import codes_to_ids, rasterise_codes, read_heights
+from .zonal_stats import partial_zonal_stats, zonal_stats
+
+# Rough working set per pixel: heights, float labels, masks, sort order and sorted copies
+BYTES_PER_PIXEL = 48
+
+def iter_row_windows(
+    src: rasterio.io.DatasetReader,
+    memory_budget: int) -> Iterator[Window]:
+    """Yields full width row windows aligned to the raster block height that fit in memory_budget
+
+    Args:
+    src: Open raster dataset
+    memory_budget: Bytes allowed for the working set of one window
+
+    Yields:
+    window: Row window of src
+    """
+    block_height = src.block_shapes[0][0]
+    rows = memory_budget // (src.width * BYTES_PER_PIXEL)
+    rows = max(block_height, rows - rows % block_height)
+    for row_off in range(0, src.height, rows):
+        yield Window(0, row_off, src.width, min(rows, src.height - row_off))
+
+
+def get_building_window_ranges(
+    gdf: gpd.GeoDataFrame,
+    transform: rasterio.Affine,
+    window_rows: int) -> np.ndarray:
+    """Returns first and last row window index touched by the bounds of each building
+
+    Args:
+    gdf: Buildings geodataframe
+    transform: Affine transform of the raster
+    window_rows: Number of rows in each window
+
+    Returns:
+    ranges: (n, 2) array of first and last window index per building
+    """
+    bounds = gdf.geometry.bounds
+    first_row = np.floor((bounds.maxy.values - transform.f) / transform.e)
+    last_row = np.floor((bounds.miny.values - transform.f) / transform.e)
+    ranges = np.column_stack([first_row, last_row]) // window_rows
+    return np.clip(ranges, 0, None).astype(np.int64)
+
+
+class WindowedZonalReducer:
+    """Merges per window zonal stats into per building stats
+
+    Buildings that can fall in more than one window have their pixels held back
+    and are summarised once all windows have been added, so every statistic
+    (including the median) is exact.
+    """
+
+    def __init__(
+        self,
+        stats: List[str],
+        spanning_ids: np.ndarray,
+        id_field: str = 'osm_id',
+        summarise: Optional[Callable[[np.ndarray, np.ndarray], pd.DataFrame]] = None):
+        self.stats = stats
+        self.spanning_ids = np.asarray(spanning_ids)
+        self.id_field = id_field
+        self.summarise = summarise or partial(zonal_stats, stats=stats, id_field=id_field)
+        self._frames = []
+        self._held_labels = []
+        self._held_values = []
+
+    def add(self, labels: np.ndarray, values: np.ndarray):
+        """Adds the label and height arrays of one window"""
+        labels = np.ravel(labels)
+        values = np.ravel(values)
+        held = np.isin(labels, self.spanning_ids)
+        if held.any():
+            self._held_labels.append(labels[held])
+            self._held_values.append(values[held])
+            labels = labels[~held]
+            values = values[~held]
+        self._frames.append(self.summarise(labels, values))
+
+    def result(self) -> pd.DataFrame:
+        """Returns DataFrame of statistics for every building seen"""
+        frames = list(self._frames)
+        if self._held_labels:
+            frames.append(self.summarise(
+                np.concatenate(self._held_labels),
+                np.concatenate(self._held_values)))
+        if not frames:
+            return self.summarise(np.empty(0), np.empty(0))
+        df = pd.concat(frames, ignore_index=True)
+        return df.sort_values(self.id_field, ignore_index=True)
+
+
+def get_building_height_stats_windowed(
+    raster: Union[Path, str],
+    gdf: gpd.GeoDataFrame,
+    stats: List[str],
+    memory_budget: int,
+    summarise: Optional[Callable[[np.ndarray, np.ndarray], pd.DataFrame]] = None) -> pd.DataFrame:
+    """Rasterises gdf and calculates zonal statistics one row window at a time
+
+    Building codes are burnt into one uint32 buffer reused for every window.
+
+    Args:
+    raster: Path to raster
+    gdf: gdf of buildings to rasterise
+    stats: stats to calculate (options ['mean', 'min', 'max', 'med'])
+    memory_budget: Bytes allowed for the working set of one window
+    summarise: Function of codes and values returning stats keyed by code (zonal_stats of stats if None)
+
+    Returns:
+    df : DataFrame of statistics (same as get_building_height_stats of the whole raster)
+    """
+    summarise = summarise or partial(zonal_stats, stats=stats, nodata_label=0)
+    with open_raster(raster) as src:
+        windows = list(iter_row_windows(src, memory_budget))
+        window_rows = windows[0].height
+        ranges = get_building_window_ranges(gdf, src.transform, window_rows)
+        spanning = ranges[:, 0] != ranges[:, 1]
+        reducer = WindowedZonalReducer(stats, np.flatnonzero(spanning) + 1, summarise=summarise)
+        buffer = np.zeros((window_rows, src.width), dtype=np.uint32)
+        for index, window in enumerate(windows):
+            in_window = np.flatnonzero((ranges[:, 0] <= index) & (ranges[:, 1] >= index))
+            if not len(in_window):
+                continue
+            heights = read_heights(src, window)
+            # burn positions in the whole gdf so codes are the same in every window
+            codes = rasterise_codes(
+                gdf.iloc[in_window], heights.shape, src.window_transform(window), buffer[:window.height])
+            nonzero = codes > 0
+            codes[nonzero] = in_window[codes[nonzero] - 1] + 1
+            reducer.add(codes, heights)
+    return codes_to_ids(reducer.result(), gdf.osm_id.values)
+
+
+def get_edge_ids(
+    gdf: gpd.GeoDataFrame,
+    bounds: rasterio.coords.BoundingBox) -> np.ndarray:
+    """Returns ids of buildings whose bounds reach or cross bounds (so may have pixels in another tile)
+
+    Args:
+    gdf: Buildings geodataframe
+    bounds: Raster bounds
+
+    Returns:
+    edge_ids: Array of osm_id
+    """
+    building_bounds = gdf.geometry.bounds
+    edge = (
+        (building_bounds.minx.values <= bounds.left)
+        | (building_bounds.miny.values <= bounds.bottom)
+        | (building_bounds.maxx.values >= bounds.right)
+        | (building_bounds.maxy.values >= bounds.top))
+    return gdf.osm_id.values[edge]
+
+
+def get_tile_building_height_partials(
+    raster: Union[Path, str],
+    gdf: gpd.GeoDataFrame,
+    memory_budget: Optional[int] = None,
+    heights: Optional[np.ndarray] = None) -> pd.DataFrame:
+    """Calculates mergeable partial statistics for a raster, in row windows when memory_budget is set
+
+    Buildings reaching the raster edge get a histogram so their median can be
+    merged with the other tiles they fall in (see reduce_partial_stats).
+
+    Args:
+    raster: Path to raster
+    gdf: gdf of buildings to rasterise
+    memory_budget: Bytes allowed for the working set of one window (None reads the whole raster)
+    heights: Whole band already read with read_heights (e.g. prefetched, ignored with memory_budget)
+
+    Returns:
+    df : DataFrame of partial statistics
+    """
+    if gdf.empty:
+        return partial_zonal_stats(np.empty(0, dtype=np.int64), np.empty(0))
+    with open_raster(raster) as src:
+        edge_codes = np.flatnonzero(np.isin(gdf.osm_id.values, get_edge_ids(gdf, src.bounds))) + 1
+        if not memory_budget:
+            if heights is None:
+                heights = read_heights(src)
+            codes = rasterise_codes(gdf, heights.shape, src.transform)
+    summarise = partial(partial_zonal_stats, edge_ids=edge_codes, nodata_label=0)
+    if memory_budget:
+        return get_building_height_stats_windowed(raster, gdf, [], memory_budget, summarise)
+    return codes_to_ids(summarise(codes, heights), gdf.osm_id.values)
@@ -0,0 +1,386 @@
+"""Vectorised zonal statistics over flat label and value arrays"""
+
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+STATS_COLUMNS = {
+    "mean": "heights_mean",
+    "min": "heights_min",
+    "max": "heights_max",
+    "med": "heights_med",
+}
+PARTIAL_COLUMNS = [
+    "heights_count",
+    "heights_sum",
+    "heights_min",
+    "heights_max",
+    "heights_med",
+    "heights_hist_bins",
+    "heights_hist_counts",
+]
+HIST_BIN_WIDTH = 0.1
+
+def _sort_groups(
+    labels: np.ndarray,
+    values: np.ndarray,
+    sort_values: bool,
+    nodata_label: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Drops unlabelled pixels and sorts pixels by label (and by value inside each label)
+
+    Args:
+    labels: Array of zone ids (NaN or nodata_label marks pixels outside a zone)
+    values: Array of values the same size as labels
+    sort_values: Sort values inside each label (NaN values go last), always
+        done for uint32 labels with float32 values as it is then cheapest
+    nodata_label: Label value to ignore for integer label arrays
+
+    Returns:
+    labels: Sorted labels
+    values: Values in label order
+    starts: Index of the first pixel of each label
+    """
+    labels = np.ravel(labels)
+    values = np.ravel(values)
+    if labels.size != values.size:
+        raise ValueError(f'labels ({labels.size}) and values ({values.size}) must be the same size')
+    valid = None
+    if np.issubdtype(labels.dtype, np.floating):
+        valid = ~np.isnan(labels)
+    if nodata_label is not None:
+        not_nodata = labels != nodata_label
+        valid = not_nodata if valid is None else valid & not_nodata
+    if valid is not None and not valid.all():
+        labels = labels[valid]
+        values = values[valid]
+
+    if labels.dtype.kind == 'u' and labels.dtype.itemsize <= 4 and values.dtype == np.float32:
+        labels, values = _packed_sort(labels, values)
+    else:
+        if sort_values:
+            order = np.lexsort((values, labels))
+        else:
+            order = np.argsort(labels, kind='stable')
+        labels = labels[order]
+        values = values[order]
+        del order
+
+    if labels.size:
+        starts = np.flatnonzero(np.concatenate(([True], labels[1:] != labels[:-1])))
+    else:
+        starts = np.empty(0, dtype=np.intp)
+    return labels, values, starts
+
+
+def _packed_sort(
+    labels: np.ndarray,
+    values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Sorts uint32 labels and float32 values (NaN last) as one uint64 key
+
+    The float bits are flipped so their unsigned order is the float order,
+    which lets a single in place sort replace a lexsort and two gathers.
+
+    Args:
+    labels: Unsigned integer labels of at most 32 bits
+    values: float32 values
+
+    Returns:
+    labels: Sorted uint32 labels
+    values: float32 values sorted inside each label
+    """
+    bits = values.view(np.uint32)
+    nan = np.isnan(values)
+    if nan.any():
+        bits = bits.copy()
+        bits[nan] = 0x7fc00000 # positive NaN sorts after +inf
+    key = (bits ^ np.where(bits >> 31, np.uint32(0xffffffff), np.uint32(0x80000000))).astype(np.uint64)
+    key |= labels.astype(np.uint64) << np.uint64(32)
+    key.sort()
+    low = key.astype(np.uint32)
+    bits = np.where(low >> 31, low ^ np.uint32(0x80000000), ~low)
+    return (key >> np.uint64(32)).astype(np.uint32), bits.view(np.float32)
+
+
+def _sorted_medians(
+    values: np.ndarray,
+    starts: np.ndarray,
+    counts: np.ndarray) -> np.ndarray:
+    """Returns median of each group of values sorted with NaN last"""
+    has_values = counts > 0
+    lower = starts + np.maximum(counts - 1, 0) // 2
+    upper = np.where(has_values, starts + counts // 2, starts)
+    med = 0.5 * (values[lower].astype(np.float64) + values[upper])
+    return np.where(has_values, med, np.nan)
+
+
+def zonal_stats(
+    labels: np.ndarray,
+    values: np.ndarray,
+    stats: List[str],
+    id_field: str = 'osm_id',
+    nodata_label: Optional[int] = None) -> pd.DataFrame:
+    """Calculates statistics of values inside each label using one sorted pass
+
+    Pixels are sorted once by label (and by value inside each label when the
+    median is requested) and every statistic is then read off the group
+    boundaries with ufunc reductions, so the arrays are only scanned once.
+
+    Args:
+    labels: Array of zone ids (NaN or nodata_label marks pixels outside a zone)
+    values: Array of values the same size as labels (NaN values are ignored)
+    stats: stats to calculate (options ['mean', 'min', 'max', 'med'])
+    id_field: Name of the id column in the returned dataframe
+    nodata_label: Label value to ignore for integer label arrays
+
+    Returns:
+    df : DataFrame with id_field and heights_* columns (NaN for stats not requested)
+    """
+    labels, values, starts = _sort_groups(labels, values, "med" in stats, nodata_label)
+    df = pd.DataFrame({id_field: labels[starts]})
+    for col in STATS_COLUMNS.values():
+        df[col] = np.nan
+    if not starts.size:
+        return df
+
+    finite = ~np.isnan(values)
+    counts = np.add.reduceat(finite, starts, dtype=np.int64)
+    if "mean" in stats:
+        sums = np.add.reduceat(np.where(finite, values, 0), starts, dtype=np.float64)
+        df[STATS_COLUMNS["mean"]] = np.divide(
+            sums, counts, out=np.full(sums.shape, np.nan), where=counts > 0)
+    if "min" in stats:
+        df[STATS_COLUMNS["min"]] = np.fmin.reduceat(values, starts).astype(np.float64)
+    if "max" in stats:
+        df[STATS_COLUMNS["max"]] = np.fmax.reduceat(values, starts).astype(np.float64)
+    if "med" in stats:
+        df[STATS_COLUMNS["med"]] = _sorted_medians(values, starts, counts)
+    return df
+
+
+def partial_zonal_stats(
+    labels: np.ndarray,
+    values: np.ndarray,
+    edge_ids: Optional[np.ndarray] = None,
+    id_field: str = 'osm_id',
+    nodata_label: Optional[int] = None,
+    bin_width: float = HIST_BIN_WIDTH) -> pd.DataFrame:
+    """Calculates mergeable partial statistics of values inside each label
+
+    Every label gets its count, sum, min, max and exact median. Labels in
+    edge_ids (zones that continue outside these arrays) also get a sparse
+    histogram of their values with bins of bin_width, used by
+    reduce_partial_stats to merge medians across tiles.
+
+    Args:
+    labels: Array of zone ids (NaN or nodata_label marks pixels outside a zone)
+    values: Array of values the same size as labels (NaN values are ignored)
+    edge_ids: Zone ids that may also have pixels in another tile
+    id_field: Name of the id column in the returned dataframe
+    nodata_label: Label value to ignore for integer label arrays
+    bin_width: Width of histogram bins
+
+    Returns:
+    df : DataFrame with id_field and PARTIAL_COLUMNS
+    """
+    labels, values, starts = _sort_groups(labels, values, True, nodata_label)
+    df = pd.DataFrame({id_field: labels[starts]})
+    if not starts.size:
+        for col in PARTIAL_COLUMNS:
+            df[col] = pd.Series(dtype=np.int64 if col == "heights_count" else object if 'hist' in col else np.float64)
+        return df
+
+    finite = ~np.isnan(values)
+    counts = np.add.reduceat(finite, starts, dtype=np.int64)
+    df["heights_count"] = counts
+    df["heights_sum"] = np.add.reduceat(np.where(finite, values, 0), starts, dtype=np.float64)
+    df["heights_min"] = np.fmin.reduceat(values, starts).astype(np.float64)
+    df["heights_max"] = np.fmax.reduceat(values, starts).astype(np.float64)
+    df["heights_med"] = _sorted_medians(values, starts, counts)
+
+    hist_bins = np.full(len(df), None, dtype=object)
+    hist_counts = np.full(len(df), None, dtype=object)
+    if edge_ids is not None and len(edge_ids):
+        groups = np.flatnonzero(np.isin(df[id_field].values, edge_ids) & (counts > 0))
+        for group in groups:
+            # values are sorted so equal bins are contiguous
+            group_values = values[starts[group]:starts[group] + counts[group]]
+            bins, bin_counts = np.unique(np.floor(group_values / bin_width).astype(np.int32), return_counts=True)
+            hist_bins[group] = bins
+            hist_counts[group] = bin_counts.astype(np.int32)
+    df["heights_hist_bins"] = hist_bins
+    df["heights_hist_counts"] = hist_counts
+    return df
+
+
+def partials_from_stats(
+    df: pd.DataFrame,
+    column: str = "heights_mean") -> pd.DataFrame:
+    """Returns partial statistics for rows that each hold a single sampled value
+
+    Args:
+    df: DataFrame of sampled values (e.g. missing building samples)
+    column: Column holding the sampled value
+
+    Returns:
+    df : DataFrame with the id column and PARTIAL_COLUMNS
+    """
+    values = df[column].values.astype(np.float64)
+    partials = df[[x for x in df.columns if not x.startswith('heights')]].copy()
+    partials["heights_count"] = (~np.isnan(values)).astype(np.int64)
+    partials["heights_sum"] = np.nan_to_num(values)
+    partials["heights_min"] = values
+    partials["heights_max"] = values
+    partials["heights_med"] = values
+    partials["heights_hist_bins"] = None
+    partials["heights_hist_counts"] = None
+    return partials
+
+
+def reduce_partial_stats(
+    df: pd.DataFrame,
+    stats: List[str],
+    id_field: str = 'osm_id',
+    bin_width: float = HIST_BIN_WIDTH) -> pd.DataFrame:
+    """Merges partial statistics of the same id into final statistics
+
+    Mean, min and max are exact. The median is exact for ids with a single
+    partial row and is read from the merged histograms otherwise, so it is
+    within bin_width / 2 of the exact median. Rows without a histogram count
+    as their median repeated count times.
+
+    Args:
+    df: DataFrame of partial statistics (see partial_zonal_stats)
+    stats: stats to return (options ['mean', 'min', 'max', 'med'])
+    id_field: Name of the id column
+    bin_width: Width of histogram bins used for the partials
+
+    Returns:
+    df : DataFrame indexed by id_field with heights_* columns (NaN for stats not requested)
+    """
+    grouped = df.groupby(id_field, sort=True)
+    final_df = grouped.agg(
+        heights_count=("heights_count", "sum"),
+        heights_sum=("heights_sum", "sum"),
+        heights_min=("heights_min", "min"),
+        heights_max=("heights_max", "max"),
+        heights_med=("heights_med", "first"),
+        n_partials=("heights_count", "size"))
+    counts = final_df.heights_count.values
+    final_df["heights_mean"] = np.divide(
+        final_df.heights_sum.values, counts,
+        out=np.full(len(final_df), np.nan), where=counts > 0)
+
+    split = final_df.index[final_df.n_partials.values > 1]
+    if len(split) and "med" in stats:
+        final_df.loc[split, "heights_med"] = _histogram_medians(
+            df[df[id_field].isin(split)], id_field, bin_width).reindex(split).values
+        final_df["heights_med"] = final_df.heights_med.clip(final_df.heights_min, final_df.heights_max)
+
+    final_df = final_df[list(STATS_COLUMNS.values())].copy()
+    for stat, col in STATS_COLUMNS.items():
+        if stat not in stats:
+            final_df[col] = np.nan
+    return final_df
+
+
+def merge_partial_stats(
+    df: pd.DataFrame,
+    edge_ids: Optional[np.ndarray] = None,
+    id_field: str = 'osm_id',
+    bin_width: float = HIST_BIN_WIDTH) -> pd.DataFrame:
+    """Merges partial statistics of the same id into one partial row per id
+
+    Unlike reduce_partial_stats the result can be merged again, so partials
+    can be combined in a tree. Ids with several rows get their merged
+    histogram and its median (within bin_width / 2 of the exact median).
+
+    Args:
+    df: DataFrame of partial statistics (see partial_zonal_stats)
+    edge_ids: Ids to keep histograms for (all ids if None)
+    id_field: Name of the id column
+    bin_width: Width of histogram bins used for the partials
+
+    Returns:
+    df : DataFrame with id_field and PARTIAL_COLUMNS, one row per id
+    """
+    merged = df.groupby(id_field, sort=True).agg(
+        heights_count=("heights_count", "sum"),
+        heights_sum=("heights_sum", "sum"),
+        heights_min=("heights_min", "min"),
+        heights_max=("heights_max", "max"),
+        heights_med=("heights_med", "first"),
+        heights_hist_bins=("heights_hist_bins", "first"),
+        heights_hist_counts=("heights_hist_counts", "first"),
+        n_partials=("heights_count", "size"))
+
+    split = merged.index[merged.n_partials.values > 1]
+    if len(split):
+        long = _merged_histograms(df[df[id_field].isin(split)], id_field, bin_width)
+        merged.loc[split, "heights_med"] = _long_medians(long, id_field, bin_width).reindex(split).values
+        merged["heights_med"] = merged.heights_med.clip(merged.heights_min, merged.heights_max)
+        ids = long[id_field].values
+        starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+        bins = np.split(long.bin.values.astype(np.int32), starts[1:])
+        bin_counts = np.split(long['count'].values.astype(np.int32), starts[1:])
+        rows = merged.index.get_indexer(ids[starts])
+        hist_bins = merged.heights_hist_bins.values.copy()
+        hist_counts = merged.heights_hist_counts.values.copy()
+        for row, row_bins, row_counts in zip(rows, bins, bin_counts):
+            hist_bins[row] = row_bins
+            hist_counts[row] = row_counts
+        merged["heights_hist_bins"] = hist_bins
+        merged["heights_hist_counts"] = hist_counts
+    if edge_ids is not None:
+        interior = ~np.isin(merged.index.values, edge_ids)
+        merged.loc[interior, ["heights_hist_bins", "heights_hist_counts"]] = None
+    return merged[PARTIAL_COLUMNS].reset_index()
+
+
+def _histogram_medians(
+    df: pd.DataFrame,
+    id_field: str,
+    bin_width: float) -> pd.Series:
+    """Returns median of each id from the merged histograms of its partial rows"""
+    return _long_medians(_merged_histograms(df, id_field, bin_width), id_field, bin_width)
+
+
+def _merged_histograms(
+    df: pd.DataFrame,
+    id_field: str,
+    bin_width: float) -> pd.DataFrame:
+    """Returns summed histogram counts of each id and bin sorted by id and bin
+
+    Rows without a histogram count as their median repeated count times.
+    """
+    has_hist = df.heights_hist_bins.notna().values
+    hist = df[has_hist]
+    lengths = np.array([len(x) for x in hist.heights_hist_bins], dtype=np.int64)
+    ids = [np.repeat(hist[id_field].values, lengths)]
+    bins = [np.concatenate(hist.heights_hist_bins.values).astype(np.int64) if len(hist) else np.empty(0, np.int64)]
+    bin_counts = [np.concatenate(hist.heights_hist_counts.values).astype(np.int64) if len(hist) else np.empty(0, np.int64)]
+    points = df[~has_hist & (df.heights_count.values > 0)]
+    ids.append(points[id_field].values)
+    bins.append(np.floor(points.heights_med.values / bin_width).astype(np.int64))
+    bin_counts.append(points.heights_count.values.astype(np.int64))
+    long = pd.DataFrame({
+        id_field: np.concatenate(ids),
+        'bin': np.concatenate(bins),
+        'count': np.concatenate(bin_counts)})
+    return long.groupby([id_field, 'bin'], sort=True)['count'].sum().reset_index()
+
+
+def _long_medians(
+    long: pd.DataFrame,
+    id_field: str,
+    bin_width: float) -> pd.Series:
+    """Returns median of each id from histogram counts sorted by id and bin"""
+    cumulative = long.groupby(id_field)['count'].cumsum().values
+    totals = long.groupby(id_field)['count'].transform('sum').values
+    lower = cumulative >= (totals + 1) // 2
+    upper = cumulative >= totals // 2 + 1
+    long = long.assign(
+        lower=np.where(lower, long.bin.values, np.iinfo(np.int64).max),
+        upper=np.where(upper, long.bin.values, np.iinfo(np.int64).max))
+    med_bins = long.groupby(id_field)[['lower', 'upper']].min()
+    return (0.5 * (med_bins.lower + med_bins.upper) + 0.5) * bin_width
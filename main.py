@@ -1,5 +1,6 @@
 from pathlib import Path 
 from datetime import datetime
+import logging
 
 import building_zonals as bz
 
@@ -30,6 +31,7 @@ def main():
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
     start = datetime.now()
     main()
     finish = datetime.now()
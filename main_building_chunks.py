@@ -1,31 +1,38 @@
 """Chunk buildings into tiles and move rasters to same dir and process"""
 
+import argparse
 from pathlib import Path
 import building_zonals as bz
 import pandas as pd
-import geopandas as gpd
 import logging
-from datetime import datetime
-import fiona
 
 BASE = Path(__file__).resolve().parent
 GPKG = Path(r'C:\Users\dkerr\Documents\GISRede\buildings\UK\London\data\building_heights_tiles\buildings_subset.gpkg').resolve()
 DATA_DIR = GPKG.parent.joinpath('rasters')
 building_shp = DATA_DIR.joinpath('gis_osm_buildings_a_free_1.shp')
 
-logging.basicConfig(filename=BASE.joinpath('logs.log'), level=logging.INFO)
+STATS = ['mean', 'min', 'max', 'med']
 
-def main():
-    logging.info(f'START CHUNKING - {datetime.now()}')
-    chunk_buildings_and_move_rasters()
-    logging.info(f'FINISED CHUNKING  - {datetime.now()}')
-    for index, tile in enumerate(DATA_DIR.joinpath('tiles').iterdir()):
+def main(lookup_index=False, raster_cache=None):
+    with bz.use_raster_cache(raster_cache): # decoded once, reruns read memory mapped bands
+        process_tiles(lookup_index)
+
+def process_tiles(lookup_index=False):
+    with bz.Metrics().stage('chunking') as record:
+        tiles = get_tiles()
+    logging.info(f'Chunking took {record.wall_s:.0f}s')
+    metrics = bz.Metrics(DATA_DIR.joinpath('tiles', bz.METRICS_FILE), total_tiles=len(tiles))
+    ledger = bz.JobLedger(DATA_DIR.joinpath('tiles', bz.LEDGER))
+    manifest = bz.TileManifest(DATA_DIR.joinpath('tiles', bz.MANIFEST))
+    ledger.add(x.name for x in tiles)
+    logging.info(f'Tile jobs: {ledger.counts()}')
+    for index, tile in enumerate(tiles):
         building_gpkg = tile.joinpath(f'{tile.name}.gpkg')
         building_layer = 'buildings_uk'
         building_id_field = 'osm_id'
         building_crs = 27700
-        raster = tile.joinpath(f'DSM_DTM_{tile.name}_m100_10K_Tile.tif')
-        stats = ['mean', 'min', 'max', 'med']
+        raster = bz.raster_path(tile, tile.name)
+        stats = STATS
         output_gpkg = building_gpkg
         output_layer = 'building_heights'
         if raster.exists():
@@ -39,66 +46,73 @@ def main():
                 stats,
                 output_gpkg=output_gpkg,
                 output_layer=output_layer,
-                save_output_gpkg=True
+                save_output_gpkg=True,
+                metrics=metrics,
+                ledger=ledger,
+                manifest=manifest
             )
-            logging.info(f'PROCESSING {tile.name} - {datetime.now()}')
             x.process()
-            logging.info(f'FINISHED PROCESSING {tile.name} - {datetime.now()}')
         else:
-            logging.info(f'RASTER MISSING {raster.name} - {datetime.now()}')
-    logging.info(f'MAKING ZONALS - {datetime.now()}')
-    make_zonals_table()
-    logging.info(f'JOINING EVERYTHING TO GPKG - {datetime.now()}')
-    join_buildings_to_gpkg()
+            logging.info(f'RASTER MISSING {raster.name}')
+    manifest.save()
+    logging.info(f'Tile jobs: {ledger.counts()}')
+    ledger.close()
+    tiles = [x for x in tiles if bz.raster_path(x, x.name).exists()] # outputs of removed rasters are left out
+    with metrics.stage('make_zonals'):
+        metrics.buildings = len(make_zonals_table(tiles))
+    with metrics.stage('join_buildings_to_gpkg'):
+        join_buildings_to_gpkg(tiles)
+    if lookup_index:
+        with metrics.stage('build_lookup_index'):
+            bz.build_lookup_index(GPKG, DATA_DIR.joinpath('lookup'), 'building_heights')
+    metrics.log_summary()
 
-def make_zonals_table():
-    df_list = [pd.read_csv(x.joinpath(f'{x.name}.csv')) for x in DATA_DIR.joinpath('tiles').iterdir()]
-    final_df = pd.concat(df_list)
-    assert len(final_df) > len(final_df.osm_id.unique())
-    final_df = final_df.groupby('osm_id').agg({
-                "heights_mean": ['mean'],
-                "heights_min": ['min'],
-                "heights_max": ['max'],
-                "heights_med": ['median']})
-    assert len(final_df) == len(final_df.reset_index().osm_id.unique())
-    final_df.columns = ["heights_mean", "heights_min", "heights_max", "heights_med"]
-    final_df.to_csv(DATA_DIR.joinpath('tiles/BUILDING_ZONALS.csv'))
+def make_zonals_table(tiles):
+    parquets = [x.joinpath(f'{x.name}.parquet') for x in tiles if x.joinpath(f'{x.name}.parquet').exists()]
+    final_df = pd.concat(bz.reduce_partial_files(parquets, STATS)).sort_index()
+    assert len(final_df) == len(final_df.index.unique())
+    with bz.atomic_path(DATA_DIR.joinpath('tiles/BUILDING_ZONALS.csv')) as tmp:
+        final_df.to_csv(tmp)
+    return final_df
 
-def join_buildings_to_gpkg():
-    gdf = gpd.read_file(GPKG, layer='buildings_uk').set_index('osm_id')
-    logging.info(f'JOINING EVERYTHING TO GPKG (GOT GDF) - {datetime.now()}')
-    df = pd.read_csv(DATA_DIR.joinpath('tiles/BUILDING_ZONALS.csv')).set_index('osm_id')
-    logging.info(f'JOINING EVERYTHING TO GPKG (GOT DF) - {datetime.now()}')
-    gdf = gdf[[x for x in gdf.columns if not x in ["heights_mean", "heights_min", "heights_max", "heights_med"]]]
-    gdf_join = gdf.join(df, how='inner')
-    gdf_join = gdf_join[['name', 'type', 'tile_name', "heights_mean", "heights_min", "heights_max", "heights_med", "geometry"]]
-    logging.info(f'SAVING HEIGHTS - {datetime.now()}')
-    gdf_join.to_file(GPKG, layer='building_heights')
-    logging.info(f'SAVED HEIGHTS - {datetime.now()}')
-    gdf_list = []
-    for tile in DATA_DIR.joinpath('tiles').iterdir():
-        if tile.is_dir():
-            tile_gpkg = tile.joinpath(f'{tile.name}.gpkg')
-            if 'overlapping_buildings' in fiona.listlayers(tile_gpkg):
-                gdf_overlap = gpd.read_file(tile_gpkg, layer='overlapping_buildings')
-                gdf_list.append(gdf_overlap)
-    gdf_overlapping = gpd.GeoDataFrame(pd.concat(gdf_list))
-    logging.info(f'SAVING OVERLAPS - {datetime.now()}')
-    gdf_overlapping.to_file(GPKG, layer="overlapping_buildings")        
+def join_buildings_to_gpkg(tiles):
+    buildings = bz.BuildingTable.read(GPKG, layer='buildings_uk')
+    df = bz.compact_heights(pd.read_csv(DATA_DIR.joinpath('tiles/BUILDING_ZONALS.csv')).set_index('osm_id'))
+    logging.info('Saving heights')
+    bz.write_building_heights(buildings, df, GPKG, 'building_heights')
+    logging.info('Saving overlaps')
+    bz.copy_layers(
+        [(x.joinpath(f'{x.name}.gpkg'), 'overlapping_buildings') for x in tiles],
+        GPKG,
+        'overlapping_buildings')
 
 
-def chunk_buildings_and_move_rasters():
-    out_parent = DATA_DIR.joinpath('tiles')
-    raster_dir = DATA_DIR
-    for cell, tile_name in bz.iterate_grid_cells():
-        if not out_parent.joinpath(tile_name, f'{tile_name}.gpkg').exists():
-            logging.info(f'CHUNKING {tile_name} - {datetime.now()}')
-            gdf_clip = bz.extract_from_buildings(GPKG, 'buildings_uk', cell)
-            bz.save_gpkg_to_folder(gdf_clip, out_parent, raster_dir, tile_name)
-        else:
-            logging.info(f'ALREADY PREPROCESSED {tile_name} - {datetime.now()}')
+def get_tiles():
+    # partitioned again only when the buildings layer changed
+    counts = bz.partition_buildings(
+        GPKG,
+        'buildings_uk',
+        DATA_DIR.joinpath('tiles'),
+        raster_dir=DATA_DIR)
+    return [DATA_DIR.joinpath('tiles', x) for x in counts]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--lookup-index', action='store_true',
+        help='index the results for python -m building_zonals.lookup serve (in DATA_DIR/lookup)')
+    parser.add_argument(
+        '--raster-cache', type=Path, metavar='DIR',
+        help='keep decoded rasters in DIR so reruns skip decompression '
+             '(uncompressed float copies, several times the size of the rasters, never evicted)')
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
-    main()
+    logging.basicConfig(
+        filename=BASE.joinpath('logs.log'),
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(name)s %(message)s')
+    main(**vars(parse_args()))
 
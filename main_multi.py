@@ -1,5 +1,6 @@
 from pathlib import Path 
 from datetime import datetime
+import logging
 
 import building_zonals as bz
 
@@ -32,6 +33,7 @@ def main():
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
     start = datetime.now()
     main()
     finish = datetime.now()
@@ -0,0 +1,52 @@
+"""Shared fixtures building small synthetic rasters and buildings"""
+
+import pytest
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+TILE_NAME = 'TQ38'
+ORIGIN = (530000, 190000)
+SIZE = 200
+
+def make_raster(path, origin=ORIGIN, size=SIZE, seed=0, nodata=-9999.0):
+    """Writes a tiled float32 DSM with a few nodata pixels"""
+    rng = np.random.default_rng(seed)
+    heights = rng.normal(1000, 300, size=(size, size)).astype(np.float32)
+    heights[rng.random((size, size)) < 0.01] = nodata
+    with rasterio.open(
+            path, 'w', driver='GTiff', width=size, height=size, count=1,
+            dtype='float32', crs='EPSG:27700', nodata=nodata,
+            transform=from_origin(*origin, 1, 1),
+            tiled=True, blockxsize=16, blockysize=16) as dst:
+        dst.write(heights, 1)
+    return path
+
+def make_buildings(n=150, origin=ORIGIN, size=SIZE, seed=0, tile_name=TILE_NAME):
+    """Returns gdf of random box buildings, some straddling the raster edge"""
+    rng = np.random.default_rng(seed)
+    x = origin[0] - 10 + rng.random(n) * (size + 20)
+    y = origin[1] - size - 10 + rng.random(n) * (size + 20)
+    w = rng.uniform(0.5, 30, n)
+    h = rng.uniform(0.5, 30, n)
+    return gpd.GeoDataFrame({
+            'osm_id': np.arange(n, dtype=np.int64) + 4_000_000_000,
+            'name': [f'building {i}' for i in range(n)],
+            'type': rng.choice(['house', 'yes', None], n),
+            'tile_name': tile_name},
+        geometry=[box(*b) for b in zip(x, y, x + w, y + h)],
+        crs=27700)
+
+
+@pytest.fixture
+def synthetic_raster(tmp_path):
+    raster_dir = tmp_path.joinpath('rasters')
+    raster_dir.mkdir()
+    yield make_raster(raster_dir.joinpath(f'DSM_DTM_{TILE_NAME}_m100_10K_Tile.tif'))
+
+@pytest.fixture
+def synthetic_buildings():
+    yield make_buildings()
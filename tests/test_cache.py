@@ -0,0 +1,70 @@
+"""Unit tests for cache.py"""
+
+import pandas as pd
+
+import building_zonals
+from .conftest import make_buildings
+
+STATS = ['mean', 'med']
+
+def test_fingerprint_buildings_ignores_row_order(synthetic_buildings):
+    fingerprint = building_zonals.fingerprint_buildings(synthetic_buildings)
+    shuffled = synthetic_buildings.sample(frac=1, random_state=0)
+    assert building_zonals.fingerprint_buildings(shuffled) == fingerprint
+    moved = synthetic_buildings.copy()
+    moved.loc[0, 'geometry'] = moved.loc[0, 'geometry'].buffer(1)
+    assert building_zonals.fingerprint_buildings(moved) != fingerprint
+
+
+def test_tile_fingerprint_reuses_raster_hash(synthetic_raster, synthetic_buildings):
+    fingerprint = building_zonals.tile_fingerprint(synthetic_raster, synthetic_buildings, STATS)
+    previous = dict(fingerprint, raster='recorded')
+    again = building_zonals.tile_fingerprint(synthetic_raster, synthetic_buildings, STATS, previous)
+    assert again['raster'] == 'recorded'
+    assert building_zonals.is_same_tile(again, previous)
+    assert not building_zonals.is_same_tile(again, dict(previous, stats=['mean']))
+
+
+def test_manifest(tmp_path, synthetic_raster, synthetic_buildings):
+    output = tmp_path.joinpath('TQ38.parquet')
+    manifest = building_zonals.TileManifest(tmp_path.joinpath(building_zonals.MANIFEST))
+    fingerprint = building_zonals.tile_fingerprint(synthetic_raster, synthetic_buildings, STATS)
+    manifest.record('TQ38', fingerprint)
+    assert not manifest.is_current('TQ38', fingerprint, output)
+    assert not manifest.path.exists() # saved in batches
+    manifest.save()
+    output.touch()
+    reopened = building_zonals.TileManifest(tmp_path.joinpath(building_zonals.MANIFEST))
+    assert reopened.is_current('TQ38', fingerprint, output)
+    assert not reopened.is_current('TQ48', fingerprint, output)
+
+
+def test_manifest_saves_in_batches(tmp_path, synthetic_raster, synthetic_buildings):
+    manifest = building_zonals.TileManifest(tmp_path.joinpath(building_zonals.MANIFEST), save_every=3)
+    fingerprint = building_zonals.tile_fingerprint(synthetic_raster, synthetic_buildings, STATS)
+    for i in range(4):
+        manifest.record(f'TQ{i}8', fingerprint)
+    reopened = building_zonals.TileManifest(manifest.path)
+    assert sorted(reopened.tiles) == ['TQ08', 'TQ18', 'TQ28']
+    assert manifest.unsaved == 1
+
+
+def test_chunked_tile_recomputes_changed_buildings(tmp_path, synthetic_raster, synthetic_buildings):
+    gpkg = synthetic_raster.parent.joinpath('TQ38.gpkg')
+    synthetic_buildings.to_file(gpkg, layer='buildings_uk')
+    manifest = building_zonals.TileManifest(tmp_path.joinpath(building_zonals.MANIFEST))
+
+    def process():
+        building_zonals.BuildingHeights(
+            None, gpkg, 'buildings_uk', 'osm_id', 27700, synthetic_raster, STATS,
+            output_gpkg=gpkg, manifest=manifest).process()
+        return gpkg.with_suffix('.parquet')
+
+    out_parquet = process()
+    before = pd.read_parquet(out_parquet)
+    mtime = out_parquet.stat().st_mtime_ns
+    assert process().stat().st_mtime_ns == mtime # unchanged tile is skipped
+    make_buildings(seed=5).to_file(gpkg, layer='buildings_uk')
+    after = pd.read_parquet(process())
+    assert out_parquet.stat().st_mtime_ns != mtime
+    assert not before.equals(after)
@@ -0,0 +1,101 @@
+"""Unit tests for engine.py"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import pytest
+
+import pandas as pd
+import rasterio
+from shapely.geometry import Polygon
+
+import building_zonals
+
+STATS = ['mean', 'min', 'max', 'med']
+
+def test_run_tasks_yields_all_results():
+    with ProcessPoolExecutor(max_workers=2) as exec:
+        results = list(building_zonals.run_tasks(exec, pow, [(x, 2) for x in range(10)], 3))
+    assert sorted(results) == [x ** 2 for x in range(10)]
+
+
+def test_run_tasks_raises_worker_errors():
+    with ProcessPoolExecutor(max_workers=2) as exec:
+        with pytest.raises(ZeroDivisionError):
+            list(building_zonals.run_tasks(exec, divmod, [(1, 1), (1, 0), (2, 1)], 1))
+
+
+def test_process_tile(tmp_path, synthetic_raster, synthetic_buildings):
+    gpkg = tmp_path.joinpath('buildings.gpkg')
+    synthetic_buildings.to_file(gpkg, layer='buildings_uk')
+    out_parquet, fingerprint, records = building_zonals.process_tile(
+        synthetic_raster, gpkg, 'buildings_uk', STATS, tmp_path.joinpath('tile.parquet'))
+    df = pd.read_parquet(out_parquet)
+    grid = building_zonals.rasterise_clip(synthetic_raster, synthetic_buildings)
+    expected = building_zonals.get_building_height_stats(grid, STATS)
+    pd.testing.assert_series_equal(df.heights_med, expected.heights_med)
+    assert (df.tile_name == 'TQ38').all()
+    assert df.osm_id.dtype == 'int64'
+    assert [x.stage for x in records][-4:] == ['fingerprint', 'read_raster', 'zonal_stats', 'write_partials']
+    assert records[-2].buildings == records[-5].buildings > 0
+    assert records[-2].pixels == 200 * 200
+    assert records[-1].bytes_written == out_parquet.stat().st_size
+
+
+def test_process_tile_skips_unchanged(tmp_path, synthetic_raster, synthetic_buildings):
+    gpkg = tmp_path.joinpath('buildings.gpkg')
+    synthetic_buildings.to_file(gpkg, layer='buildings_uk')
+    out_parquet, fingerprint, _ = building_zonals.process_tile(
+        synthetic_raster, gpkg, 'buildings_uk', STATS, tmp_path.joinpath('tile.parquet'))
+    mtime = out_parquet.stat().st_mtime_ns
+    _, fingerprint_again, records = building_zonals.process_tile(
+        synthetic_raster, gpkg, 'buildings_uk', STATS, out_parquet, previous=fingerprint)
+    assert fingerprint_again == fingerprint
+    assert [x.stage for x in records][-2:] == ['read_buildings', 'fingerprint']
+    assert out_parquet.stat().st_mtime_ns == mtime
+
+
+def test_process_tile_shared_matches_process_tile(tmp_path, synthetic_raster, synthetic_buildings):
+    gpkg = tmp_path.joinpath('buildings.gpkg')
+    synthetic_buildings.to_file(gpkg, layer='buildings_uk')
+    expected, fingerprint, _ = building_zonals.process_tile(
+        synthetic_raster, gpkg, 'buildings_uk', STATS, tmp_path.joinpath('tile.parquet'))
+    buildings = building_zonals.BuildingTable.read(gpkg, 'buildings_uk')
+    tasks = [
+        (synthetic_raster, buildings, STATS, tmp_path.joinpath(f'shared_{i}.parquet'), budget)
+        for i, budget in enumerate([None, 1 << 16] * 4)]
+    with ThreadPoolExecutor(max_workers=4) as exec:
+        results = list(building_zonals.run_tasks(exec, building_zonals.process_tile_shared, tasks, 8))
+    assert len(results) == 8
+    for out_parquet, fingerprint_shared, records in results:
+        assert fingerprint_shared == fingerprint
+        assert [x.stage for x in records][-2:] == ['zonal_stats', 'write_partials']
+        pd.testing.assert_frame_equal(
+            pd.read_parquet(out_parquet).sort_values('osm_id', ignore_index=True),
+            pd.read_parquet(expected).sort_values('osm_id', ignore_index=True))
+    _, _, records = building_zonals.process_tile_shared(
+        synthetic_raster, buildings, STATS, results[0][0], previous=fingerprint)
+    assert [x.stage for x in records] == ['read_buildings', 'fingerprint']
+
+
+
+def test_engines_select_the_same_buildings(tmp_path, synthetic_raster, synthetic_buildings):
+    # bounds overlap the raster corner but the triangle itself does not
+    corner = Polygon([(529990, 189995), (529999, 190010), (530010, 190010)])
+    gdf = pd.concat([synthetic_buildings, synthetic_buildings.iloc[:1].assign(osm_id=1, geometry=[corner])])
+    gpkg = tmp_path.joinpath('buildings.gpkg')
+    gdf.to_file(gpkg, layer='buildings_uk')
+    out_parquet, fingerprint, _ = building_zonals.process_tile(
+        synthetic_raster, gpkg, 'buildings_uk', STATS, tmp_path.joinpath('tile.parquet'))
+    buildings = building_zonals.BuildingTable.read(gpkg, 'buildings_uk')
+    _, fingerprint_shared, records = building_zonals.process_tile_shared(
+        synthetic_raster, buildings, STATS, out_parquet, previous=fingerprint)
+    assert fingerprint_shared == fingerprint
+    assert [x.stage for x in records] == ['read_buildings', 'fingerprint']
+
+
+@pytest.mark.filterwarnings('error')
+def test_threaded_rasterise_does_not_warn(synthetic_buildings):
+    transform = rasterio.transform.from_origin(530000, 190000, 1, 1)
+    with ThreadPoolExecutor(max_workers=8) as exec:
+        grids = list(exec.map(
+            lambda _: building_zonals.rasterise_codes(synthetic_buildings, (200, 200), transform), range(400)))
+    assert all((x == grids[0]).all() for x in grids)
@@ -0,0 +1,41 @@
+"""Unit tests for grid.py"""
+
+import pytest
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+import building_zonals
+
+
+def test_tile_names_match_grid_gpkg():
+    gdf = gpd.read_file(building_zonals.GRID_GPKG)
+    points = gdf.geometry.representative_point()
+    names = building_zonals.tile_names(points.x.values, points.y.values)
+    np.testing.assert_array_equal(names, gdf.tile_name.values)
+    np.testing.assert_array_equal(building_zonals.tile_bounds(gdf.tile_name), shapely.bounds(gdf.geometry.values))
+
+
+def test_tile_names_edges():
+    names = building_zonals.tile_names([530000, 539999.9, 0, 699999, -1, 700000], [180000, 189999.9, 0, 1299999, 0, 0])
+    assert list(names) == ['TQ38', 'TQ38', 'SV00', 'JM99', None, None]
+    with pytest.raises(ValueError):
+        building_zonals.tile_bounds(['TI38'])
+
+
+def test_bounds_tile_pairs():
+    bounds = np.array([
+        [531000, 181000, 532000, 182000],
+        [539990, 189990, 540010, 190010],
+        [540000, 185000, 541000, 186000],
+        [-10, 5, -5, 10]])
+    rows, names = building_zonals.bounds_tile_pairs(bounds)
+    assert list(rows) == [0, 1, 1, 1, 1, 2, 2]
+    assert list(names) == ['TQ38', 'TQ38', 'TQ48', 'TQ39', 'TQ49', 'TQ38', 'TQ48']
+
+
+def test_raster_path(tmp_path):
+    raster = building_zonals.raster_path(tmp_path, 'TQ38')
+    assert raster.name == 'DSM_DTM_TQ38_m100_10K_Tile.tif'
+    assert building_zonals.raster_tile_name(raster) == 'TQ38'
@@ -0,0 +1,46 @@
+"""Unit tests for instrument.py"""
+
+import json
+import pytest
+
+import building_zonals
+
+def test_stage_records_and_saves(tmp_path):
+    path = tmp_path.joinpath('metrics.jsonl')
+    metrics = building_zonals.Metrics(path, total_tiles=4)
+    with metrics.stage('zonal_stats', 'TQ38', buildings=10) as record:
+        record.pixels = 100
+    metrics.tile_done('TQ38', 10)
+    lines = [json.loads(x) for x in path.read_text().splitlines()]
+    assert len(lines) == 1
+    assert lines[0]['stage'] == 'zonal_stats'
+    assert lines[0]['tile'] == 'TQ38'
+    assert lines[0]['buildings'] == 10
+    assert lines[0]['pixels'] == 100
+    assert lines[0]['wall_s'] >= 0
+    assert metrics.eta() is not None
+    summary = metrics.summary()
+    assert summary['tiles'] == 1
+    assert summary['buildings'] == 10
+    assert summary['stages']['zonal_stats']['count'] == 1
+    assert summary['slowest_tiles'][0][0] == 'TQ38'
+    metrics.buildings = 7 # distinct buildings, once known
+    assert metrics.summary()['buildings'] == 7
+
+
+def test_failed_stage_is_not_recorded():
+    metrics = building_zonals.Metrics()
+    with pytest.raises(ZeroDivisionError):
+        with metrics.stage('broken'):
+            1 / 0
+    assert metrics.records == []
+
+
+def test_add_worker_records(tmp_path):
+    worker = building_zonals.Metrics()
+    with worker.stage('read_buildings', 'TQ38'):
+        pass
+    metrics = building_zonals.Metrics(tmp_path.joinpath('metrics.jsonl'))
+    metrics.add(worker.records)
+    assert metrics.summary()['stages']['read_buildings']['count'] == 1
+    assert len(tmp_path.joinpath('metrics.jsonl').read_text().splitlines()) == 1
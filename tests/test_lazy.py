@@ -0,0 +1,29 @@
+"""Unit tests for lazy.py"""
+
+import pytest
+
+import pandas as pd
+
+import building_zonals
+
+pytest.importorskip('dask')
+
+STATS = ['mean', 'min', 'max', 'med']
+
+@pytest.mark.parametrize('scheduler', ['threads', 'synchronous'])
+def test_lazy_partials_match_whole_tile(synthetic_raster, synthetic_buildings, scheduler):
+    expected = building_zonals.get_tile_building_height_partials(synthetic_raster, synthetic_buildings)
+    df = building_zonals.get_tile_building_height_partials_lazy(
+        synthetic_raster, synthetic_buildings, chunk_size=48, scheduler=scheduler, split_every=3)
+    assert sorted(df.osm_id) == sorted(expected.osm_id)
+    # buildings on the raster edge keep histograms to merge with other tiles
+    assert df.heights_hist_bins.notna().sum() == expected.heights_hist_bins.notna().sum()
+    expected = building_zonals.reduce_partial_stats(expected, STATS)
+    df = building_zonals.reduce_partial_stats(df, STATS)
+    pd.testing.assert_frame_equal(df.drop(columns='heights_med'), expected.drop(columns='heights_med'))
+    assert (df.heights_med - expected.heights_med).abs().max() <= building_zonals.HIST_BIN_WIDTH / 2
+
+
+def test_lazy_partials_empty(synthetic_raster, synthetic_buildings):
+    df = building_zonals.get_tile_building_height_partials_lazy(synthetic_raster, synthetic_buildings.iloc[:0])
+    assert df.empty
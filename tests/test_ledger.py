@@ -0,0 +1,61 @@
+"""Unit tests for ledger.py"""
+
+import pytest
+
+import building_zonals
+
+
+def test_atomic_path_replaces_on_success(tmp_path):
+    path = tmp_path.joinpath('out.csv')
+    path.write_text('old')
+    with building_zonals.atomic_path(path) as tmp:
+        assert tmp.suffix == '.csv' and tmp != path
+        tmp.write_text('new')
+        assert path.read_text() == 'old'
+    assert path.read_text() == 'new'
+    assert [x.name for x in tmp_path.iterdir()] == ['out.csv']
+
+
+def test_atomic_path_leaves_no_partial_file(tmp_path):
+    path = tmp_path.joinpath('out.parquet')
+    with pytest.raises(RuntimeError):
+        with building_zonals.atomic_path(path) as tmp:
+            tmp.write_text('partial')
+            raise RuntimeError('killed')
+    assert not any(tmp_path.iterdir())
+
+
+def test_ledger_states_and_attempts(tmp_path):
+    with building_zonals.JobLedger(tmp_path.joinpath(building_zonals.LEDGER)) as ledger:
+        ledger.add(['SU00', 'SU01', 'SU02'])
+        assert ledger.counts() == {building_zonals.PENDING: 3}
+        ledger.start('SU00')
+        ledger.done('SU00')
+        ledger.start('SU01')
+        ledger.fail('SU01', ValueError('bad raster'))
+        ledger.start('SU01')
+        ledger.fail('SU01', ValueError('bad raster'))
+        ledger.add(['SU00'])
+        assert ledger.is_done('SU00')
+        assert ledger.state('SU01') == building_zonals.FAILED
+        assert ledger.state('XX99') is None
+        assert ledger.unfinished() == ['SU01', 'SU02']
+        assert ledger.unfinished(max_attempts=2) == ['SU02']
+        attempts, wall_s, error = ledger.connection.execute(
+            'SELECT attempts, wall_s, error FROM jobs WHERE name = ?', ('SU01',)).fetchone()
+        assert attempts == 2 and wall_s >= 0 and 'bad raster' in error
+
+
+def test_ledger_survives_crash(tmp_path):
+    path = tmp_path.joinpath(building_zonals.LEDGER)
+    ledger = building_zonals.JobLedger(path)
+    ledger.add(['SU00', 'SU01'])
+    ledger.start('SU00')
+    ledger.done('SU00')
+    ledger.start('SU01')
+    ledger.connection.close() # killed while SU01 was running
+    with building_zonals.JobLedger(path) as ledger:
+        assert ledger.names(building_zonals.RUNNING) == ['SU01']
+        assert ledger.unfinished() == ['SU01']
+        assert ledger.fail_running('lost worker') == ['SU01']
+        assert ledger.counts() == {building_zonals.DONE: 1, building_zonals.FAILED: 1}
@@ -0,0 +1,103 @@
+"""Unit tests for lookup.py"""
+
+import json
+import threading
+from urllib.error import HTTPError
+from urllib.request import urlopen
+import pytest
+
+import numpy as np
+import pandas as pd
+import shapely
+
+import building_zonals
+
+
+@pytest.fixture
+def heights(synthetic_buildings):
+    gdf = synthetic_buildings.sample(frac=1, random_state=0) # ids out of order
+    rng = np.random.default_rng(0)
+    gdf['heights_mean'] = rng.uniform(2, 40, len(gdf))
+    gdf.loc[gdf.index[:5], 'heights_mean'] = np.nan
+    return gdf
+
+
+@pytest.mark.parametrize('suffix', ['gpkg', 'parquet', 'fgb'])
+def test_lookups_match_geodataframe(tmp_path, heights, suffix):
+    path = tmp_path.joinpath(f'out.{suffix}')
+    building_zonals.write_frame(heights, path, 'building_heights')
+    path = building_zonals.layer_path(path, 'building_heights')
+    building_zonals.build_lookup_index(path, tmp_path.joinpath('index'), cell_size=20)
+    lookup = building_zonals.BuildingLookup(tmp_path.joinpath('index'))
+    assert len(lookup) == len(heights) and lookup.spatial
+
+    row = heights.iloc[10]
+    record = lookup.by_id(row.osm_id)
+    assert record['heights_mean'] == pytest.approx(row.heights_mean)
+    assert record['name'] == row['name'] and 'geometry' not in record
+    assert lookup.by_id(1) is None
+    assert lookup.by_id(heights.osm_id.iloc[0])['heights_mean'] is None # NaN as null
+    assert [x['osm_id'] for x in lookup.by_ids([row.osm_id, 1, heights.osm_id.iloc[3]])] == [
+        row.osm_id, heights.osm_id.iloc[3]]
+
+    bounds = (530050, 189880, 530120, 189950)
+    expected = heights.osm_id[heights.geometry.intersects(shapely.box(*bounds))]
+    assert sorted(x['osm_id'] for x in lookup.in_bbox(bounds)) == sorted(expected)
+    assert len(lookup.in_bbox(bounds, limit=2)) == 2
+    everything = lookup.in_bbox((0, 0, 1e7, 1e7)) # too many cells, scans bounds
+    assert len(everything) == len(heights)
+
+    x, y = shapely.get_coordinates(row.geometry.representative_point())[0]
+    expected = heights.osm_id[heights.geometry.intersects(shapely.Point(x, y))]
+    assert sorted(r['osm_id'] for r in lookup.at_point(x, y)) == sorted(expected)
+    assert lookup.at_point(0, 0) == []
+
+
+def test_csv_supports_ids_only(tmp_path, heights):
+    csv = tmp_path.joinpath('BUILDING_ZONALS.csv')
+    pd.DataFrame(heights.drop(columns='geometry')).to_csv(csv, index=False)
+    building_zonals.build_lookup_index(csv, tmp_path.joinpath('index'))
+    lookup = building_zonals.BuildingLookup(tmp_path.joinpath('index'))
+    assert not lookup.spatial
+    assert lookup.by_id(heights.osm_id.iloc[7])['heights_mean'] == pytest.approx(heights.heights_mean.iloc[7])
+    with pytest.raises(ValueError):
+        lookup.at_point(0, 0)
+
+
+def test_incomplete_index_is_not_opened(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        building_zonals.BuildingLookup(tmp_path)
+
+
+def test_http_endpoint(tmp_path, heights):
+    path = tmp_path.joinpath('out.gpkg')
+    building_zonals.write_frame(heights, path, 'building_heights')
+    building_zonals.build_lookup_index(path, tmp_path.joinpath('index'))
+    server = building_zonals.make_lookup_server(building_zonals.BuildingLookup(tmp_path.joinpath('index')), port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}'
+
+    def get(path):
+        with urlopen(url + path) as response:
+            return json.loads(response.read())
+
+    try:
+        row = heights.iloc[10]
+        assert get(f'/buildings/{row.osm_id}')['heights_mean'] == pytest.approx(row.heights_mean)
+        assert len(get(f'/buildings?ids={row.osm_id},1')) == 1
+        assert len(get('/buildings?bbox=0,0,1e7,1e7&limit=3')) == 3
+        x, y = shapely.get_coordinates(row.geometry.representative_point())[0]
+        assert row.osm_id in [r['osm_id'] for r in get(f'/buildings?x={x}&y={y}')]
+        assert get('/health') == {'buildings': len(heights)}
+        bad_requests = [
+            ('/buildings/1', 404), ('/buildings?bbox=1,2', 400), ('/other', 404),
+            ('/buildings/99999999999999999999999', 400), ('/buildings?ids=99999999999999999999999', 400),
+            ('/buildings?bbox=0,0,inf,inf', 400)]
+        for bad, status in bad_requests:
+            with pytest.raises(HTTPError) as error:
+                get(bad)
+            assert error.value.code == status
+            error.value.close()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,90 @@
+"""Unit tests for mosaic.py"""
+
+import json
+import pytest
+
+import pandas as pd
+from shapely.geometry import box
+
+import building_zonals
+from .conftest import make_raster, make_buildings
+
+STATS = ['mean', 'min', 'max', 'med']
+
+#fixtures
+@pytest.fixture
+def raster_dir(tmp_path):
+    raster_dir = tmp_path.joinpath('rasters')
+    raster_dir.mkdir()
+    make_raster(raster_dir.joinpath('DSM_DTM_TQ38_m100_10K_Tile.tif'), seed=1)
+    make_raster(raster_dir.joinpath('DSM_DTM_TQ48_m100_10K_Tile.tif'), origin=(530200, 190000), seed=2)
+    yield raster_dir
+
+@pytest.fixture
+def buildings(tmp_path):
+    gdf = make_buildings(300, size=400, seed=3)
+    gdf.to_file(tmp_path.joinpath('buildings.gpkg'), layer='buildings_uk')
+    yield gdf
+
+
+def test_build_raster_index(raster_dir):
+    raster_index = building_zonals.build_raster_index(raster_dir)
+    assert len(raster_index) == 2
+    assert list(raster_index.total_bounds) == [530000, 189800, 530400, 190000]
+
+
+def test_plan_work_units(raster_dir, buildings):
+    raster_index = building_zonals.build_raster_index(raster_dir)
+    units = building_zonals.plan_work_units(
+        raster_index, building_zonals.BuildingTable.from_geodataframe(buildings), 5000, 40)
+    assert len(units) > 4
+    for unit in units:
+        assert (unit[2] - unit[0]) * (unit[3] - unit[1]) <= 5000 or (unit[2] - unit[0]) < 2
+        assert all(float(x).is_integer() for x in unit)
+    area = sum((x[2] - x[0]) * (x[3] - x[1]) for x in units)
+    assert area <= 400 * 200
+
+
+def test_process_units_match_merged_raster(tmp_path, raster_dir, buildings):
+    raster_index = building_zonals.build_raster_index(raster_dir)
+    units = building_zonals.plan_work_units(
+        raster_index, building_zonals.BuildingTable.from_geodataframe(buildings), 5000, 40)
+    tasks = building_zonals.iter_unit_tasks(
+        raster_index, units, tmp_path.joinpath('buildings.gpkg'), 'buildings_uk', tmp_path)
+    results = []
+    for task in tasks:
+        assert task.rasters and task.out_parquet.parent == tmp_path
+        results.append(building_zonals.process_unit(*task))
+    paths = [x for x, _ in results]
+    assert sum(records[0].buildings for _, records in results) >= len(buildings.cx[530000:530400, 189800:190000])
+    assert all(records[0].stage == 'process_unit' and records[0].pixels for _, records in results)
+    df = building_zonals.reduce_partial_stats(building_zonals.merge_zonals(paths), STATS)
+
+    heights, transform = building_zonals.read_mosaic_window(list(raster_index.path), tuple(raster_index.total_bounds))
+    codes = building_zonals.rasterise_codes(buildings, heights.shape, transform)
+    expected = building_zonals.zonal_stats(codes, heights, STATS, nodata_label=0)
+    expected = expected.set_index(buildings.osm_id.values[expected.osm_id.values - 1])
+    expected = expected[expected.heights_mean.notna()].drop(columns='osm_id')
+    df = df.loc[expected.index]
+    pd.testing.assert_frame_equal(df.drop(columns='heights_med'), expected.drop(columns='heights_med'), check_names=False)
+    assert (df.heights_med - expected.heights_med).abs().max() <= building_zonals.HIST_BIN_WIDTH / 2
+
+
+def test_sample_missing_buildings_from_index(raster_dir, buildings):
+    raster_index = building_zonals.build_raster_index(raster_dir)
+    zonals = pd.DataFrame({'osm_id': buildings.osm_id.values[:250]})
+    df, gdf_overlapping = building_zonals.sample_missing_buildings_from_index(buildings, zonals, raster_index)
+    assert set(df.osm_id).isdisjoint(zonals.osm_id)
+    covered = buildings.centroid.intersects(box(*raster_index.total_bounds))
+    assert len(df) + len(gdf_overlapping) == covered.values[250:].sum()
+
+
+def test_parallel_units_are_recorded(tmp_path, raster_dir, buildings):
+    building_zonals.BuildingHeightsMosaic(
+        None, tmp_path.joinpath('buildings.gpkg'), 'buildings_uk', 'osm_id', 27700, raster_dir, STATS,
+        output_gpkg=tmp_path.joinpath('out.gpkg'), save_output_gpkg=False,
+        n_workers=2, memory_budget=4 * 5000, max_buildings=40)
+    lines = raster_dir.joinpath('tmp', building_zonals.METRICS_FILE).read_text().splitlines()
+    units = [x for x in map(json.loads, lines) if x['stage'] == 'process_unit']
+    assert len(units) == len(list(raster_dir.joinpath('tmp', 'units').glob('unit_*.parquet'))) > 1
+    assert all(x['buildings'] and x['pixels'] for x in units)
@@ -0,0 +1,74 @@
+"""Unit tests for output.py"""
+
+import pytest
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+import building_zonals
+
+COLUMNS = ['osm_id', 'name', 'type', 'tile_name', 'heights_mean', 'heights_min', 'heights_max', 'heights_med', 'geometry']
+
+#fixtures
+@pytest.fixture
+def gpkg(tmp_path, synthetic_buildings):
+    gpkg = tmp_path.joinpath('buildings.gpkg')
+    synthetic_buildings.to_file(gpkg, layer='buildings_uk')
+    yield gpkg
+
+@pytest.fixture
+def final_df(synthetic_buildings):
+    ids = synthetic_buildings.osm_id.values[::2]
+    yield pd.DataFrame({
+            'heights_mean': np.arange(len(ids), dtype=np.float64),
+            'heights_min': 0.0,
+            'heights_max': 1.0,
+            'heights_med': 0.5},
+        index=pd.Index(ids, name='osm_id'))
+
+
+def test_layer_path(tmp_path):
+    assert building_zonals.layer_path(tmp_path.joinpath('out.gpkg'), 'x') == tmp_path.joinpath('out.gpkg')
+    assert building_zonals.layer_path(tmp_path.joinpath('out.fgb'), 'x') == tmp_path.joinpath('out_x.fgb')
+    with pytest.raises(ValueError):
+        building_zonals.get_driver('out.shp')
+
+
+@pytest.mark.parametrize('suffix', ['.gpkg', '.parquet', '.fgb'])
+def test_write_building_heights(tmp_path, gpkg, final_df, synthetic_buildings, suffix):
+    buildings = building_zonals.BuildingTable.read(gpkg, 'buildings_uk')
+    path = gpkg if suffix == '.gpkg' else tmp_path.joinpath(f'out{suffix}')
+    n = building_zonals.write_building_heights(buildings, final_df, path, 'building_heights', batch_size=16)
+    assert n == len(final_df)
+    gdf = gpd.read_parquet(path) if suffix == '.parquet' else gpd.read_file(path, layer='building_heights')
+    gdf = gdf.sort_values('osm_id', ignore_index=True) # FlatGeobuf writes in spatial index order
+    assert list(gdf.columns) == COLUMNS
+    np.testing.assert_array_equal(gdf.osm_id.values, final_df.index.values)
+    np.testing.assert_array_equal(gdf.heights_mean.values, final_df.heights_mean.values)
+    assert gdf.geometry.geom_equals(synthetic_buildings.geometry[::2].reset_index(drop=True)).all()
+    assert gdf.crs == synthetic_buildings.crs
+    if suffix == '.gpkg':
+        assert len(gpd.read_file(gpkg, layer='buildings_uk')) == len(synthetic_buildings)
+
+
+def test_copy_layers(tmp_path, synthetic_buildings):
+    sources = []
+    for i, gdf in enumerate([synthetic_buildings[:100], synthetic_buildings[100:]]):
+        path = tmp_path.joinpath(f'tile_{i}.gpkg')
+        gdf.to_file(path, layer='overlapping_buildings')
+        sources.append((path, 'overlapping_buildings'))
+    sources.append((tmp_path.joinpath('missing.gpkg'), 'overlapping_buildings'))
+    out = tmp_path.joinpath('out.gpkg')
+    assert building_zonals.copy_layers(sources, out, 'overlapping_buildings', batch_size=32) == len(synthetic_buildings)
+    gdf = gpd.read_file(out, layer='overlapping_buildings')
+    np.testing.assert_array_equal(gdf.osm_id.values, synthetic_buildings.osm_id.values)
+    assert gdf.crs == synthetic_buildings.crs
+
+
+def test_write_frame(tmp_path, synthetic_buildings):
+    out = tmp_path.joinpath('out.fgb')
+    assert building_zonals.write_frame(synthetic_buildings[:0], out, 'overlapping_buildings') == 0
+    assert building_zonals.write_frame(synthetic_buildings, out, 'overlapping_buildings') == len(synthetic_buildings)
+    gdf = gpd.read_file(tmp_path.joinpath('out_overlapping_buildings.fgb'))
+    assert len(gdf) == len(synthetic_buildings)
@@ -0,0 +1,75 @@
+"""Unit tests for partition.py"""
+
+import pytest
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+import building_zonals
+from .conftest import make_buildings
+
+
+#fixtures
+@pytest.fixture
+def gpkg(tmp_path):
+    gdf = pd.concat([
+        make_buildings(150, origin=(539900, 190100), seed=1, tile_name='TQ38'),
+        make_buildings(150, origin=(540000, 190100), seed=2, tile_name='TQ48').assign(osm_id=lambda x: x.osm_id + 1000)],
+        ignore_index=True)
+    gpkg = tmp_path.joinpath('buildings.gpkg')
+    gdf.to_file(gpkg, layer='buildings_uk')
+    yield gpkg
+
+
+@pytest.mark.parametrize('batch_size, buffer_rows', [(64, 100), (1000, 10000)])
+def test_partition_by_grid_matches_bbox_reads(tmp_path, gpkg, batch_size, buffer_rows):
+    raster_dir = tmp_path.joinpath('rasters')
+    raster_dir.mkdir()
+    raster = raster_dir.joinpath('DSM_DTM_TQ38_m100_10K_Tile.tif')
+    raster.write_bytes(b'tif')
+    out_parent = tmp_path.joinpath('tiles')
+    counts = building_zonals.partition_buildings(
+        gpkg, 'buildings_uk', out_parent, raster_dir=raster_dir, batch_size=batch_size, buffer_rows=buffer_rows)
+    assert list(counts) == ['TQ38', 'TQ39', 'TQ48', 'TQ49']
+    for tile_name, bounds in zip(counts, building_zonals.tile_bounds(counts)):
+        expected = gpd.read_file(gpkg, layer='buildings_uk', bbox=tuple(bounds))
+        gdf = gpd.read_file(out_parent.joinpath(tile_name, f'{tile_name}.gpkg'), layer='buildings_uk')
+        assert counts[tile_name] == len(gdf)
+        assert sorted(gdf.osm_id) == sorted(expected.osm_id)
+        assert (np.diff(gdf.osm_id.values) > 0).all()
+    assert raster.exists()
+    assert out_parent.joinpath('TQ38', raster.name).read_bytes() == b'tif'
+    assert not out_parent.joinpath('TQ48', 'DSM_DTM_TQ48_m100_10K_Tile.tif').exists()
+    assert building_zonals.partition_buildings(gpkg, 'buildings_uk', out_parent) == counts
+
+
+def test_partition_by_tile_name(tmp_path, gpkg):
+    counts = building_zonals.partition_buildings(
+        gpkg, 'buildings_uk', tmp_path.joinpath('tiles'), by_grid=False, batch_size=100)
+    assert counts == {'TQ38': 150, 'TQ48': 150}
+    counts = building_zonals.partition_buildings(
+        gpkg, 'buildings_uk', tmp_path.joinpath('tiles_48'), by_grid=False, tiles=['TQ48'])
+    assert counts == {'TQ48': 150}
+    gdf = gpd.read_file(tmp_path.joinpath('tiles', 'TQ48', 'TQ48.gpkg'), layer='buildings_uk')
+    assert (gdf.tile_name == 'TQ48').all()
+    assert gdf.crs == 27700
+
+
+def test_partition_repeats_when_buildings_change(tmp_path, gpkg):
+    raster_dir = tmp_path.joinpath('rasters')
+    raster_dir.mkdir()
+    raster = raster_dir.joinpath('DSM_DTM_TQ38_m100_10K_Tile.tif')
+    raster.write_bytes(b'tif')
+    out_parent = tmp_path.joinpath('tiles')
+    counts = building_zonals.partition_buildings(gpkg, 'buildings_uk', out_parent, by_grid=False, raster_dir=raster_dir)
+    gdf = gpd.read_file(gpkg, layer='buildings_uk')
+    gdf.iloc[:10].to_file(gpkg, layer='building_heights') # outputs in other layers do not count
+    assert building_zonals.partition_buildings(gpkg, 'buildings_uk', out_parent, by_grid=False) == counts
+
+    gdf.iloc[:200].to_file(gpkg, layer='buildings_uk')
+    raster.unlink()
+    counts = building_zonals.partition_buildings(gpkg, 'buildings_uk', out_parent, by_grid=False, raster_dir=raster_dir)
+    assert counts == {'TQ38': 150, 'TQ48': 50}
+    assert len(gpd.read_file(out_parent.joinpath('TQ48', 'TQ48.gpkg'), layer='buildings_uk')) == 50
+    assert not out_parent.joinpath('TQ38', raster.name).exists()
@@ -0,0 +1,65 @@
+"""Unit tests for pipeline.py"""
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import pytest
+
+import pandas as pd
+
+import building_zonals
+
+
+def test_prefetch_keeps_order_and_depth():
+    started = []
+    lock = threading.Lock()
+
+    def load(x):
+        with lock:
+            started.append(x)
+        return x * 10
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        results = []
+        for item, future in building_zonals.prefetch(executor, load, range(6), depth=2):
+            results.append((item, future.result()))
+            assert len(started) <= item + 3 # never more than depth ahead
+    assert results == [(x, x * 10) for x in range(6)]
+
+
+def test_prefetch_errors_belong_to_their_item():
+    def load(x):
+        if x == 1:
+            raise ValueError('bad tile')
+        return x
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        futures = dict(building_zonals.prefetch(executor, load, range(3)))
+        assert futures[0].result() == 0
+        with pytest.raises(ValueError):
+            futures[1].result()
+        assert futures[2].result() == 2
+
+
+def test_load_tile_matches_direct_read(synthetic_raster, synthetic_buildings, tmp_path):
+    buildings = building_zonals.BuildingTable.from_geodataframe(synthetic_buildings)
+    out_parquet = tmp_path.joinpath('tile.parquet')
+    tile = building_zonals.load_tile(synthetic_raster, buildings, ['mean'], out_parquet)
+    assert not tile.current
+    assert {x.stage for x in tile.records} == {'read_buildings', 'fingerprint', 'read_raster'}
+    expected = building_zonals.get_tile_building_height_partials(synthetic_raster, tile.gdf)
+    df = building_zonals.get_tile_building_height_partials(synthetic_raster, tile.gdf, heights=tile.heights)
+    pd.testing.assert_frame_equal(df, expected)
+
+    building_zonals.write_tile(df, out_parquet, tile.fingerprint, len(tile.gdf))
+    again = building_zonals.load_tile(synthetic_raster, buildings, ['mean'], out_parquet, tile.fingerprint)
+    assert again.current and again.heights is None
+    windowed = building_zonals.load_tile(synthetic_raster, buildings, ['mean'], out_parquet, read_raster=False)
+    assert windowed.heights is None
+
+
+def test_write_tile(tmp_path):
+    df = building_zonals.partials_from_stats(pd.DataFrame({'osm_id': [1, 2], 'heights_mean': [1.0, 2.0]}))
+    out_parquet, fingerprint, records = building_zonals.write_tile(df, tmp_path.joinpath('tile.parquet'), {'a': 1}, 2)
+    assert out_parquet.exists() and fingerprint == {'a': 1}
+    assert records[0].stage == 'write_partials' and records[0].buildings == 2
+    assert records[0].bytes_written == out_parquet.stat().st_size
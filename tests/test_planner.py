@@ -0,0 +1,96 @@
+"""Unit tests for planner.py"""
+
+from pathlib import Path
+import pytest
+
+import pandas as pd
+
+import building_zonals
+from .conftest import make_buildings, make_raster
+
+
+def make_tiles(raster_dir):
+    """Writes a dense and a sparse raster next to each other with their buildings"""
+    raster_dir.mkdir()
+    dense = make_raster(raster_dir.joinpath('DSM_DTM_TQ38_m100_10K_Tile.tif'), origin=(530000, 190000))
+    sparse = make_raster(raster_dir.joinpath('DSM_DTM_TQ48_m100_10K_Tile.tif'), origin=(540000, 190000))
+    gdf = make_buildings(n=400, origin=(530000, 190000))
+    gdf = pd.concat([gdf, make_buildings(n=20, origin=(540000, 190000), seed=1)], ignore_index=True)
+    gdf['osm_id'] = range(len(gdf))
+    return dense, sparse, building_zonals.BuildingTable.from_geodataframe(gdf), gdf
+
+
+def cost(tile, seconds, memory_mb=10.0):
+    return building_zonals.TileCost(tile, Path(f'{tile}.tif'), 0, 0, 0, seconds, memory_mb)
+
+
+def test_estimate_ranks_dense_tiles_first(tmp_path):
+    dense, sparse, buildings, _ = make_tiles(tmp_path.joinpath('rasters'))
+    costs = building_zonals.estimate_tile_costs([sparse, dense], buildings)
+    assert [x.tile for x in costs] == [sparse.stem, dense.stem]
+    assert costs[1].buildings > costs[0].buildings
+    assert costs[1].seconds > costs[0].seconds
+    plan = building_zonals.plan_tiles(costs, n_workers=2)
+    assert plan.rasters == [dense, sparse]
+
+
+def test_estimate_uses_timings_and_scales_the_rest(tmp_path):
+    dense, sparse, buildings, _ = make_tiles(tmp_path.joinpath('rasters'))
+    model = building_zonals.CostModel()
+    estimated = building_zonals.estimate_tile_costs([dense, sparse], buildings, model=model)
+    timings = {dense.stem: estimated[0].seconds * 10}
+    costs = building_zonals.estimate_tile_costs([dense, sparse], buildings, timings, model=model)
+    assert costs[0].measured and costs[0].seconds == timings[dense.stem]
+    assert costs[1].seconds == pytest.approx(estimated[1].seconds * 10)
+    cached = building_zonals.estimate_tile_costs([dense, sparse], buildings, timings, cached=[dense.stem])
+    assert cached[0].seconds == model.overhead_s
+
+
+def test_memory_budget_caps_working_set(tmp_path):
+    dense, _, buildings, _ = make_tiles(tmp_path.joinpath('rasters'))
+    whole = building_zonals.estimate_tile_costs([dense], buildings)[0]
+    windowed = building_zonals.estimate_tile_costs([dense], buildings, memory_budget=1024)[0]
+    assert windowed.memory_mb < whole.memory_mb
+
+
+def test_lpt_cuts_the_tail():
+    costs = [cost('a', 1), cost('b', 1), cost('c', 1), cost('d', 1), cost('e', 4)]
+    plan = building_zonals.plan_tiles(costs, n_workers=2)
+    assert [x.tile for x in plan.tiles] == ['e', 'a', 'b', 'c', 'd']
+    assert plan.wall_s == 4
+    assert plan.unordered_wall_s == 6
+    assert plan.serial_s == 8
+    assert plan.starts['e'] == 0 and plan.starts['d'] == 3
+
+
+def test_peak_memory_counts_concurrent_tiles():
+    costs = [cost('a', 2, 100), cost('b', 1, 50), cost('c', 1, 30)]
+    plan = building_zonals.simulate_schedule(costs, n_workers=2, base_memory_mb=5, worker_mb=10)
+    # a and b run together, c replaces b as it finishes
+    assert plan.peak_memory_mb == pytest.approx(5 + 2 * 10 + 90 + 40)
+    assert plan.wall_s == 2
+
+
+def test_load_tile_timings(tmp_path):
+    path = tmp_path.joinpath(building_zonals.METRICS_FILE)
+    for run, computed in [('2026-01-01T00:00:00', True), ('2026-01-02T00:00:00', True), ('2026-01-03T00:00:00', False)]:
+        metrics = building_zonals.Metrics(path)
+        metrics.run_id = run
+        stages = ['read_buildings', 'zonal_stats'] if computed else ['read_buildings']
+        metrics.add([building_zonals.StageRecord(x, 'TQ38', wall_s=float(run[9])) for x in stages])
+        metrics.add([building_zonals.StageRecord('merge_tiles', wall_s=100.0)])
+    assert building_zonals.load_tile_timings(path) == {'TQ38': 4.0}
+    assert building_zonals.load_tile_timings(tmp_path.joinpath('missing.jsonl')) == {}
+
+
+def test_multi_dry_run_writes_no_tiles(tmp_path):
+    dense, sparse, _, gdf = make_tiles(tmp_path.joinpath('rasters'))
+    gpkg = tmp_path.joinpath('buildings.gpkg')
+    gdf.to_file(gpkg, layer='buildings')
+    x = building_zonals.BuildingHeightsMulti(
+        None, gpkg, 'buildings', 'osm_id', 27700, dense.parent, ['mean'],
+        output_gpkg=tmp_path.joinpath('out.gpkg'), n_workers=2, dry_run=True)
+    assert x.plan.rasters == [dense, sparse]
+    assert x.plan.wall_s <= x.plan.serial_s
+    assert not list(dense.parent.joinpath('tmp').glob('*.parquet'))
+    assert not tmp_path.joinpath('out.gpkg').exists()
@@ -0,0 +1,66 @@
+"""Unit tests for raster_pool.py"""
+
+import os
+import threading
+
+import rasterio
+
+import building_zonals
+from .conftest import make_raster
+
+
+def test_pool_reuses_and_evicts(tmp_path):
+    rasters = [make_raster(tmp_path.joinpath(f'{i}.tif'), size=16, seed=i) for i in range(3)]
+    pool = building_zonals.RasterPool(max_open=2)
+    for _ in range(2):
+        with pool.open(rasters[0]) as src:
+            assert not src.closed
+    assert pool.opened == 1
+    with pool.open(rasters[0]) as first:
+        for raster in rasters[1:]:
+            with pool.open(raster):
+                pass
+        assert not first.closed # in use, so not evicted
+    assert len(pool) == 2
+    with pool.open(rasters[1]) as src:
+        pass
+    pool.close()
+    assert src.closed and len(pool) == 0
+
+
+def test_info_is_memoized_and_refreshed(tmp_path):
+    raster = make_raster(tmp_path.joinpath('tile.tif'), size=16)
+    pool = building_zonals.RasterPool()
+    info = pool.info(raster)
+    with rasterio.open(raster) as src:
+        assert info.bounds == src.bounds
+        assert info.transform == src.transform
+        assert info.nodata == src.nodata
+    assert pool.info(raster) is info
+    pool.close()
+    make_raster(raster, origin=(0, 16), size=16)
+    os.utime(raster, ns=(0, 0))
+    assert pool.info(raster).bounds.left == 0
+
+
+def test_handles_are_per_thread(synthetic_raster):
+    pool = building_zonals.RasterPool()
+    handles = []
+    def read():
+        with pool.open(synthetic_raster) as src:
+            handles.append(src)
+            src.read(1)
+    threads = [threading.Thread(target=read) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert handles[0] is not handles[1]
+
+
+def test_process_pool_is_shared(synthetic_raster):
+    assert building_zonals.get_raster_pool() is building_zonals.get_raster_pool()
+    with building_zonals.open_raster(synthetic_raster) as src:
+        assert building_zonals.raster_info(synthetic_raster).width == src.width
+    building_zonals.close_rasters()
+    assert src.closed
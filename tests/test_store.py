@@ -0,0 +1,52 @@
+"""Unit tests for store.py"""
+
+import pytest
+
+import numpy as np
+import pandas as pd
+
+import building_zonals
+
+@pytest.fixture
+def tiles(tmp_path):
+    paths = []
+    for i, tile_name in enumerate(['TQ38', 'TQ48']):
+        df = pd.DataFrame({
+            'osm_id': np.array([1, 2], dtype=np.int64) + 10_000_000_000 * i,
+            'heights_mean': [1.5, 2.5],
+            'tile_name': tile_name})
+        paths.append(building_zonals.write_zonals(df, tmp_path.joinpath(f'{tile_name}.parquet')))
+    yield paths
+
+
+def test_merge_zonals(tmp_path, tiles):
+    out_path = tmp_path.joinpath(building_zonals.ZONALS_TABLE)
+    df = building_zonals.merge_zonals(tiles, out_path)
+    assert len(df) == 4
+    assert df.osm_id.dtype == 'int64'
+    assert df.osm_id.max() == 10_000_000_002
+    pd.testing.assert_frame_equal(building_zonals.read_zonals(out_path), df)
+
+
+def test_read_zonals_csv(tmp_path, tiles):
+    df = building_zonals.read_zonals(tiles[0])
+    df.to_csv(tmp_path.joinpath('tile.csv'), index=False)
+    pd.testing.assert_frame_equal(building_zonals.read_zonals(tmp_path.joinpath('tile.csv')), df)
+    assert building_zonals.read_zonals(df) is df
+
+
+def test_reduce_partial_files(tmp_path):
+    rng = np.random.default_rng(0)
+    labels = rng.integers(1, 40, size=(20, 20)).astype(np.float64)
+    heights = rng.normal(10, 3, size=(20, 20))
+    edge_ids = np.unique(labels[9:11])
+    paths = []
+    for i, rows in enumerate([slice(0, 10), slice(10, 20)]):
+        df = building_zonals.partial_zonal_stats(labels[rows], heights[rows], edge_ids)
+        df['osm_id'] = df.osm_id.astype(np.int64)
+        paths.append(building_zonals.write_zonals(df, tmp_path.joinpath(f'{i}.parquet')))
+    expected = building_zonals.reduce_partial_stats(building_zonals.merge_zonals(paths), ['mean', 'med'])
+    df = pd.concat(building_zonals.reduce_partial_files(paths, ['mean', 'med'], n_partitions=4)).sort_index()
+    pd.testing.assert_frame_equal(df, expected)
+    with pytest.raises(ValueError):
+        next(building_zonals.reduce_partial_files(paths, ['mean'], n_partitions=3))
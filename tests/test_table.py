@@ -0,0 +1,51 @@
+"""Unit tests for table.py"""
+
+import pytest
+
+import numpy as np
+import pandas as pd
+from shapely.geometry import box
+
+import building_zonals
+
+#fixtures
+@pytest.fixture
+def gpkg(tmp_path, synthetic_buildings):
+    gpkg = tmp_path.joinpath('buildings.gpkg')
+    synthetic_buildings.to_file(gpkg, layer='buildings_uk')
+    yield gpkg
+
+
+def test_compact_buildings(synthetic_buildings):
+    gdf = building_zonals.compact_buildings(synthetic_buildings.copy())
+    assert gdf.osm_id.dtype == np.int64
+    assert gdf.osm_id.min() > 2 ** 31
+    assert isinstance(gdf.tile_name.dtype, pd.CategoricalDtype)
+    assert isinstance(gdf['type'].dtype, pd.CategoricalDtype)
+    assert gdf.memory_usage(deep=True).sum() < synthetic_buildings.memory_usage(deep=True).sum()
+
+
+def test_read_matches_read_file(gpkg, synthetic_buildings):
+    buildings = building_zonals.BuildingTable.read(gpkg, 'buildings_uk')
+    assert len(buildings) == len(synthetic_buildings)
+    np.testing.assert_array_equal(buildings.ids, synthetic_buildings.osm_id.values)
+    gdf = buildings.take()
+    assert list(gdf.columns) == list(synthetic_buildings.columns)
+    assert gdf.geometry.geom_equals(synthetic_buildings.geometry).all()
+    assert (gdf['type'].astype(object).fillna('') == synthetic_buildings['type'].fillna('')).all()
+
+
+def test_query_bounds_matches_sindex(synthetic_buildings):
+    buildings = building_zonals.BuildingTable.from_geodataframe(synthetic_buildings)
+    for bounds in [(530000, 189800, 530100, 189900), (529980, 189790, 530010, 189820), (0, 0, 1, 1)]:
+        expected = np.sort(synthetic_buildings.sindex.query(box(*bounds)))
+        np.testing.assert_array_equal(buildings.query_bounds(bounds), expected)
+
+
+def test_missing(synthetic_buildings):
+    buildings = building_zonals.BuildingTable.from_geodataframe(synthetic_buildings)
+    zonals = pd.DataFrame({'osm_id': synthetic_buildings.osm_id.values[:100], 'tile_name': 'TQ38'})
+    np.testing.assert_array_equal(buildings.missing(zonals), np.arange(100, len(synthetic_buildings)))
+    assert len(buildings.missing(zonals.assign(tile_name='TQ48'))) == 0
+    assert len(buildings.missing(zonals.assign(tile_name='TQ48'), by_tile=False)) == len(synthetic_buildings) - 100
+
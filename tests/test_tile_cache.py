@@ -0,0 +1,149 @@
+"""Unit tests for tile_cache.py"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import pytest
+
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.windows import Window
+
+import building_zonals
+from .conftest import make_raster, make_buildings
+
+
+@pytest.fixture
+def raster_cache(tmp_path, monkeypatch):
+    monkeypatch.delenv(building_zonals.RASTER_CACHE_ENV, raising=False)
+    building_zonals.set_raster_cache(tmp_path.joinpath('cache'))
+    yield building_zonals.get_raster_cache()
+    building_zonals.set_raster_cache(None)
+
+
+def test_cached_heights_match_decoded(tmp_path, synthetic_raster):
+    cache = building_zonals.RasterCache(tmp_path.joinpath('cache'), rows_per_read=20) # several strips
+    window = Window(13, 50, 70, 101)
+    with rasterio.open(synthetic_raster) as src:
+        expected = building_zonals.decode_heights(src)
+        expected_window = building_zonals.decode_heights(src, window)
+    heights = cache.heights(synthetic_raster)
+    np.testing.assert_array_equal(heights, expected)
+    np.testing.assert_array_equal(cache.heights(synthetic_raster, window), expected_window)
+    assert np.isnan(heights).any() and not heights.flags.writeable
+    assert cache.converted == 1
+
+
+def test_cache_is_reused_until_raster_changes(tmp_path, synthetic_raster):
+    cache_dir = tmp_path.joinpath('cache')
+    building_zonals.RasterCache(cache_dir).heights(synthetic_raster)
+    cache = building_zonals.RasterCache(cache_dir) # new process, same folder
+    cache.heights(synthetic_raster)
+    assert cache.converted == 0 and cache.is_current(synthetic_raster)
+
+    make_raster(synthetic_raster, seed=5)
+    os.utime(synthetic_raster, ns=(1, 1))
+    assert not cache.is_current(synthetic_raster)
+    with rasterio.open(synthetic_raster) as src:
+        np.testing.assert_array_equal(cache.heights(synthetic_raster), building_zonals.decode_heights(src))
+    assert cache.converted == 1
+
+
+def test_incomplete_conversion_is_redone(tmp_path, synthetic_raster):
+    cache = building_zonals.RasterCache(tmp_path.joinpath('cache'))
+    cache.convert(synthetic_raster)
+    cache.paths(synthetic_raster)[1].unlink() # killed before the sidecar was written
+    assert not cache.is_current(synthetic_raster)
+    cache.heights(synthetic_raster)
+    assert cache.converted == 2
+
+
+def test_set_raster_cache(tmp_path, monkeypatch):
+    monkeypatch.delenv(building_zonals.RASTER_CACHE_ENV, raising=False)
+    assert building_zonals.get_raster_cache() is None
+    building_zonals.set_raster_cache(tmp_path)
+    cache = building_zonals.get_raster_cache()
+    assert os.environ[building_zonals.RASTER_CACHE_ENV] == str(tmp_path.resolve())
+    assert building_zonals.get_raster_cache() is cache
+    building_zonals.set_raster_cache(None)
+    assert building_zonals.get_raster_cache() is None
+
+
+def test_cached_mosaic_window_matches_merge(tmp_path, raster_cache):
+    rasters = [
+        make_raster(tmp_path.joinpath('DSM_DTM_TQ38_m100_10K_Tile.tif'), seed=1),
+        make_raster(tmp_path.joinpath('DSM_DTM_TQ48_m100_10K_Tile.tif'), origin=(530200, 190000), seed=2)]
+    bounds = (530150, 189880, 530260, 190000)
+    heights, transform = building_zonals.read_mosaic_window(rasters, bounds)
+    building_zonals.set_raster_cache(None)
+    expected, expected_transform = building_zonals.read_mosaic_window(rasters, bounds)
+    np.testing.assert_array_equal(heights, expected)
+    assert transform == expected_transform
+
+
+def test_partials_match_with_cache(synthetic_raster, raster_cache):
+    gdf = make_buildings()
+    cached = building_zonals.get_tile_building_height_partials(synthetic_raster, gdf, memory_budget=1 << 16)
+    lazy = building_zonals.get_tile_building_height_partials_lazy(synthetic_raster, gdf, chunk_size=64)
+    assert raster_cache.converted == 1
+    building_zonals.set_raster_cache(None)
+    expected = building_zonals.get_tile_building_height_partials(synthetic_raster, gdf)
+    expected_lazy = building_zonals.get_tile_building_height_partials_lazy(synthetic_raster, gdf, chunk_size=64)
+    pd.testing.assert_frame_equal(cached, expected)
+    pd.testing.assert_frame_equal(lazy, expected_lazy)
+
+
+def test_conversion_only_blocks_its_own_raster(tmp_path, synthetic_raster):
+    other = make_raster(tmp_path.joinpath('DSM_DTM_TQ48_m100_10K_Tile.tif'), origin=(530200, 190000), seed=2)
+    cache = building_zonals.RasterCache(tmp_path.joinpath('cache'))
+    started, release = threading.Event(), threading.Event()
+    convert = cache.convert
+
+    def slow_convert(raster):
+        if raster == synthetic_raster:
+            started.set()
+            release.wait(10)
+        return convert(raster)
+    cache.convert = slow_convert
+    with ThreadPoolExecutor(max_workers=4) as exec:
+        blocked = [exec.submit(cache.heights, synthetic_raster) for _ in range(3)]
+        assert started.wait(10)
+        assert exec.submit(cache.heights, other).result(timeout=10).shape == (200, 200)
+        assert not any(x.done() for x in blocked)
+        release.set()
+        heights = [x.result(timeout=10) for x in blocked]
+    assert heights[0] is heights[1] is heights[2]
+    assert cache.converted == 2
+
+
+def test_use_raster_cache_restores_previous(tmp_path, monkeypatch):
+    monkeypatch.setenv(building_zonals.RASTER_CACHE_ENV, str(tmp_path.joinpath('old')))
+    with pytest.raises(RuntimeError):
+        with building_zonals.use_raster_cache(tmp_path.joinpath('new')) as cache:
+            assert cache.cache_dir == tmp_path.joinpath('new')
+            raise RuntimeError('tile failed')
+    assert os.environ[building_zonals.RASTER_CACHE_ENV] == str(tmp_path.joinpath('old'))
+    with building_zonals.use_raster_cache(None) as cache: # left as it is
+        assert cache.cache_dir == tmp_path.joinpath('old')
+
+
+def test_failed_run_turns_cache_off(tmp_path, monkeypatch):
+    monkeypatch.delenv(building_zonals.RASTER_CACHE_ENV, raising=False)
+    raster_dir = tmp_path.joinpath('rasters')
+    raster_dir.mkdir()
+    make_raster(raster_dir.joinpath('DSM_DTM_TQ38_m100_10K_Tile.tif'))
+    gpkg = tmp_path.joinpath('buildings.gpkg')
+    make_buildings().to_file(gpkg, layer='buildings')
+    closed = []
+    monkeypatch.setattr(building_zonals, 'close_rasters', lambda: closed.append(True))
+
+    def fail(*args):
+        raise RuntimeError('tile failed')
+    monkeypatch.setattr(building_zonals, 'get_tile_building_height_partials', fail)
+    with pytest.raises(RuntimeError):
+        building_zonals.BuildingHeightsSingle(
+            None, gpkg, 'buildings', 'osm_id', 27700, raster_dir, ['mean'],
+            output_gpkg=tmp_path.joinpath('out.gpkg'), raster_cache=tmp_path.joinpath('cache'))
+    assert building_zonals.get_raster_cache() is None
+    assert closed
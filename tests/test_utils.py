@@ -4,10 +4,12 @@ from pathlib import Path
 import pytest
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import rasterio
 
 import building_zonals
+from .conftest import make_buildings
 
 DATA_DIR = Path(__file__).resolve().parent.joinpath('data')
 SHP = DATA_DIR.joinpath('buildings_uk.shp')
@@ -97,3 +99,66 @@ def test_join_csv_to_global_shape():
 
 
 
+def test_sample_raster_points(synthetic_raster):
+    rng = np.random.default_rng(0)
+    xs = rng.uniform(529990, 530210, 500)
+    ys = rng.uniform(189790, 190010, 500)
+    values = building_zonals.sample_raster_points(synthetic_raster, xs, ys, strip_rows=32)
+    with rasterio.open(synthetic_raster) as src:
+        inside = (xs > src.bounds.left) & (xs < src.bounds.right) & (ys > src.bounds.bottom) & (ys < src.bounds.top)
+        expected = np.array([x[0] for x in src.sample(zip(xs[inside], ys[inside]))], dtype=np.float64)
+        expected[expected == src.nodata] = np.nan
+    np.testing.assert_array_equal(values[inside], expected)
+    assert np.isnan(values[~inside]).all()
+
+
+def test_sample_missing_buildings(synthetic_raster, synthetic_buildings):
+    gdf = synthetic_buildings
+    zonals = pd.DataFrame({'osm_id': gdf.osm_id.values[:100], 'tile_name': 'TQ38'})
+    df, gdf_overlapping = building_zonals.sample_missing_buildings_and_join_back_to_csv(
+        gdf, zonals, synthetic_raster.parent)
+    assert len(df) + len(gdf_overlapping) == 50
+    assert list(df.columns) == ['osm_id', 'heights_mean', 'heights_min', 'heights_max', 'heights_med']
+
+
+def test_rasterise_codes_matches_rasterise_clip(synthetic_raster, synthetic_buildings):
+    grid = building_zonals.rasterise_clip(synthetic_raster, synthetic_buildings)
+    with rasterio.open(synthetic_raster) as src:
+        heights = building_zonals.read_heights(src)
+        buffer = np.full((src.height, src.width), 7, dtype=np.uint32)
+        codes = building_zonals.rasterise_codes(synthetic_buildings, heights.shape, src.transform, buffer)
+    assert codes is buffer
+    ids = np.where(codes > 0, synthetic_buildings.osm_id.values[codes.astype(np.int64) - 1], -1)
+    np.testing.assert_array_equal(ids, np.nan_to_num(grid.osm_id.values, nan=-1).astype(np.int64))
+    np.testing.assert_array_equal(heights, grid.heights.values[0])
+
+
+def test_convert_shp_to_gpkg_in_batches(tmp_path):
+    gdf = make_buildings(300, origin=(529900, 190100), size=400, seed=4)
+    shp = tmp_path.joinpath('buildings.shp')
+    gdf.drop(columns='tile_name').assign(osm_id=gdf.osm_id.astype(str)).to_crs(4326).to_file(shp)
+    gpkg = tmp_path.joinpath('buildings.gpkg')
+    assert building_zonals.convert_shp_to_gpkg(shp, gpkg, OUT_LAYER, batch_size=64) == len(gdf)
+    gdf_gpkg = gpd.read_file(gpkg, layer=OUT_LAYER)
+    assert list(gdf_gpkg.columns) == ['osm_id', 'name', 'type', 'tile_name', 'geometry']
+    assert gdf_gpkg.osm_id.dtype == np.int64
+    np.testing.assert_array_equal(gdf_gpkg.osm_id.values, gdf.osm_id.values)
+    grid = gpd.read_file(building_zonals.GRID_GPKG)
+    expected = gpd.GeoDataFrame(geometry=gdf.centroid).sjoin(grid, predicate='intersects')
+    expected = expected[~expected.index.duplicated()].tile_name.reindex(gdf.index)
+    assert set(expected) == {'TQ28', 'TQ29', 'TQ38', 'TQ39'}
+    assert (gdf_gpkg.tile_name == expected.values).all()
+    assert gdf_gpkg.geometry.normalize().geom_equals_exact(gdf.geometry.normalize(), 1e-2).all()
+
+
+def test_interrupted_conversion_leaves_no_gpkg(tmp_path, monkeypatch):
+    gdf = make_buildings(10)
+
+    def batches(shp, batch_size):
+        yield gdf
+        raise KeyboardInterrupt
+    monkeypatch.setattr(building_zonals.utils, 'iter_shp_batches', batches)
+    gpkg = tmp_path.joinpath('buildings.gpkg')
+    with pytest.raises(KeyboardInterrupt):
+        building_zonals.convert_shp_to_gpkg(tmp_path.joinpath('buildings.shp'), gpkg, OUT_LAYER)
+    assert list(tmp_path.iterdir()) == []
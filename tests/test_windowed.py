@@ -0,0 +1,34 @@
+"""Unit tests for windowed.py"""
+
+import numpy as np
+import pandas as pd
+import rasterio
+
+import building_zonals
+
+STATS = ['mean', 'min', 'max', 'med']
+
+def test_iter_row_windows(synthetic_raster):
+    with rasterio.open(synthetic_raster) as src:
+        windows = list(building_zonals.iter_row_windows(src, 200 * 40 * building_zonals.BYTES_PER_PIXEL))
+        assert all(w.width == src.width for w in windows)
+        assert all(w.row_off % 16 == 0 for w in windows)
+        assert sum(w.height for w in windows) == src.height
+    assert windows[0].height == 32
+
+
+def test_windowed_matches_whole_raster(synthetic_raster, synthetic_buildings):
+    grid = building_zonals.rasterise_clip(synthetic_raster, synthetic_buildings)
+    expected = building_zonals.get_building_height_stats(grid, STATS)
+    df = building_zonals.get_building_height_stats_windowed(
+        synthetic_raster, synthetic_buildings, STATS, 200 * 16 * building_zonals.BYTES_PER_PIXEL)
+    pd.testing.assert_frame_equal(df, expected)
+
+
+def test_reducer_holds_back_spanning_ids():
+    reducer = building_zonals.WindowedZonalReducer(['med'], np.array([2]))
+    reducer.add(np.array([1, 1, 2, 2]), np.array([1.0, 2.0, 10.0, 20.0]))
+    reducer.add(np.array([2, 3]), np.array([30.0, 5.0]))
+    df = reducer.result()
+    assert df.osm_id.tolist() == [1, 2, 3]
+    assert df.heights_med.tolist() == [1.5, 20.0, 5.0]
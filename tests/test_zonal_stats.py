@@ -0,0 +1,134 @@
+"""Unit tests for zonal_stats.py"""
+
+import pytest
+
+import numpy as np
+import pandas as pd
+import xarray
+
+import building_zonals
+
+STATS = ['mean', 'min', 'max', 'med']
+
+#fixtures
+@pytest.fixture
+def grid():
+    rng = np.random.default_rng(0)
+    labels = rng.integers(1, 50, size=(1, 60, 80)).astype(np.float64)
+    labels[:, :5, :] = np.nan
+    heights = rng.normal(1000, 300, size=(1, 60, 80)).astype(np.float32)
+    heights[:, 10, :20] = np.nan
+    labels[:, 20:25, :] = 7.0
+    heights[:, 20:25, :] = np.nan
+    labels[0, 30, 0] = 99.0
+    heights[0, 30, 0] = np.nan
+    yield labels, heights
+
+
+def xarray_stats(labels, heights):
+    """Reference implementation using xarray groupby"""
+    ds = xarray.Dataset({
+        'osm_id': (('y', 'x'), labels[0]),
+        'heights': (('band', 'y', 'x'), heights)}).set_coords('osm_id')
+    grouped = ds.groupby('osm_id')
+    df = xarray.merge([
+        grouped.mean().rename({"heights": "heights_mean"}),
+        grouped.min().rename({"heights": "heights_min"}),
+        grouped.max().rename({"heights": "heights_max"}),
+        grouped.median().rename({"heights": "heights_med"})]).to_dataframe().reset_index()
+    return df[["osm_id", "heights_mean", "heights_min", "heights_max", "heights_med"]]
+
+
+def test_zonal_stats_matches_xarray(grid):
+    labels, heights = grid
+    df = building_zonals.zonal_stats(labels, heights, STATS)
+    expected = xarray_stats(labels, heights)
+    assert list(df.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(df, expected, check_dtype=False, rtol=1e-5)
+
+
+def test_zonal_stats_requested_only(grid):
+    labels, heights = grid
+    df = building_zonals.zonal_stats(labels, heights, ['min'])
+    assert df.heights_mean.isna().all()
+    assert df.heights_med.isna().all()
+    assert df.heights_min.notna().sum() == df.osm_id.nunique() - 1
+
+
+def test_zonal_stats_integer_labels():
+    labels = np.array([0, 1, 1, 2, 2, 2, 0], dtype=np.uint32)
+    values = np.array([9.0, 1.0, 3.0, 4.0, 5.0, 9.0, 9.0])
+    df = building_zonals.zonal_stats(labels, values, STATS, nodata_label=0)
+    assert df.osm_id.tolist() == [1, 2]
+    assert df.heights_mean.tolist() == [2.0, 6.0]
+    assert df.heights_med.tolist() == [2.0, 5.0]
+
+
+def test_zonal_stats_empty():
+    df = building_zonals.zonal_stats(np.full(4, np.nan), np.ones(4), STATS)
+    assert df.empty
+    assert list(df.columns) == ['osm_id', 'heights_mean', 'heights_min', 'heights_max', 'heights_med']
+
+
+def test_reduce_partial_stats_matches_whole(grid):
+    labels, heights = grid
+    expected = building_zonals.zonal_stats(labels, heights, STATS).set_index('osm_id')
+    edge_ids = np.unique(labels[:, 28:32][~np.isnan(labels[:, 28:32])])
+    partials = pd.concat([
+        building_zonals.partial_zonal_stats(labels[:, :30], heights[:, :30], edge_ids),
+        building_zonals.partial_zonal_stats(labels[:, 30:], heights[:, 30:], edge_ids)])
+    df = building_zonals.reduce_partial_stats(partials, STATS)
+    assert list(df.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(df.drop(columns='heights_med'), expected.drop(columns='heights_med'), check_names=False)
+    med_error = (df.heights_med - expected.heights_med).abs()
+    assert med_error.max() <= building_zonals.HIST_BIN_WIDTH / 2
+
+
+def test_reduce_partial_stats_single_partial_is_exact(grid):
+    labels, heights = grid
+    expected = building_zonals.zonal_stats(labels, heights, ['med']).set_index('osm_id')
+    partials = building_zonals.partial_zonal_stats(labels, heights)
+    df = building_zonals.reduce_partial_stats(partials, ['med'])
+    pd.testing.assert_series_equal(df.heights_med, expected.heights_med, check_names=False)
+    assert df.heights_mean.isna().all()
+
+
+def test_partials_from_stats():
+    samples = pd.DataFrame({'osm_id': [1, 2], 'heights_mean': [5.0, np.nan]})
+    partials = building_zonals.partials_from_stats(samples)
+    df = building_zonals.reduce_partial_stats(partials, STATS)
+    assert partials.heights_count.tolist() == [1, 0]
+    assert df.loc[1].tolist() == [5.0] * 4
+    assert df.loc[2].isna().all()
+
+
+def test_merge_partial_stats_in_a_tree(grid):
+    labels, heights = grid
+    expected = building_zonals.zonal_stats(labels, heights, STATS).set_index('osm_id')
+    quarters = [(slice(None, 20), slice(None, 30)), (slice(None, 20), slice(30, None)),
+                (slice(20, None), slice(None, 30)), (slice(20, None), slice(30, None))]
+    partials = [
+        building_zonals.partial_zonal_stats(labels[q], heights[q], np.unique(labels[q][~np.isnan(labels[q])]))
+        for q in quarters]
+    top = building_zonals.merge_partial_stats(pd.concat(partials[:2]))
+    bottom = building_zonals.merge_partial_stats(pd.concat(partials[2:]))
+    merged = building_zonals.merge_partial_stats(pd.concat([top, bottom]), edge_ids=np.array([]))
+    assert merged.osm_id.is_unique
+    assert merged.heights_hist_bins.isna().all()
+    df = building_zonals.reduce_partial_stats(merged, STATS)
+    pd.testing.assert_frame_equal(df.drop(columns='heights_med'), expected.drop(columns='heights_med'), check_names=False)
+    assert (df.heights_med - expected.heights_med).abs().max() <= building_zonals.HIST_BIN_WIDTH / 2
+
+
+def test_packed_sort_matches_lexsort():
+    rng = np.random.default_rng(1)
+    labels = rng.integers(0, 50, 5000).astype(np.uint32)
+    values = rng.normal(0, 10, 5000).astype(np.float32)
+    values[:20] = np.nan
+    values[20:25] = -np.inf
+    values[25:30] = np.inf
+    values[30] = -0.0
+    packed = building_zonals.zonal_stats(labels, values, STATS, nodata_label=0)
+    expected = building_zonals.zonal_stats(labels.astype(np.int64), values, STATS, nodata_label=0)
+    assert packed.osm_id.dtype == np.uint32
+    pd.testing.assert_frame_equal(packed.astype({'osm_id': np.int64}), expected)